@@ -6,52 +6,346 @@
 # found in the LICENSE file.
 
 # Experimental Skia Multi-Picture Doc parser.
+#
+# Usage:
+#   python mskp_parser.py MSKP_FILE [OUTPUT_SKP]
+#   python mskp_parser.py MSKP_FILE --split OUTPUT_DIR [--jobs N]
+#
+# Or as a library:
+#   with mskp_parser.MSKP('doc.mskp') as doc:
+#     for page in doc.pages:
+#       ...
+#     doc.split('out_dir')
+#
+# Version 1 documents hold one SKP per page, at offsets listed in the header.
+# Version 2 documents (see src/utils/SkMultiPictureDocument.cpp) hold a single
+# SKP which draws each page's picture in turn, so the pages are that SKP's
+# sub-pictures. They're found by walking its tags once; the resulting index is
+# cached next to the document. Sub-pictures share their parent's typefaces, so
+# a page extracted from a version 2 document gets a copy of them to make it a
+# complete SKP.
 
 from __future__ import print_function
 
-import fileinput
-import sys
+import argparse
+import collections
+import json
+import mmap
+import multiprocessing.pool
+import os
 import struct
+import sys
+
+MAGIC = b'Skia Multi-Picture Doc\n\n'
+SKP_MAGIC = b'skiapict'
+
+# From SkReadBuffer.h and SkPicture.cpp.
+REMOVE_HEADER_FLAGS_VERSION = 60
+PICTURE_DATA_TRAILING_BYTE = 1
+
+def _tag(name):
+  a, b, c, d = bytearray(name)
+  return (a << 24) | (b << 16) | (c << 8) | d
+
+# From SkPictureData.h.
+READER_TAG = _tag(b'read')
+FACTORY_TAG = _tag(b'fact')
+TYPEFACE_TAG = _tag(b'tpfc')
+PICTURE_TAG = _tag(b'pctr')
+BUFFER_SIZE_TAG = _tag(b'aray')
+EOF_TAG = _tag(b'eof ')
+
+# From SkFontDescriptor.cpp.
+FONT_FAMILY_NAME = 0x01
+FONT_FULL_NAME = 0x04
+FONT_POSTSCRIPT_NAME = 0x06
+FONT_AXES = 0xFB
+FONT_AXES_BAD = 0xFC
+FONT_INDEX = 0xFD
+FONT_SENTINEL = 0xFF
+
+INDEX_SUFFIX = '.index.json'
+
+
+class MSKPError(Exception):
+  pass
+
+
+# offset and length are the page's bytes in the document. For version 2
+# documents, buffer_offset is where in those bytes the document's typefaces
+# must be inserted to make a complete SKP.
+Page = collections.namedtuple(
+    'Page', ['index', 'width', 'height', 'offset', 'length', 'buffer_offset'])
+
+
+def _u32(data, pos):
+  return struct.unpack_from('<I', data, pos)[0], pos + 4
+
+
+def _packed_uint(data, pos):
+  """Reads a uint written by SkWStream::writePackedUInt."""
+  b = struct.unpack_from('<B', data, pos)[0]
+  if b == 0xFE:
+    return struct.unpack_from('<H', data, pos + 1)[0], pos + 3
+  if b == 0xFF:
+    return struct.unpack_from('<I', data, pos + 1)[0], pos + 5
+  return b, pos + 1
+
+
+def _skip_typeface(data, pos):
+  """Skips a typeface written by SkFontDescriptor::serialize."""
+  _, pos = _packed_uint(data, pos)  # style
+  while True:
+    field, pos = _packed_uint(data, pos)
+    if field == FONT_SENTINEL:
+      break
+    if field in (FONT_FAMILY_NAME, FONT_FULL_NAME, FONT_POSTSCRIPT_NAME):
+      length, pos = _packed_uint(data, pos)
+      pos += length
+    elif field == FONT_AXES:
+      count, pos = _packed_uint(data, pos)
+      pos += 4 * count
+    elif field == FONT_AXES_BAD:
+      count, pos = _packed_uint(data, pos)
+      for _ in range(count):
+        _, pos = _packed_uint(data, pos)
+    elif field == FONT_INDEX:
+      _, pos = _packed_uint(data, pos)
+    else:
+      raise MSKPError('unknown typeface field %d at offset %d (typefaces '
+                      'from a custom serializer are not supported)'
+                      % (field, pos))
+  length, pos = _packed_uint(data, pos)
+  return pos + length
+
+
+def _parse_picture(data, pos):
+  """Walks the SKP at pos, as written by SkPicture::serialize.
+
+  Returns a dict with the picture's 'end', and the offsets of its 'typefaces'
+  section (offset, length) and its 'buffer' tag, if any, and its
+  sub-'pictures' (offset, length, buffer offset).
+  """
+  if data[pos:pos + len(SKP_MAGIC)] != SKP_MAGIC:
+    raise MSKPError('no SKP at offset %d' % pos)
+  version, _ = _u32(data, pos + len(SKP_MAGIC))
+  pos += len(SKP_MAGIC) + 4 + 16  # version, cull rect
+  if version < REMOVE_HEADER_FLAGS_VERSION:
+    pos += 4
+  if struct.unpack_from('<B', data, pos)[0] != PICTURE_DATA_TRAILING_BYTE:
+    raise MSKPError('SKP at offset %d holds no picture data' % pos)
+  pos += 1
 
-if len(sys.argv) < 2:
-  sys.stderr.write('Usage:\n\tpython %s MSKP_FILE [OUTPUT_SKP]\n\n'
-                   % sys.argv[0])
-  exit(1)
-
-mskp_src = sys.argv[1]
-src = open(mskp_src, 'rb')
-
-magic_constant = b'Skia Multi-Picture Doc\n\n'
-magic = src.read(len(magic_constant))
-if magic != magic_constant:
-  sys.stderr.write('Not a mskp file: "%s"\n' % mskp_src)
-  exit(2)
-
-version, page_count = struct.unpack('II', src.read(8))[:2]
-print('MSKP version: ', version)
-print('page count: ', page_count)
-if version > 2 or version < 1:
-  #TODO(halcanary): Remove support for version 1.
-  sys.stderr.write('unsupported mskp version\n')
-  exit(3)
-offsets = []
-for page in range(page_count):
-  print('page %3d\t' % page, end='')
-  if version == 1:
-    offset, size_x, size_y =struct.unpack('Qff', src.read(16))
-    print('offset = %-7d\t' % offset, end='')
-    offsets.append(offset)
-  elif version == 2:
-    size_x, size_y =struct.unpack('ff', src.read(8))
-  print('size = (%r,%r)' % (size_x, size_y))
-
-if len(sys.argv) >= 3:
-  with open(sys.argv[2], 'wb') as o:
-    if version == 2 or len(offsets) < 2:
-      while True:
-        file_buffer = src.read(8192)
-        if 0 == len(file_buffer):
-          break
-        o.write(file_buffer)
+  picture = {'typefaces': None, 'buffer': None, 'pictures': []}
+  while True:
+    tag_offset = pos
+    tag, pos = _u32(data, pos)
+    if tag == EOF_TAG:
+      break
+    size, pos = _u32(data, pos)
+    if tag in (READER_TAG, FACTORY_TAG, BUFFER_SIZE_TAG):
+      if tag == BUFFER_SIZE_TAG:
+        picture['buffer'] = tag_offset
+      pos += size
+    elif tag == TYPEFACE_TAG:
+      for _ in range(size):
+        pos = _skip_typeface(data, pos)
+      picture['typefaces'] = (tag_offset, pos - tag_offset)
+    elif tag == PICTURE_TAG:
+      for _ in range(size):
+        start = pos
+        sub = _parse_picture(data, pos)
+        pos = sub['end']
+        picture['pictures'].append((start, pos - start, sub['buffer']))
     else:
-      o.write(src.read(offsets[1] - offsets[0]))
+      raise MSKPError('unknown SKP tag 0x%08x at offset %d'
+                      % (tag, tag_offset))
+  picture['end'] = pos
+  return picture
+
+
+class MSKP(object):
+  """A memory-mapped Skia Multi-Picture Document."""
+
+  def __init__(self, path, cache_index=True):
+    self.path = path
+    self._cache_index = cache_index
+    self._pages = None
+    self._typefaces = None
+    with open(path, 'rb') as f:
+      if os.fstat(f.fileno()).st_size < len(MAGIC) + 8:
+        raise MSKPError('Not a mskp file: "%s"' % path)
+      self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      self._read_header()
+    except (MSKPError, struct.error):
+      self.close()
+      raise
+
+  def _read_header(self):
+    if self._data[:len(MAGIC)] != MAGIC:
+      raise MSKPError('Not a mskp file: "%s"' % self.path)
+    pos = len(MAGIC)
+    self.version, pos = _u32(self._data, pos)
+    page_count, pos = _u32(self._data, pos)
+    if self.version not in (1, 2):
+      #TODO(halcanary): Remove support for version 1.
+      raise MSKPError('unsupported mskp version %d' % self.version)
+    self.sizes = []
+    self._offsets = []
+    for _ in range(page_count):
+      if self.version == 1:
+        offset, width, height = struct.unpack_from('<Qff', self._data, pos)
+        self._offsets.append(offset)
+        pos += 16
+      else:
+        width, height = struct.unpack_from('<ff', self._data, pos)
+        pos += 8
+      self.sizes.append((width, height))
+    self._skp_offset = pos
+
+  def close(self):
+    self._data.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return len(self.sizes)
+
+  @property
+  def pages(self):
+    """The document's pages, indexed the first time they're asked for."""
+    if self._pages is None:
+      self._build_index()
+    return self._pages
+
+  def _index_path(self):
+    return self.path + INDEX_SUFFIX
+
+  def _file_key(self):
+    st = os.stat(self.path)
+    return [st.st_size, st.st_mtime]
+
+  def _build_index(self):
+    if self.version == 1:
+      ends = self._offsets[1:] + [len(self._data)]
+      self._set_pages([(offset, end - offset, None)
+                       for offset, end in zip(self._offsets, ends)])
+      return
+
+    if self._cache_index and os.path.isfile(self._index_path()):
+      with open(self._index_path()) as f:
+        cached = json.load(f)
+      if cached.get('file') == self._file_key():
+        self._typefaces = cached['typefaces']
+        self._set_pages(cached['pages'])
+        return
+
+    try:
+      doc = _parse_picture(self._data, self._skp_offset)
+    except struct.error:
+      raise MSKPError('truncated SKP in "%s"' % self.path)
+    if len(doc['pictures']) != len(self.sizes):
+      # Pages with at most one draw are recorded inline rather than as
+      # sub-pictures.
+      raise MSKPError('"%s" has %d pages but %d sub-pictures; cannot tell '
+                      'them apart' % (self.path, len(self.sizes),
+                                      len(doc['pictures'])))
+    self._typefaces = doc['typefaces']
+    self._set_pages(doc['pictures'])
+
+    if self._cache_index:
+      try:
+        with open(self._index_path(), 'w') as f:
+          json.dump({'file': self._file_key(),
+                     'typefaces': self._typefaces,
+                     'pages': [[p.offset, p.length, p.buffer_offset]
+                               for p in self._pages]}, f)
+      except (IOError, OSError):
+        pass  # The index is only a cache.
+
+  def _set_pages(self, locations):
+    self._pages = [Page(i, w, h, offset, length, buffer_offset)
+                   for i, ((w, h), (offset, length, buffer_offset))
+                   in enumerate(zip(self.sizes, locations))]
+
+  def page_data(self, index):
+    """Returns page index as a complete SKP."""
+    page = self.pages[index]
+    data = self._data[page.offset:page.offset + page.length]
+    if not self._typefaces or page.buffer_offset is None:
+      return data
+    # Typefaces must come before the buffer which refers to them.
+    offset, length = self._typefaces
+    split = page.buffer_offset - page.offset
+    return (data[:split] + self._data[offset:offset + length] +
+            data[split:])
+
+  def write_page(self, index, dst):
+    with open(dst, 'wb') as o:
+      o.write(self.page_data(index))
+
+  def split(self, output_dir, jobs=None):
+    """Writes each page to output_dir as <name>_<page>.skp, several at once.
+
+    Returns the paths written.
+    """
+    if not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+    name = os.path.splitext(os.path.basename(self.path))[0]
+    paths = [os.path.join(output_dir, '%s_%03d.skp' % (name, page.index))
+             for page in self.pages]
+    pool = multiprocessing.pool.ThreadPool(
+        jobs or multiprocessing.cpu_count())
+    try:
+      pool.map(lambda i: self.write_page(i, paths[i]), range(len(paths)))
+    finally:
+      pool.close()
+      pool.join()
+    return paths
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      usage='python %(prog)s MSKP_FILE [OUTPUT_SKP | --split OUTPUT_DIR]')
+  parser.add_argument('mskp_file')
+  parser.add_argument('output_skp', nargs='?',
+                      help='write the first page here')
+  parser.add_argument('--split', metavar='OUTPUT_DIR',
+                      help='write every page to OUTPUT_DIR')
+  parser.add_argument('--jobs', type=int,
+                      help='number of pages to write at once')
+  parser.add_argument('--no-cache', action='store_true',
+                      help='do not read or write the cached page index')
+  args = parser.parse_args()
+
+  try:
+    doc = MSKP(args.mskp_file, cache_index=not args.no_cache)
+  except (IOError, MSKPError) as e:
+    sys.stderr.write('%s\n' % e)
+    return 2
+  with doc:
+    print('MSKP version: ', doc.version)
+    print('page count: ', len(doc))
+    try:
+      pages = doc.pages
+    except MSKPError as e:
+      sys.stderr.write('%s\n' % e)
+      return 3
+    for page in pages:
+      print('page %3d\toffset = %-7d\tlength = %-7d\tsize = (%r,%r)'
+            % (page.index, page.offset, page.length, page.width, page.height))
+    if args.output_skp and pages:
+      doc.write_page(0, args.output_skp)
+    if args.split:
+      for path in doc.split(args.split, args.jobs):
+        print(path)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Content-addressed cache for build actions that generate source files.
+
+An action is keyed by the contents of the tools it runs, the contents of its
+inputs and its arguments.  On a hit the outputs are restored from the cache
+without running any tool; on a miss the action generates its outputs into
+scratch files which are then published to the cache.  Either way an output is
+only rewritten if its contents changed, so ninja's restat can prune everything
+downstream of it.  Scratch files are written next to the real outputs under
+hidden names and removed once the action finishes.
+
+The cache lives in $SKIA_ACTION_CACHE_DIR, or in 'action_cache' under the
+current (build) directory.  Set SKIA_ACTION_CACHE_DIR to an empty string to
+disable caching; outputs are still only written when they change.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Bump this to invalidate every existing cache entry.
+CACHE_VERSION = '2'
+CACHE_DIR_ENV = 'SKIA_ACTION_CACHE_DIR'
+
+
+def cache_dir():
+    d = os.environ.get(CACHE_DIR_ENV)
+    if d is None:
+        return os.path.abspath('action_cache')
+    return d or None
+
+
+def _hash_file(h, path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+
+
+def action_key(tools, inputs, args):
+    """Return a hex digest identifying a run of |tools| over |inputs|."""
+    h = hashlib.sha1()
+    h.update(CACHE_VERSION.encode('utf-8'))
+    # The calling script is itself part of the tool chain.
+    for path in [sys.argv[0]] + list(tools) + list(inputs):
+        h.update(b'\0')
+        _hash_file(h, path)
+    for arg in args:
+        h.update(b'\0' + arg.encode('utf-8'))
+    return h.hexdigest()
+
+
+def write_if_changed(path, data):
+    """Write |data| to |path| unless it already holds exactly that.
+
+    Returns True if the file was written.
+    """
+    if os.path.isfile(path) and os.path.getsize(path) == len(data):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    with open(path, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def copy_if_changed(src, dst):
+    with open(src, 'rb') as f:
+        return write_if_changed(dst, f.read())
+
+
+def clang_format_style(path):
+    """Return the .clang-format that applies to |path|, or None.
+
+    Like clang-format, this looks in |path|'s directory and then each of its
+    parents.  Actions that run clang_format pass it as an input, so that a
+    change of style invalidates their cached outputs.
+    """
+    d = os.path.dirname(os.path.abspath(path))
+    while True:
+        for name in ('.clang-format', '_clang-format'):
+            style = os.path.join(d, name)
+            if os.path.isfile(style):
+                return style
+        parent = os.path.dirname(d)
+        if parent == d:
+            return None
+        d = parent
+
+
+def clang_format_styles(paths):
+    """Return the distinct .clang-format files that apply to |paths|."""
+    styles = set(clang_format_style(p) for p in paths)
+    return sorted(s for s in styles if s)
+
+
+def clang_format(clangFormat, paths, flags=()):
+    """Format |paths| in place with a single clang-format invocation."""
+    subprocess.check_output([clangFormat] + list(flags) + ['-i'] + list(paths))
+
+
+class Action(object):
+    """One cacheable run of |tools| over |inputs| producing |outputs|.
+
+    Outputs are generated into self.staged, which maps each output to a
+    scratch file in the same directory (so tools that look for config files
+    next to their input, like clang-format, behave as they would on the real
+    output), then commit() moves them into place and into the cache.
+    """
+
+    def __init__(self, tools, inputs, args, outputs):
+        self.outputs = list(outputs)
+        self.staged = dict((o, _staged_name(o)) for o in self.outputs)
+        self._entry = None
+        root = cache_dir()
+        if root:
+            key = action_key(tools, inputs, args)
+            self._entry = os.path.join(root, key[:2], key)
+
+    def _cached(self, i):
+        return os.path.join(self._entry, str(i))
+
+    def restore(self):
+        """Restore the outputs from the cache.  Returns False on a miss."""
+        if not self._entry:
+            return False
+        if not all(os.path.isfile(self._cached(i))
+                   for i in range(len(self.outputs))):
+            return False
+        for i, output in enumerate(self.outputs):
+            copy_if_changed(self._cached(i), output)
+        return True
+
+    def commit(self):
+        """Move the staged outputs into place and publish them to the cache."""
+        for output in self.outputs:
+            copy_if_changed(self.staged[output], output)
+        if self._entry and not os.path.isdir(self._entry):
+            scratch = tempfile.mkdtemp(dir=_ensure_dir(os.path.dirname(
+                self._entry)))
+            for i, output in enumerate(self.outputs):
+                shutil.copyfile(self.staged[output],
+                                os.path.join(scratch, str(i)))
+            try:
+                os.rename(scratch, self._entry)
+            except OSError:
+                # Another build published this entry first; keep theirs.
+                shutil.rmtree(scratch)
+        self.discard()
+
+    def discard(self):
+        """Remove any staged outputs."""
+        for staged in self.staged.values():
+            if os.path.exists(staged):
+                os.remove(staged)
+
+
+def _staged_name(output):
+    # Keep the extension; some tools (skslc, clang-format) look at it.
+    head, tail = os.path.split(output)
+    name, ext = os.path.splitext(tail)
+    return os.path.join(head, '.%s.%d.tmp%s' % (name, os.getpid(), ext))
+
+
+def run(tools, inputs, args, outputs, generate):
+    """Produce |outputs|, reusing a cached result if one exists.
+
+    On a miss, generate(staged) is called with a dict mapping each output path
+    to a scratch path that it must write instead.
+    """
+    action = Action(tools, inputs, args, outputs)
+    if action.restore():
+        return
+    try:
+        generate(action.staged)
+        action.commit()
+    finally:
+        action.discard()
+
+
+def _ensure_dir(d):
+    try:
+        os.makedirs(d)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return d
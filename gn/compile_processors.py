@@ -5,24 +5,69 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import action_cache
+import multiprocessing.pool
 import os
 import subprocess
 import sys
+import time
 
 skslc = sys.argv[1]
 clangFormat = sys.argv[2]
 processors = sys.argv[3:]
-for p in processors:
+
+
+def make_action(p):
     path, _ = os.path.splitext(p)
-    print("Recompiling " + p + "...")
+    outputs = [path + ".h", path + ".cpp"]
+    return action_cache.Action([skslc, clangFormat],
+                               [p] + action_cache.clang_format_styles(outputs),
+                               [], outputs)
+
+
+def restore(action):
+    return action.restore()
+
+
+def compile(job):
+    p, action = job
+    start = time.time()
     try:
-        subprocess.check_output([skslc, p, path + ".h"])
-        subprocess.check_call(clangFormat + " --sort-includes=false -i \"" +
-                              path + ".h\"", shell=True)
-        subprocess.check_output([skslc, p, path + ".cpp"])
-        subprocess.check_call(clangFormat + " --sort-includes=false -i \"" +
-                              path + ".cpp\"", shell=True)
+        for out in action.outputs:
+            subprocess.check_output([skslc, p, action.staged[out]],
+                                    stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as err:
-        print("### Error compiling " + p + ":")
-        print(err.output)
-        exit(1)
+        return err.output
+    print("Recompiled %s in %.2fs" % (p, time.time() - start))
+    return None
+
+
+# skslc and clang-format are separate processes, so threads are enough to keep
+# every core busy.
+pool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+actions = pool.map(make_action, processors)
+hits = pool.map(restore, actions)
+jobs = [(p, a) for p, a, hit in zip(processors, actions, hits) if not hit]
+try:
+    for (p, _), error in zip(jobs, pool.map(compile, jobs)):
+        if error is not None:
+            print("### Error compiling " + p + ":")
+            print(error)
+            exit(1)
+    if jobs:
+        start = time.time()
+        staged = [a.staged[out] for _, a in jobs for out in a.outputs]
+        try:
+            action_cache.clang_format(clangFormat, staged,
+                                      ["--sort-includes=false"])
+        except subprocess.CalledProcessError as err:
+            print("### Error formatting processors:")
+            print(err.output)
+            exit(1)
+        print("Formatted %d files in %.2fs" % (len(staged),
+                                               time.time() - start))
+        for _, action in jobs:
+            action.commit()
+finally:
+    for _, action in jobs:
+        action.discard()
@@ -5,16 +5,22 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-import os
-import subprocess
+import action_cache
 import sys
 
-src = open(sys.argv[1], 'r')
-dst = open(sys.argv[2], 'wb')
-dst.write('R"(')
-for line in src.readlines():
-    if not line.startswith("#"):
-        dst.write(line)
-dst.write(')"\n')
-src.close()
-dst.close()
+src = sys.argv[1]
+dst = sys.argv[2]
+
+
+def generate(staged):
+    with open(src, 'rb') as f:
+        lines = f.readlines()
+    with open(staged[dst], 'wb') as out:
+        out.write(b'R"(')
+        for line in lines:
+            if not line.startswith(b"#"):
+                out.write(line)
+        out.write(b')"\n')
+
+
+action_cache.run([], [src], [], [dst], generate)
@@ -5,46 +5,75 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import action_cache
+import argparse
+import fnmatch
 import os
 import sys
 
-# We'll recursively search each include directory for headers,
-# then write them to skia.h with a small blacklist.
+# We'll search each include directory for headers (recursively with
+# --recursive), then write them to skia.h with a small blacklist.
 
 # We'll also write skia.h.deps, which Ninja uses to track dependencies. It's the
 # very same mechanism Ninja uses to know which .h files affect which .cpp files.
 
-skia_h       = sys.argv[1]
-include_dirs = sys.argv[2:]
+# Outputs are only rewritten when the set of headers changes, so rerunning this
+# doesn't force a rebuild of everything that includes skia.h.
 
-blacklist = {
+blacklist = [
   "GrGLConfig_chrome.h",
   "SkFontMgr_fontconfig.h",
-}
+]
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--recursive', action='store_true',
+                    help='also search subdirectories of each include dir; '
+                         'their headers are included relative to it')
+parser.add_argument('--ignore', action='append', default=[],
+                    help='file or directory name pattern to skip')
+parser.add_argument('--pch',
+                    help='also write a variant of skia.h suitable for '
+                         'compiling into a precompiled header')
+parser.add_argument('skia_h')
+parser.add_argument('include_dirs', nargs='*')
+args = parser.parse_args()
+
+ignore = blacklist + args.ignore
+
+def ignored(name):
+  return any(fnmatch.fnmatch(name, pattern) for pattern in ignore)
+
+# (path, name to #include) pairs.
 headers = []
-for directory in include_dirs:
-  for f in os.listdir(directory):
-    if os.path.isfile(os.path.join(directory, f)):
-      if f.endswith('.h') and f not in blacklist:
-        headers.append(os.path.join(directory,f))
+for directory in args.include_dirs:
+  for root, dirs, files in os.walk(directory):
+    if args.recursive:
+      dirs[:] = [d for d in dirs if not ignored(d)]
+    else:
+      dirs[:] = []
+    for f in files:
+      if f.endswith('.h') and not ignored(f):
+        path = os.path.join(root, f)
+        name = os.path.relpath(path, directory).replace(os.sep, '/')
+        headers.append((path, name))
 headers.sort()
 
-with open(skia_h, "w") as f:
-  f.write('// skia.h generated by GN.\n')
-  f.write('#ifndef skia_h_DEFINED\n')
-  f.write('#define skia_h_DEFINED\n')
-  for h in headers:
-    f.write('#include "' + os.path.basename(h) + '"\n')
-  f.write('#endif//skia_h_DEFINED\n')
-
-with open(skia_h + '.deps', "w") as f:
-  f.write(skia_h + ':')
-  for h in headers:
-    f.write(' ' + h)
-  f.write('\n')
-
-# Temporary: during development this file wrote skia.h.d, not skia.h.deps,
-# and I think we have some bad versions of those files laying around.
-if os.path.exists(skia_h + '.d'):
-  os.remove(skia_h + '.d')
+def umbrella(path, pch=False):
+  lines = ['// %s generated by GN.' % os.path.basename(path)]
+  if pch:
+    # A precompiled header is only ever included once, up front.
+    lines.append('#pragma once')
+  else:
+    lines += ['#ifndef skia_h_DEFINED', '#define skia_h_DEFINED']
+  lines += ['#include "%s"' % name for _, name in headers]
+  if not pch:
+    lines.append('#endif//skia_h_DEFINED')
+  return ('\n'.join(lines) + '\n').encode('utf-8')
+
+action_cache.write_if_changed(args.skia_h, umbrella(args.skia_h))
+
+deps = args.skia_h + ':' + ''.join(' ' + path for path, _ in headers) + '\n'
+action_cache.write_if_changed(args.skia_h + '.deps', deps.encode('utf-8'))
+
+if args.pch:
+  action_cache.write_if_changed(args.pch, umbrella(args.pch, pch=True))
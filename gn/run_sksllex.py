@@ -5,29 +5,34 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-import os
+import action_cache
 import subprocess
 import sys
 
 sksllex = sys.argv[1]
 clangFormat = sys.argv[2]
 src = sys.argv[3]
+
+
+def lex(name, lexer, token):
+    lexFile = src + "/sksl/lex/" + name + ".lex"
+    outputs = [src + "/sksl/SkSL" + lexer + ".h",
+               src + "/sksl/SkSL" + lexer + ".cpp"]
+
+    def generate(staged):
+        subprocess.check_output([sksllex, lexFile, lexer, token] +
+                                [staged[out] for out in outputs])
+        action_cache.clang_format(clangFormat,
+                                  [staged[out] for out in outputs])
+
+    action_cache.run([sksllex, clangFormat],
+                     [lexFile] + action_cache.clang_format_styles(outputs),
+                     [lexer, token], outputs, generate)
+
+
 try:
-    subprocess.check_output([sksllex, src + "/sksl/lex/sksl.lex", "Lexer",
-                             "Token", src + "/sksl/SkSLLexer.h", src +
-                             "/sksl/SkSLLexer.cpp"])
-    subprocess.check_call(clangFormat + " -i \"" + src + "/sksl/SkSLLexer.h\"",
-                          shell=True)
-    subprocess.check_call(clangFormat + " -i \"" + src +
-                          "/sksl/SkSLLexer.cpp\"", shell=True)
-    subprocess.check_output([sksllex, src + "/sksl/lex/layout.lex",
-                             "LayoutLexer", "LayoutToken",
-                             src + "/sksl/SkSLLayoutLexer.h",
-                             src + "/sksl/SkSLLayoutLexer.cpp"])
-    subprocess.check_call(clangFormat + " -i \"" + src +
-                          "/sksl/SkSLLayoutLexer.h\"", shell=True)
-    subprocess.check_call(clangFormat + " -i \"" + src +
-                          "/sksl/SkSLLayoutLexer.cpp\"", shell=True)
+    lex("sksl", "Lexer", "Token")
+    lex("layout", "LayoutLexer", "LayoutToken")
 except subprocess.CalledProcessError as err:
     print("### Lexer error:")
     print(err.output)
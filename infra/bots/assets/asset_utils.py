@@ -10,12 +10,24 @@
 
 
 import argparse
+import collections
+import errno
+import hashlib
 import json
 import os
+import posixpath
 import shlex
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
+import uuid
+
+if sys.platform == 'win32':
+  import msvcrt
+else:
+  import fcntl
 
 INFRA_BOTS_DIR = os.path.abspath(os.path.realpath(os.path.join(
     os.path.dirname(os.path.abspath(__file__)), os.pardir)))
@@ -33,6 +45,9 @@ DEFAULT_CIPD_SERVICE_URL = 'https://chrome-infra-packages.appspot.com'
 DEFAULT_GS_BUCKET = 'skia-assets'
 GS_SUBDIR_TMPL = 'gs://%s/assets/%s'
 GS_PATH_TMPL = '%s/%s.zip'
+DELTA_SUBDIR_TMPL = '%s/delta'
+DELTA_MANIFEST_TMPL = '%s/%d.json'
+DELTA_BLOBS_SUBDIR_TMPL = '%s/blobs'
 
 TAG_PROJECT_SKIA = 'project:skia'
 TAG_VERSION_PREFIX = 'version:'
@@ -43,6 +58,21 @@ WHICH = 'where' if sys.platform.startswith('win') else 'which'
 VERSION_FILENAME = 'VERSION'
 ZIP_BLACKLIST = ['.git', '.svn', '*.pyc', '.DS_STORE']
 
+CACHE_DIR_ENV_VAR = 'SKIA_ASSET_CACHE_DIR'
+DEFAULT_CACHE_MAX_BYTES = 50 * 1024 * 1024 * 1024
+CACHE_GC_LOCK = 'gc.lock'
+
+# How AssetCache puts files into target directories.
+LINK_AUTO = 'auto'
+LINK_REFLINK = 'reflink'
+LINK_HARDLINK = 'hardlink'
+LINK_COPY = 'copy'
+
+# ioctl to clone a file on Linux, from linux/fs.h.
+FICLONE = 0x40049409
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 class CIPDStore(object):
   """Wrapper object for CIPD."""
@@ -158,10 +188,22 @@ class GSStore(object):
       self._gsutil = ['python', gsutil]
     self._gs_bucket = bucket
 
+  def asset_dir(self, name):
+    """Return the GS directory holding the given asset's versions."""
+    return GS_SUBDIR_TMPL % (self._gs_bucket, name)
+
   def copy(self, src, dst):
     """Copy src to dst."""
     subprocess.check_call(self._gsutil + ['cp', src, dst])
 
+  def copy_many(self, srcs, dst_dir):
+    """Copy each of srcs into dst_dir, several at a time."""
+    cmd = self._gsutil + ['-m', 'cp', '-I', dst_dir + '/']
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    proc.communicate(''.join(src + '\n' for src in srcs))
+    if proc.returncode != 0:
+      raise subprocess.CalledProcessError(proc.returncode, cmd)
+
   def list(self, path):
     """List objects in the given path."""
     try:
@@ -184,7 +226,8 @@ class GSStore(object):
     target_dir = os.path.abspath(target_dir)
     with utils.tmp_dir():
       zip_file = os.path.join(os.getcwd(), '%d.zip' % version)
-      zip_utils.zip(target_dir, zip_file, blacklist=ZIP_BLACKLIST)
+      zip_utils.zip(target_dir, zip_file, blacklist=ZIP_BLACKLIST,
+                    store=zip_utils.ALREADY_COMPRESSED)
       gs_path = GS_PATH_TMPL % (GS_SUBDIR_TMPL % (self._gs_bucket, name),
                                 str(version))
       self.copy(zip_file, gs_path)
@@ -211,12 +254,224 @@ class GSStore(object):
       subprocess.check_call(self._gsutil + ['rm', '-rf', gs_path])
 
 
+class _FileLock(object):
+  """Hold an advisory lock on the given file.
+
+  Locks belong to open files, so they exclude other threads of this process
+  as well as other processes. Shared locks are exclusive on Windows.
+  """
+  def __init__(self, path, shared=False):
+    self._path = path
+    self._shared = shared
+    self._file = None
+
+  def __enter__(self):
+    self._file = open(self._path, 'a+')
+    if sys.platform == 'win32':
+      self._file.seek(0)
+      while True:
+        try:
+          # Gives up with IOError after ten seconds.
+          msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+          break
+        except IOError:
+          pass
+    else:
+      fcntl.flock(self._file, fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, t, v, tb):
+    if sys.platform == 'win32':
+      self._file.seek(0)
+      msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+    # Closing the file releases an flock.
+    self._file.close()
+
+
+def _makedirs(d):
+  """Create the given directory, unless it already exists."""
+  try:
+    os.makedirs(d)
+  except OSError as e:
+    if e.errno != errno.EEXIST or not os.path.isdir(d):
+      raise
+
+
+def _hash_file(path):
+  """Return the SHA1 of the given file's contents."""
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def _reflink(src, dst):
+  """Make dst a copy-on-write clone of src. Raises IOError if unsupported."""
+  if not sys.platform.startswith('linux'):
+    raise IOError(errno.EOPNOTSUPP, 'reflinks are only supported on Linux')
+  with open(src, 'rb') as s:
+    with open(dst, 'wb') as d:
+      try:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+      except IOError:
+        os.remove(dst)
+        raise
+  shutil.copymode(src, dst)
+
+
+def _walk_manifest(target_dir, blacklist):
+  """Describe the directories and files in target_dir.
+
+  Returns a manifest dict, with 'dirs', a list of [path, mode], and 'files', a
+  list of [path, SHA1 of contents, mode, size], and a dict mapping each SHA1
+  to one of the files with those contents.
+  """
+  def rel(path):
+    return os.path.relpath(path, target_dir).replace(os.sep, posixpath.sep)
+
+  dirs = []
+  files = []
+  paths = {}
+  for r, d, f in os.walk(target_dir, topdown=True):
+    d[:] = zip_utils.filtered(d, blacklist)
+    for dirname in d:
+      path = os.path.join(r, dirname)
+      dirs.append([rel(path), stat.S_IMODE(os.stat(path).st_mode)])
+    for filename in zip_utils.filtered(f, blacklist):
+      path = os.path.join(r, filename)
+      st = os.stat(path)
+      sha1 = _hash_file(path)
+      files.append([rel(path), sha1, stat.S_IMODE(st.st_mode), st.st_size])
+      paths.setdefault(sha1, path)
+  return {'dirs': dirs, 'files': files}, paths
+
+
+class DeltaStore(object):
+  """Wrapper object which stores each file in GS once, for all versions.
+
+  Each version is a manifest listing its directories and files, along with
+  the SHA1 of each file's contents. The contents are uploaded as blobs named
+  for their SHA1 and shared by every version of the asset, so uploading a
+  version only uploads the files which changed since earlier ones, and
+  downloading it only fetches the blobs which aren't available locally.
+  """
+  def __init__(self, gs):
+    self._gs = gs
+
+  def _subdir(self, name):
+    return DELTA_SUBDIR_TMPL % self._gs.asset_dir(name)
+
+  def _blobs_dir(self, name):
+    return DELTA_BLOBS_SUBDIR_TMPL % self._subdir(name)
+
+  def get_available_versions(self, name):
+    """Return the existing version numbers for the asset."""
+    suffix = '.json'
+    bnames = [posixpath.basename(f.rstrip('/'))
+              for f in self._gs.list(self._subdir(name))]
+    versions = [int(f[:-len(suffix)]) for f in bnames if f.endswith(suffix)]
+    versions.sort()
+    return versions
+
+  def upload(self, name, version, target_dir):
+    """Upload the files which aren't in GS yet, then the manifest."""
+    manifest, paths = _walk_manifest(os.path.abspath(target_dir),
+                                     ZIP_BLACKLIST)
+    blobs_dir = self._blobs_dir(name)
+    existing = set(posixpath.basename(f.rstrip('/'))
+                   for f in self._gs.list(blobs_dir))
+    missing = sorted(set(paths) - existing)
+    sizes = dict((sha1, size) for _, sha1, _, size in manifest['files'])
+    print 'Uploading %d of %d files (%d of %d bytes).' % (
+        len(missing), len(paths), sum(sizes[sha1] for sha1 in missing),
+        sum(sizes.itervalues()))
+    with utils.tmp_dir():
+      if missing:
+        # Blobs are named for their contents.
+        os.mkdir('blobs')
+        srcs = []
+        for sha1 in missing:
+          src = os.path.join(os.getcwd(), 'blobs', sha1)
+          try:
+            os.link(paths[sha1], src)
+          except (AttributeError, OSError):
+            shutil.copyfile(paths[sha1], src)
+          srcs.append(src)
+        self._gs.copy_many(srcs, blobs_dir)
+      # The manifest goes last, so that the version doesn't exist until all
+      # of its blobs do.
+      manifest_file = os.path.join(os.getcwd(), '%d.json' % version)
+      with open(manifest_file, 'w') as f:
+        json.dump(manifest, f)
+      self._gs.copy(manifest_file,
+                    DELTA_MANIFEST_TMPL % (self._subdir(name), version))
+
+  def download(self, name, version, target_dir):
+    """Download from GS."""
+    self.download_reusing(name, version, target_dir, None)
+
+  def download_reusing(self, name, version, target_dir, find_blob):
+    """Download from GS, reusing local copies of blobs where possible.
+
+    find_blob(sha1), if given, returns the path of a local file with the
+    given SHA1, or None.
+    """
+    target_dir = os.path.abspath(target_dir)
+    with utils.tmp_dir():
+      manifest_file = os.path.join(os.getcwd(), 'manifest.json')
+      self._gs.copy(DELTA_MANIFEST_TMPL % (self._subdir(name), version),
+                    manifest_file)
+      with open(manifest_file) as f:
+        manifest = json.load(f)
+
+      blobs = {}
+      for _, sha1, _, _ in manifest['files']:
+        if sha1 not in blobs:
+          blobs[sha1] = find_blob(sha1) if find_blob else None
+      missing = sorted(sha1 for sha1, path in blobs.iteritems() if not path)
+      print 'Downloading %d of %d files.' % (len(missing), len(blobs))
+      if missing:
+        fetched = os.path.join(os.getcwd(), 'blobs')
+        os.mkdir(fetched)
+        self._gs.copy_many(
+            [posixpath.join(self._blobs_dir(name), sha1) for sha1 in missing],
+            fetched)
+        for sha1 in missing:
+          blobs[sha1] = os.path.join(fetched, sha1)
+          if _hash_file(blobs[sha1]) != sha1:
+            raise Exception('Downloaded blob %s is corrupt!' % sha1)
+
+      def native(path):
+        return path.replace(posixpath.sep, os.sep)
+      _makedirs(target_dir)
+      for path, _ in manifest['dirs']:
+        os.mkdir(os.path.join(target_dir, native(path)))
+      for path, sha1, mode, _ in manifest['files']:
+        dst = os.path.join(target_dir, native(path))
+        shutil.copyfile(blobs[sha1], dst)
+        os.chmod(dst, mode)
+      # Directory permissions last, in case they don't allow writing files.
+      for path, mode in reversed(manifest['dirs']):
+        os.chmod(os.path.join(target_dir, native(path)), mode)
+
+  def delete_contents(self, name):
+    """Delete data for the given asset."""
+    self._gs.delete_contents(name)
+
+
 class MultiStore(object):
-  """Wrapper object which uses CIPD as the primary store and GS for backup."""
+  """Wrapper object which uses CIPD as the primary store and GS for backup.
+
+  With delta=True, new versions also go to GS through a DeltaStore, and
+  versions are downloaded from it if they're there. The zip is still
+  uploaded, since downloads without delta=True only look for it.
+  """
   def __init__(self, cipd_url=DEFAULT_CIPD_SERVICE_URL,
-               gsutil=None, gs_bucket=DEFAULT_GS_BUCKET):
+               gsutil=None, gs_bucket=DEFAULT_GS_BUCKET, delta=False):
     self._cipd = CIPDStore(cipd_url=cipd_url)
     self._gs = GSStore(gsutil=gsutil, bucket=gs_bucket)
+    self._delta = DeltaStore(self._gs) if delta else None
 
   def get_available_versions(self, name):
     return self._cipd.get_available_versions(name)
@@ -224,15 +479,279 @@ class MultiStore(object):
   def upload(self, name, version, target_dir):
     self._cipd.upload(name, version, target_dir)
     self._gs.upload(name, version, target_dir)
+    if self._delta:
+      self._delta.upload(name, version, target_dir)
 
   def download(self, name, version, target_dir):
-    self._gs.download(name, version, target_dir)
+    self.download_reusing(name, version, target_dir, None)
+
+  def download_reusing(self, name, version, target_dir, find_blob):
+    if (self._delta and
+        version in self._delta.get_available_versions(name)):
+      self._delta.download_reusing(name, version, target_dir, find_blob)
+    else:
+      self._gs.download(name, version, target_dir)
 
   def delete_contents(self, name):
     self._cipd.delete_contents(name)
     self._gs.delete_contents(name)
 
 
+class AssetCache(object):
+  """Machine-wide cache of downloaded asset versions.
+
+  Each file is stored once per (contents, mode) under objects/, whichever
+  versions and assets contain it. Each cached version is a manifest under
+  versions/<name>/<version>.json listing its directories and files. Versions
+  are materialized into target directories by reflinking or hard-linking the
+  objects, falling back to copying them, and the least recently used versions
+  are forgotten once their objects add up to more than max_bytes.
+
+  Hard-linked files share their contents with the cache, so they must not be
+  modified in place. Use LINK_REFLINK or LINK_COPY if that's a problem.
+  """
+  def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_MAX_BYTES,
+               link=LINK_AUTO):
+    self._dir = os.path.abspath(cache_dir)
+    self._max_bytes = max_bytes
+    self._link = link
+    self._objects_dir = os.path.join(self._dir, 'objects')
+    self._versions_dir = os.path.join(self._dir, 'versions')
+    self._locks_dir = os.path.join(self._dir, 'locks')
+    self._tmp_dir = os.path.join(self._dir, 'tmp')
+    for d in (self._objects_dir, self._versions_dir, self._locks_dir,
+              self._tmp_dir):
+      _makedirs(d)
+    # Whether reflinks and hard links work here; None until we've tried.
+    self._can_reflink = None
+    self._can_hardlink = None
+
+  def _lock(self, name, shared=False):
+    return _FileLock(os.path.join(self._locks_dir, name), shared=shared)
+
+  def _manifest_path(self, name, version):
+    return os.path.join(self._versions_dir, name, '%s.json' % version)
+
+  def _object_path(self, key):
+    return os.path.join(self._objects_dir, key[:2], key)
+
+  def has_version(self, name, version):
+    """Return True iff the given version of the asset is in the cache."""
+    return os.path.isfile(self._manifest_path(name, version))
+
+  def find_object(self, sha1):
+    """Return the path of a cached file with the given SHA1, or None.
+
+    Only valid while the cache is locked against eviction, eg. from within
+    the fetch function passed to download.
+    """
+    d = os.path.dirname(self._object_path(sha1))
+    if os.path.isdir(d):
+      for f in os.listdir(d):
+        if f.startswith(sha1 + '-'):
+          return os.path.join(d, f)
+    return None
+
+  def download(self, name, version, target_dir, fetch):
+    """Materialize the given version of the asset into target_dir.
+
+    On a cache miss, fetch(dest_dir) is called to download the version into
+    dest_dir, which it should create. Only one process at a time fetches any
+    given version. Returns True iff the version was already cached.
+    """
+    with self._lock('%s-%s.lock' % (name, version)):
+      # Versions can't be evicted while we hold this.
+      with self._lock(CACHE_GC_LOCK, shared=True):
+        manifest = self._read_manifest(name, version)
+        hit = manifest is not None
+        if not hit:
+          manifest = self._add(name, version, fetch)
+        self._materialize(manifest, target_dir)
+    if not hit:
+      self.evict()
+    return hit
+
+  def _read_manifest(self, name, version):
+    path = self._manifest_path(name, version)
+    if not os.path.isfile(path):
+      return None
+    # The manifest's mtime is the version's last use.
+    os.utime(path, None)
+    with open(path) as f:
+      return json.load(f)
+
+  def _add(self, name, version, fetch):
+    """Fetch the given version and add it to the cache."""
+    tmp = tempfile.mkdtemp(dir=self._tmp_dir)
+    try:
+      download_dir = os.path.join(tmp, 'download')
+      fetch(download_dir)
+      manifest = self._ingest(download_dir)
+      tmp_manifest = os.path.join(tmp, 'manifest.json')
+      with open(tmp_manifest, 'w') as f:
+        json.dump(manifest, f)
+      path = self._manifest_path(name, version)
+      _makedirs(os.path.dirname(path))
+      os.rename(tmp_manifest, path)
+      return manifest
+    finally:
+      utils.RemoveDirectory(tmp)
+
+  def _ingest(self, src_dir):
+    """Move the files in src_dir into objects/; return their manifest."""
+    def rel(path):
+      return os.path.relpath(path, src_dir).replace(os.sep, posixpath.sep)
+
+    dirs = []
+    files = []
+    for r, ds, fs in os.walk(src_dir):
+      for d in ds:
+        path = os.path.join(r, d)
+        dirs.append([rel(path), stat.S_IMODE(os.stat(path).st_mode)])
+      for f in fs:
+        path = os.path.join(r, f)
+        st = os.stat(path)
+        key = '%s-%o' % (_hash_file(path), stat.S_IMODE(st.st_mode))
+        obj = self._object_path(key)
+        if not os.path.isfile(obj):
+          _makedirs(os.path.dirname(obj))
+          try:
+            os.rename(path, obj)
+          except OSError:
+            # Another process added the same object first (Windows).
+            if not os.path.isfile(obj):
+              raise
+        files.append([rel(path), key, st.st_size])
+    return {'dirs': dirs, 'files': files}
+
+  def _link_file(self, src, dst):
+    if self._link in (LINK_AUTO, LINK_REFLINK) and self._can_reflink is not False:
+      try:
+        _reflink(src, dst)
+        self._can_reflink = True
+        return
+      except IOError:
+        if self._link == LINK_REFLINK:
+          raise
+        self._can_reflink = False
+    if self._link in (LINK_AUTO, LINK_HARDLINK) and self._can_hardlink is not False:
+      try:
+        os.link(src, dst)
+        self._can_hardlink = True
+        return
+      except (AttributeError, OSError):
+        # No os.link on Windows; EXDEV across filesystems.
+        if self._link == LINK_HARDLINK:
+          raise
+        self._can_hardlink = False
+    shutil.copy(src, dst)
+
+  def _materialize(self, manifest, target_dir):
+    """Put the files listed in manifest into target_dir.
+
+    The files are assembled in a temporary directory next to target_dir, and
+    then renamed into place. If target_dir doesn't exist or is empty, it
+    appears complete or not at all.
+    """
+    def native(path):
+      return path.replace(posixpath.sep, os.sep)
+
+    target_dir = os.path.abspath(target_dir)
+    parent = os.path.dirname(target_dir)
+    _makedirs(parent)
+    tmp = os.path.join(parent, '.%s.%s' % (os.path.basename(target_dir),
+                                           uuid.uuid4()))
+    os.mkdir(tmp)
+    try:
+      for path, _ in manifest['dirs']:
+        os.mkdir(os.path.join(tmp, native(path)))
+      for path, key, _ in manifest['files']:
+        self._link_file(self._object_path(key),
+                        os.path.join(tmp, native(path)))
+      # Directory permissions last, in case they don't allow writing files.
+      for path, mode in reversed(manifest['dirs']):
+        os.chmod(os.path.join(tmp, native(path)), mode)
+
+      if os.path.isdir(target_dir) and not os.listdir(target_dir):
+        os.rmdir(target_dir)
+      if not os.path.exists(target_dir):
+        os.rename(tmp, target_dir)
+        return
+      for entry in os.listdir(tmp):
+        dst = os.path.join(target_dir, entry)
+        if os.path.exists(dst):
+          raise Exception('%s already exists!' % dst)
+        os.rename(os.path.join(tmp, entry), dst)
+    finally:
+      utils.RemoveDirectory(tmp)
+
+  def evict(self):
+    """Forget the least recently used versions until the cache fits.
+
+    The most recently used version is kept even if it doesn't fit by itself.
+    """
+    with self._lock(CACHE_GC_LOCK):
+      manifests = []
+      for r, _, fs in os.walk(self._versions_dir):
+        for f in fs:
+          path = os.path.join(r, f)
+          with open(path) as fp:
+            manifests.append((os.path.getmtime(path), path, json.load(fp)))
+      manifests.sort()
+
+      refs = collections.Counter()
+      sizes = {}
+      for _, _, manifest in manifests:
+        for _, key, size in manifest['files']:
+          refs[key] += 1
+          sizes[key] = size
+      total = sum(sizes.itervalues())
+      for _, path, manifest in manifests[:-1]:
+        if total <= self._max_bytes:
+          break
+        os.remove(path)
+        for _, key, _ in manifest['files']:
+          refs[key] -= 1
+          if refs[key] == 0:
+            total -= sizes[key]
+
+      # Nothing is being added while we hold the lock, so this also cleans up
+      # after interrupted downloads.
+      for r, _, fs in os.walk(self._objects_dir):
+        for f in fs:
+          if not refs[f]:
+            os.remove(os.path.join(r, f))
+      for d in os.listdir(self._tmp_dir):
+        utils.RemoveDirectory(self._tmp_dir, d)
+
+
+class CachingStore(object):
+  """Wrapper object which caches downloads from another store."""
+  def __init__(self, store, cache_dir, max_bytes=DEFAULT_CACHE_MAX_BYTES,
+               link=LINK_AUTO):
+    self._store = store
+    self._cache = AssetCache(cache_dir, max_bytes=max_bytes, link=link)
+
+  def get_available_versions(self, name):
+    return self._store.get_available_versions(name)
+
+  def upload(self, name, version, target_dir):
+    self._store.upload(name, version, target_dir)
+
+  def download(self, name, version, target_dir):
+    def fetch(dest_dir):
+      if hasattr(self._store, 'download_reusing'):
+        # Only fetch the files which aren't cached already.
+        self._store.download_reusing(name, version, dest_dir,
+                                     self._cache.find_object)
+      else:
+        self._store.download(name, version, dest_dir)
+    self._cache.download(name, version, target_dir, fetch)
+
+  def delete_contents(self, name):
+    self._store.delete_contents(name)
+
+
 def _prompt(prompt):
   """Prompt for input, return result."""
   return raw_input(prompt)
@@ -15,6 +15,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import unittest
 import uuid
 
@@ -74,6 +75,49 @@ class _LocalStore(object):
         raise
 
 
+class _CountingStore(_LocalStore):
+  """Local store which counts downloads."""
+  def __init__(self):
+    super(_CountingStore, self).__init__()
+    self.downloads = 0
+
+  def download(self, name, version, target_dir):
+    self.downloads += 1
+    super(_CountingStore, self).download(name, version, target_dir)
+
+
+class _LocalGS(object):
+  """Local stand-in for GSStore, for use with DeltaStore."""
+  def __init__(self):
+    self.dir = tempfile.mkdtemp()
+    self.copied = []
+
+  def asset_dir(self, name):
+    return os.path.join(self.dir, name)
+
+  def copy(self, src, dst):
+    if not os.path.isdir(os.path.dirname(dst)):
+      os.makedirs(os.path.dirname(dst))
+    shutil.copy(src, dst)
+    self.copied.append(os.path.basename(src))
+
+  def copy_many(self, srcs, dst_dir):
+    for src in srcs:
+      self.copy(src, os.path.join(dst_dir, os.path.basename(src)))
+
+  def list(self, path):
+    if not os.path.isdir(path):
+      return []
+    return [os.path.join(path, f) for f in os.listdir(path)]
+
+  def delete_contents(self, name):
+    try:
+      shutil.rmtree(self.dir)
+    except OSError:
+      if os.path.exists(self.dir):
+        raise
+
+
 class StoreTest(unittest.TestCase):
   """Superclass used for testing one of the stores."""
   def setUp(self):
@@ -127,6 +171,199 @@ class LocalStoreTest(StoreTest):
     self._test_versions(self._store)
 
 
+class CachingStoreTest(StoreTest):
+  """Test the caching store, backed by a local store."""
+  def setUp(self):
+    super(CachingStoreTest, self).setUp()
+    self._local = _CountingStore()
+    self._cache_dir = tempfile.mkdtemp()
+    self._store = asset_utils.CachingStore(self._local, self._cache_dir)
+
+  def tearDown(self):
+    self._store.delete_contents(self.asset_name)
+    utils.RemoveDirectory(self._cache_dir)
+    super(CachingStoreTest, self).tearDown()
+
+  def test_upload_download(self):
+    self._test_upload_download(self._store)
+
+  def test_versions(self):
+    self._test_versions(self._store)
+
+  def test_cache_hit(self):
+    with utils.tmp_dir():
+      input_dir = os.path.join(os.getcwd(), 'input')
+      _write_stuff(input_dir)
+      self._store.upload(self.asset_name, 0, input_dir)
+
+      # Only the first download uses the underlying store.
+      for link in (asset_utils.LINK_AUTO, asset_utils.LINK_HARDLINK,
+                   asset_utils.LINK_COPY):
+        store = asset_utils.CachingStore(self._local, self._cache_dir,
+                                         link=link)
+        output_dir = os.path.join(os.getcwd(), 'output_%s' % link)
+        store.download(self.asset_name, 0, output_dir)
+        test_utils.compare_trees(self, input_dir, output_dir)
+      self.assertEqual(self._local.downloads, 1)
+
+      # Hard links share the cached files; copies don't.
+      a = os.path.join('output_%s' % asset_utils.LINK_HARDLINK, 'a.txt')
+      b = os.path.join('output_%s' % asset_utils.LINK_COPY, 'a.txt')
+      self.assertGreater(os.stat(a).st_nlink, 1)
+      self.assertEqual(os.stat(b).st_nlink, 1)
+
+  def test_existing_target_dir(self):
+    with utils.tmp_dir():
+      input_dir = os.path.join(os.getcwd(), 'input')
+      _write_stuff(input_dir)
+      self._store.upload(self.asset_name, 0, input_dir)
+
+      # An empty target dir is replaced.
+      output_dir = os.path.join(os.getcwd(), 'output')
+      os.mkdir(output_dir)
+      self._store.download(self.asset_name, 0, output_dir)
+      test_utils.compare_trees(self, input_dir, output_dir)
+
+      # Otherwise the files are added to it, but not over existing ones.
+      output_dir = os.path.join(os.getcwd(), 'output2')
+      test_utils.FileWriter(output_dir).write('other.txt')
+      self._store.download(self.asset_name, 0, output_dir)
+      self.assertTrue(os.path.isfile(os.path.join(output_dir, 'other.txt')))
+      self.assertTrue(os.path.isfile(os.path.join(output_dir, 'a.txt')))
+      with self.assertRaises(Exception):
+        self._store.download(self.asset_name, 0, output_dir)
+
+  def test_eviction(self):
+    with utils.tmp_dir():
+      input_dir = os.path.join(os.getcwd(), 'input')
+      fw = test_utils.FileWriter(input_dir)
+      fw.write('shared.txt')
+      for version in xrange(3):
+        fw.write('v.txt')
+        self._store.upload(self.asset_name, version, input_dir)
+
+      # Each version has two 36-byte files, one of them shared, so there's
+      # only room for two versions.
+      cache = asset_utils.AssetCache(self._cache_dir, max_bytes=36 * 3)
+      fetch = lambda v: lambda d: self._local.download(self.asset_name, v, d)
+      for version in xrange(3):
+        cache.download(self.asset_name, version,
+                       os.path.join('output', str(version)), fetch(version))
+      self.assertFalse(cache.has_version(self.asset_name, 0))
+      self.assertTrue(cache.has_version(self.asset_name, 1))
+      self.assertTrue(cache.has_version(self.asset_name, 2))
+      objects = [f for _, _, fs in os.walk(os.path.join(self._cache_dir,
+                                                        'objects'))
+                 for f in fs]
+      self.assertEqual(len(objects), 3)
+
+      # Using version 1 makes version 2 the least recently used.
+      cache.download(self.asset_name, 1, 'output1b', fetch(1))
+      cache.download(self.asset_name, 0, 'output0b', fetch(0))
+      self.assertTrue(cache.has_version(self.asset_name, 0))
+      self.assertTrue(cache.has_version(self.asset_name, 1))
+      self.assertFalse(cache.has_version(self.asset_name, 2))
+      self.assertEqual(self._local.downloads, 4)
+      test_utils.compare_trees(self, os.path.join('output', '0'), 'output0b')
+
+  def test_concurrent_downloads(self):
+    with utils.tmp_dir():
+      input_dir = os.path.join(os.getcwd(), 'input')
+      _write_stuff(input_dir)
+      self._store.upload(self.asset_name, 0, input_dir)
+
+      errors = []
+      def download(i):
+        try:
+          store = asset_utils.CachingStore(self._local, self._cache_dir)
+          store.download(self.asset_name, 0,
+                         os.path.join(os.getcwd(), 'output%d' % i))
+        except Exception as e:  # pylint: disable=W0703
+          errors.append(e)
+      threads = [threading.Thread(target=download, args=(i,))
+                 for i in xrange(8)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+      self.assertEqual(errors, [])
+      self.assertEqual(self._local.downloads, 1)
+      for i in xrange(8):
+        test_utils.compare_trees(self, input_dir,
+                                 os.path.join(os.getcwd(), 'output%d' % i))
+
+
+class DeltaStoreTest(StoreTest):
+  """Test the delta store, backed by a local stand-in for GS."""
+  def setUp(self):
+    super(DeltaStoreTest, self).setUp()
+    self._gs = _LocalGS()
+    self._store = asset_utils.DeltaStore(self._gs)
+
+  def tearDown(self):
+    self._store.delete_contents(self.asset_name)
+    super(DeltaStoreTest, self).tearDown()
+
+  def test_upload_download(self):
+    self._test_upload_download(self._store)
+
+  def test_versions(self):
+    self._test_versions(self._store)
+
+  def test_deltas(self):
+    with utils.tmp_dir():
+      input_dir = os.path.join(os.getcwd(), 'input')
+      _write_stuff(input_dir)
+      fw = test_utils.FileWriter(input_dir)
+      self._store.upload(self.asset_name, 0, input_dir)
+      # Four blobs, then the manifest.
+      self.assertEqual(len(self._gs.copied), 5)
+
+      # Only the changed file is uploaded for the next version.
+      del self._gs.copied[:]
+      fw.write('b.txt', 0751)
+      self._store.upload(self.asset_name, 1, input_dir)
+      self.assertEqual(len(self._gs.copied), 2)
+
+      output_dir = os.path.join(os.getcwd(), 'output1')
+      self._store.download(self.asset_name, 1, output_dir)
+      test_utils.compare_trees(self, input_dir, output_dir)
+
+      # Blobs found locally aren't downloaded.
+      local = {}
+      for f in ('a.txt', 'c.txt', os.path.join('subdir', 'd.txt')):
+        path = os.path.join(output_dir, f)
+        local[asset_utils._hash_file(path)] = path
+      del self._gs.copied[:]
+      output_dir = os.path.join(os.getcwd(), 'output2')
+      self._store.download_reusing(self.asset_name, 1, output_dir, local.get)
+      test_utils.compare_trees(self, input_dir, output_dir)
+      # The manifest and b.txt.
+      self.assertEqual(len(self._gs.copied), 2)
+
+  def test_caching(self):
+    with utils.tmp_dir():
+      input_dir = os.path.join(os.getcwd(), 'input')
+      _write_stuff(input_dir)
+      fw = test_utils.FileWriter(input_dir)
+      self._store.upload(self.asset_name, 0, input_dir)
+      fw.write('a.txt', 0777)
+      self._store.upload(self.asset_name, 1, input_dir)
+
+      # With a cache, only files which aren't in any cached version are
+      # downloaded.
+      cache_dir = tempfile.mkdtemp()
+      try:
+        store = asset_utils.CachingStore(self._store, cache_dir)
+        store.download(self.asset_name, 0, 'output0')
+        del self._gs.copied[:]
+        store.download(self.asset_name, 1, 'output1')
+        test_utils.compare_trees(self, input_dir, 'output1')
+        self.assertEqual(len(self._gs.copied), 2)
+      finally:
+        utils.RemoveDirectory(cache_dir)
+
+
 # This test is disabled due to permissions issues with CIPD.
 #class CIPDStoreTest(StoreTest):
 #  """Test the CIPD store."""
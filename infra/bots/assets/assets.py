@@ -37,15 +37,19 @@ def remove(args):
 
 def download(args):
   """Download the current version of an asset."""
-  asset = asset_utils.Asset(args.asset_name,
-                            asset_utils.MultiStore(gsutil=args.gsutil))
+  store = asset_utils.MultiStore(gsutil=args.gsutil, delta=args.delta)
+  if args.cache_dir:
+    store = asset_utils.CachingStore(
+        store, args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+  asset = asset_utils.Asset(args.asset_name, store)
   asset.download_current_version(args.target_dir)
 
 
 def upload(args):
   """Upload a new version of the asset."""
-  asset = asset_utils.Asset(args.asset_name,
-                            asset_utils.MultiStore(gsutil=args.gsutil))
+  asset = asset_utils.Asset(
+      args.asset_name,
+      asset_utils.MultiStore(gsutil=args.gsutil, delta=args.delta))
   asset.upload_new_version(args.target_dir, commit=args.commit)
 
 
@@ -69,6 +73,18 @@ def main(argv):
   prs_download.add_argument('asset_name', help='Name of the asset.')
   prs_download.add_argument('--target_dir', '-t', required=True)
   prs_download.add_argument('--gsutil')
+  prs_download.add_argument(
+      '--cache_dir', default=os.environ.get(asset_utils.CACHE_DIR_ENV_VAR),
+      help='Machine-wide cache of downloaded versions. Defaults to $%s.' %
+           asset_utils.CACHE_DIR_ENV_VAR)
+  prs_download.add_argument(
+      '--cache_max_gb', type=float,
+      default=asset_utils.DEFAULT_CACHE_MAX_BYTES / 1024.0 ** 3,
+      help='Size past which least recently used versions are evicted.')
+  prs_download.add_argument(
+      '--delta', action='store_true',
+      help='Download only changed files, if the version was uploaded with '
+           '--delta.')
 
   prs_upload = subs.add_parser(
       'upload', help='Upload a new version of an asset.')
@@ -77,6 +93,10 @@ def main(argv):
   prs_upload.add_argument('--target_dir', '-t', required=True)
   prs_upload.add_argument('--gsutil')
   prs_upload.add_argument('--commit', action='store_true')
+  prs_upload.add_argument(
+      '--delta', action='store_true',
+      help='Also store the files which changed since previous versions, for '
+           'download --delta.')
 
   args = parser.parse_args(argv)
   args.func(args)
@@ -14,52 +14,81 @@ import common
 import subprocess
 import os
 import shutil
+import sys
+import tempfile
 
 
 SVG_TOOLS = os.path.join(common.INFRA_BOTS_DIR, os.pardir, os.pardir, 'tools',
                          'svg')
 SVG_GS_BUCKET = 'gs://skia-svgs'
 
+sys.path.insert(0, SVG_TOOLS)
+import svg_downloader
 
-def create_asset(target_dir):
-  """Create the asset."""
+
+def create_asset(target_dir, manifest_path=None):
+  """Create the asset.
+
+  The download manifest is kept at manifest_path, or in a temporary directory
+  if that isn't given, but never in target_dir, so that it isn't uploaded.
+  Unchanged SVGs are only skipped when the same target_dir and manifest_path
+  are used again; otherwise every SVG is downloaded.
+  """
   target_dir = os.path.realpath(target_dir)
 
   if not os.path.exists(target_dir):
     os.makedirs(target_dir)
 
-  # Download the SVGs specified in tools/svg/svgs.txt
-  download_svgs_cmd = [
-    'python', os.path.join(SVG_TOOLS, 'svg_downloader.py'),
-    '--output_dir', target_dir,
-    '--svgs_file', os.path.join(SVG_TOOLS, 'svgs.txt'),
-  ]
-  subprocess.check_call(download_svgs_cmd)
-
-  # Download the SVGs specified in tools/svg/svgs_parse_only.txt with a prefix.
-  download_svgs_parse_only_cmd = [
-    'python', os.path.join(SVG_TOOLS, 'svg_downloader.py'),
-    '--output_dir', target_dir,
-    '--svgs_file', os.path.join(SVG_TOOLS, 'svgs_parse_only.txt'),
-    '--prefix', 'svgparse_',
-  ]
-  subprocess.check_call(download_svgs_parse_only_cmd)
-
-  # Download SVGs from Google storage.
+  # Download SVGs from Google storage, in the background.
   # The Google storage bucket will either contain private SVGs or SVGs which we
   # cannot download over the internet using svg_downloader.py.
+  gsutil_cmd = ['gsutil', '-m', 'cp']
   for skbug in ['skbug4713', 'skbug6918']:
-    subprocess.check_call([
-        'gsutil', '-m', 'cp', os.path.join(SVG_GS_BUCKET, skbug, '*'),
-        target_dir
-    ])
+    gsutil_cmd.append(os.path.join(SVG_GS_BUCKET, skbug, '*'))
+  gsutil_cmd.append(target_dir)
+  gsutil = subprocess.Popen(gsutil_cmd)
+  try:
+    # Meanwhile, download the SVGs specified in tools/svg/svgs.txt, and those
+    # in tools/svg/svgs_parse_only.txt with a prefix.
+    urls = (
+        svg_downloader.readURLs(os.path.join(SVG_TOOLS, 'svgs.txt')) +
+        svg_downloader.readURLs(os.path.join(SVG_TOOLS, 'svgs_parse_only.txt'),
+                                prefix='svgparse_'))
+    manifest_dir = None
+    if not manifest_path:
+      manifest_dir = tempfile.mkdtemp()
+      manifest_path = os.path.join(manifest_dir,
+                                   svg_downloader.MANIFEST_FILENAME)
+    try:
+      failed = svg_downloader.downloadURLs(urls, target_dir,
+                                           manifest_path=manifest_path)
+    finally:
+      if manifest_dir:
+        shutil.rmtree(manifest_dir)
+    gsutil.wait()
+  finally:
+    if gsutil.poll() is None:
+      # Something above raised; don't leave gsutil copying into target_dir.
+      gsutil.terminate()
+      gsutil.wait()
+
+  if gsutil.returncode != 0:
+    raise subprocess.CalledProcessError(gsutil.returncode, gsutil_cmd)
+  # Don't upload what earlier, interrupted runs left behind.
+  svg_downloader.removePartialDownloads(target_dir)
+  if failed:
+    raise Exception('Failed to download some SVGs.')
 
 
 def main():
   parser = argparse.ArgumentParser()
   parser.add_argument('--target_dir', '-t', required=True)
+  parser.add_argument(
+      '--manifest_path',
+      help='Where to keep the SVG download manifest, outside the target dir, '
+           'so that unchanged SVGs aren\'t downloaded again.')
   args = parser.parse_args()
-  create_asset(args.target_dir)
+  create_asset(args.target_dir, args.manifest_path)
 
 
 if __name__ == '__main__':
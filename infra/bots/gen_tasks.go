@@ -134,6 +134,12 @@ var (
 			Path: "cache/work",
 		},
 	}
+	CACHES_DM_IMAGE_DIGESTS = []*specs.Cache{
+		&specs.Cache{
+			Name: "dm_image_digests",
+			Path: "cache/dm_image_digests",
+		},
+	}
 
 	// TODO(borenet): Roll these versions automatically!
 	CIPD_PKGS_PYTHON = []*specs.CipdPackage{
@@ -1018,6 +1024,7 @@ func test(b *specs.TasksCfgBuilder, name string, parts map[string]string, compil
 		}
 		uploadTask := kitchenTask(name, "upload_dm_results", "swarm_recipe.isolate", SERVICE_ACCOUNT_UPLOAD_GM, linuxGceDimensions(MACHINE_TYPE_SMALL), extraProps, OUTPUT_NONE)
 		uploadTask.CipdPackages = append(uploadTask.CipdPackages, CIPD_PKGS_GSUTIL...)
+		uploadTask.Caches = append(uploadTask.Caches, CACHES_DM_IMAGE_DIGESTS...)
 		uploadTask.Dependencies = append(uploadTask.Dependencies, name)
 		b.MustAddTask(uploadName, uploadTask)
 		return uploadName
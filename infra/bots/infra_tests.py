@@ -9,6 +9,7 @@
 """Run all infrastructure-related tests."""
 
 
+import glob
 import os
 import subprocess
 import sys
@@ -28,9 +29,16 @@ def test(cmd, cwd):
 def python_unit_tests(train):
   if train:
     return None
-  return test(
-      ['python', '-m', 'unittest', 'discover', '-s', '.', '-p', '*_test.py'],
-      INFRA_BOTS_DIR)
+  # Recipe module resources aren't packages, so discover doesn't find them.
+  errs = []
+  for d in [INFRA_BOTS_DIR] + glob.glob(
+      os.path.join(INFRA_BOTS_DIR, 'recipe_modules', '*', 'resources')):
+    err = test(
+        ['python', '-m', 'unittest', 'discover', '-s', '.', '-p', '*_test.py'],
+        d)
+    if err:
+      errs.append(err)
+  return '\n'.join(errs) or None
 
 
 def recipe_test(train):
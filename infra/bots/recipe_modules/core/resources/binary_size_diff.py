@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Compare two binary size trees symbol by symbol.
+
+The trees are those written by run_binary_size_analysis.py (--dest), or built
+in-process by its MakeCompactTree.  Every symbol is keyed by its source path,
+symbol type and name and classified as added, removed, grown, shrunk or
+unchanged.  Deltas are then rolled up into files and directories.  The symbol
+deltas always sum to exactly the difference between the two trees' totals.
+
+Usage:
+
+    binary_size_diff.py old.json new.json [--dest diff.json] [--top N]
+"""
+
+
+import argparse
+import collections
+import json
+import sys
+
+
+# Must match run_binary_size_analysis.py.
+NODE_TYPE_KEY = 'k'
+NODE_NAME_KEY = 'n'
+NODE_CHILDREN_KEY = 'children'
+NODE_SYMBOL_TYPE_KEY = 't'
+NODE_SYMBOL_SIZE_KEY = 'value'
+NAME_NO_PATH_BUCKET = '(No Path)'
+
+ADDED = 'added'
+REMOVED = 'removed'
+GROWN = 'grown'
+SHRUNK = 'shrunk'
+UNCHANGED = 'unchanged'
+STATUSES = (ADDED, REMOVED, GROWN, SHRUNK, UNCHANGED)
+
+
+def _Children(node):
+  children = node.get(NODE_CHILDREN_KEY) or []
+  if isinstance(children, dict):
+    # A tree that hasn't been through MakeChildrenDictsIntoLists yet.
+    children = children.values()
+  return children
+
+
+def FlattenTree(tree_root):
+  """Returns a dict mapping (path, symbol type, name) to size.
+
+  Symbols without a path all go under NAME_NO_PATH_BUCKET, whichever
+  subgroup SplitNoPathBucket put them in, since subgroups aren't stable from
+  one binary to the next.
+  """
+  symbols = collections.defaultdict(int)
+  stack = [(tree_root, [])]
+  while stack:
+    node, path = stack.pop()
+    for child in _Children(node):
+      kind = child.get(NODE_TYPE_KEY)
+      if kind == 's':
+        if path and path[0] == NAME_NO_PATH_BUCKET:
+          file_path = NAME_NO_PATH_BUCKET
+        else:
+          file_path = '/'.join(path)
+        key = (file_path, child[NODE_SYMBOL_TYPE_KEY], child[NODE_NAME_KEY])
+        symbols[key] += child[NODE_SYMBOL_SIZE_KEY]
+      elif kind == 'b':
+        stack.append((child, path))
+      else:
+        stack.append((child, path + [child[NODE_NAME_KEY]]))
+  return dict(symbols)
+
+
+def LoadTree(path):
+  """Returns the tree in a JSON file written by run_binary_size_analysis."""
+  with open(path) as f:
+    data = json.load(f)
+  return data.get('tree_data', data)
+
+
+def _Status(old_size, new_size):
+  if old_size is None:
+    return ADDED
+  if new_size is None:
+    return REMOVED
+  if new_size > old_size:
+    return GROWN
+  if new_size < old_size:
+    return SHRUNK
+  return UNCHANGED
+
+
+def _Directories(path):
+  """Yields every directory containing |path|, outermost first."""
+  parts = path.split('/')
+  for i in range(1, len(parts)):
+    yield '/'.join(parts[:i])
+
+
+def _Rollup(entries, key_fn):
+  rollup = {}
+  for entry in entries:
+    for key in key_fn(entry):
+      r = rollup.get(key)
+      if r is None:
+        r = rollup[key] = {'path': key, 'old_size': 0, 'new_size': 0,
+                           'delta': 0}
+        for status in STATUSES:
+          r[status] = 0
+      r['old_size'] += entry['old_size'] or 0
+      r['new_size'] += entry['new_size'] or 0
+      r['delta'] += entry['delta']
+      r[entry['status']] += 1
+  for r in rollup.itervalues():
+    # A file or directory is only added (removed) if all of its symbols are.
+    count = sum(r[s] for s in STATUSES)
+    r['status'] = _Status(None if r[ADDED] == count else r['old_size'],
+                          None if r[REMOVED] == count else r['new_size'])
+  return _Sorted(rollup.values())
+
+
+def _Sorted(entries):
+  # Biggest changes first; ties broken by name so reports are stable.
+  return sorted(entries, key=lambda e: (-abs(e['delta']), e['path'],
+                                        e.get('name', '')))
+
+
+def DiffSymbols(old_symbols, new_symbols):
+  """Diffs two dicts as returned by FlattenTree.
+
+  Returns a report dict with:
+    old_total, new_total, delta:  overall sizes.
+    summary:      for each status, the number of symbols and their net delta.
+    symbols:      changed symbols, biggest change first.
+    files:        per-file rollups of the symbol deltas.
+    directories:  per-directory rollups, for every directory level.
+  """
+  symbols = []
+  summary = dict((s, {'count': 0, 'delta': 0}) for s in STATUSES)
+  for key in set(old_symbols) | set(new_symbols):
+    old_size = old_symbols.get(key)
+    new_size = new_symbols.get(key)
+    status = _Status(old_size, new_size)
+    delta = (new_size or 0) - (old_size or 0)
+    summary[status]['count'] += 1
+    summary[status]['delta'] += delta
+    path, sym_type, name = key
+    symbols.append({'path': path, 'type': sym_type, 'name': name,
+                    'old_size': old_size, 'new_size': new_size,
+                    'delta': delta, 'status': status})
+
+  old_total = sum(old_symbols.itervalues())
+  new_total = sum(new_symbols.itervalues())
+  delta = sum(s['delta'] for s in symbols)
+  assert delta == new_total - old_total, (
+      'symbol deltas (%d) do not add up to the total delta (%d)' %
+      (delta, new_total - old_total))
+
+  return {
+    'old_total': old_total,
+    'new_total': new_total,
+    'delta': delta,
+    'summary': summary,
+    'symbols': _Sorted(s for s in symbols if s['status'] != UNCHANGED),
+    'files': [f for f in _Rollup(symbols, lambda s: [s['path']])
+              if f['delta'] or f[ADDED] or f[REMOVED]],
+    'directories': [d for d in _Rollup(symbols,
+                                       lambda s: _Directories(s['path']))
+                    if d['delta']],
+  }
+
+
+def DiffTrees(old_tree, new_tree):
+  """Diffs two trees as built by MakeCompactTree. See DiffSymbols."""
+  return DiffSymbols(FlattenTree(old_tree), FlattenTree(new_tree))
+
+
+def _FormatDelta(delta):
+  return '%+d' % delta
+
+
+def PrintReport(report, top=20, out=sys.stdout):
+  """Writes a human-readable summary of |report| to |out|."""
+  out.write('Total: %d -> %d bytes (%s)\n' % (
+      report['old_total'], report['new_total'],
+      _FormatDelta(report['delta'])))
+  for status in (ADDED, REMOVED, GROWN, SHRUNK):
+    s = report['summary'][status]
+    out.write('  %-8s %6d symbols, %s bytes\n' % (
+        status + ':', s['count'], _FormatDelta(s['delta'])))
+
+  for title, entries, describe in (
+      ('directories', report['directories'], lambda e: e['path']),
+      ('files', report['files'], lambda e: e['path']),
+      ('symbols', report['symbols'],
+       lambda e: '%s [%s] %s' % (e['path'], e['type'], e['name']))):
+    if not entries:
+      continue
+    out.write('\nTop %d %s by size change:\n' % (min(top, len(entries)), title))
+    for e in entries[:top]:
+      out.write('  %10s  %-8s %s\n' % (_FormatDelta(e['delta']), e['status'],
+                                       describe(e)))
+
+
+def WriteReport(report, dest):
+  with open(dest, 'w') as out:
+    json.dump(report, out, separators=(',', ':'), sort_keys=True)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('old', help='tree JSON for the old binary')
+  parser.add_argument('new', help='tree JSON for the new binary')
+  parser.add_argument('--dest', help='write the full report here as JSON')
+  parser.add_argument('--top', type=int, default=20,
+                      help='number of entries of each kind to print')
+  args = parser.parse_args()
+
+  report = DiffTrees(LoadTree(args.old), LoadTree(args.new))
+  PrintReport(report, args.top)
+  if args.dest:
+    WriteReport(report, args.dest)
+
+
+if __name__ == '__main__':
+  main()
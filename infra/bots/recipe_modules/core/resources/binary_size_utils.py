@@ -7,6 +7,7 @@
 Copied from chromium/src/build/android/pylib/symbols/binary_size_tools.py.
 """
 
+import array
 import logging
 import re
 
@@ -65,3 +66,57 @@ def ParseNm(nm_lines):
     # If we reach this part of the loop, there was something in the
     # line that we didn't expect or recognize.
     logging.warning('nm output parser failed to parse: %s', repr(line))
+
+
+class SymbolTable(object):
+  """A compact, append-only list of (name, type, size, path) symbols.
+
+  Symbols are stored column-wise rather than as one tuple per symbol, and
+  each distinct path is only stored once, which keeps the memory used by
+  large binaries' symbol lists down.  Iterating yields the same tuples that
+  ParseNm does.
+  """
+  __slots__ = ('_names', '_types', '_sizes', '_path_ids', '_paths',
+               '_path_index')
+
+  def __init__(self, symbols=()):
+    self._names = []
+    self._types = bytearray()
+    self._sizes = array.array('l')
+    self._path_ids = array.array('i')
+    self._paths = []
+    self._path_index = {}
+    self.extend(symbols)
+
+  def append(self, symbol):
+    name, sym_type, size, path = symbol
+    if path is None:
+      path_id = -1
+    else:
+      path_id = self._path_index.get(path)
+      if path_id is None:
+        path_id = self._path_index[path] = len(self._paths)
+        self._paths.append(path)
+    self._names.append(name)
+    self._types.append(ord(sym_type))
+    self._sizes.append(size)
+    self._path_ids.append(path_id)
+
+  def extend(self, symbols):
+    for symbol in symbols:
+      self.append(symbol)
+
+  def __len__(self):
+    return len(self._names)
+
+  def __iter__(self):
+    paths = self._paths
+    for i, name in enumerate(self._names):
+      path_id = self._path_ids[i]
+      yield (name, chr(self._types[i]), self._sizes[i],
+             paths[path_id] if path_id >= 0 else None)
+
+  @classmethod
+  def FromNm(cls, nm_lines):
+    """Returns a SymbolTable of the symbols ParseNm finds in |nm_lines|."""
+    return cls(ParseNm(nm_lines))
@@ -0,0 +1,609 @@
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""In-process source line lookups from the DWARF line tables of an ELF file.
+
+The .debug_line section is decoded once into a sorted, array-backed index of
+address ranges, which then answers lookups by binary search. This replaces a
+pool of addr2line processes for tools which only need the source file and line
+of large numbers of addresses (e.g. binary size analysis).
+
+Like elf_symbolizer.py, this module has no dependencies on other modules in
+this project.
+"""
+
+import array
+import bisect
+import mmap
+import posixpath
+import struct
+import zlib
+
+
+# ELF constants.
+ET_REL = 1
+SHT_NOBITS = 8
+SHF_COMPRESSED = 0x800
+ELFCOMPRESS_ZLIB = 1
+
+# DWARF constants.
+DW_LNS_copy = 1
+DW_LNS_advance_pc = 2
+DW_LNS_advance_line = 3
+DW_LNS_set_file = 4
+DW_LNS_const_add_pc = 8
+DW_LNS_fixed_advance_pc = 9
+DW_LNE_end_sequence = 1
+DW_LNE_set_address = 2
+DW_LNE_define_file = 3
+DW_LNCT_path = 1
+DW_LNCT_directory_index = 2
+DW_AT_name = 0x03
+DW_AT_stmt_list = 0x10
+DW_AT_comp_dir = 0x1b
+DW_AT_str_offsets_base = 0x72
+DW_FORM_implicit_const = 0x21
+DW_FORM_indirect = 0x16
+
+# Sizes of fixed-size DWARF forms. 'offset' and 'address' depend on the unit.
+_FIXED_FORM_SIZES = {
+  0x05: 2, 0x06: 4, 0x07: 8, 0x0b: 1, 0x0c: 1, 0x11: 1, 0x12: 2, 0x13: 4,
+  0x14: 8, 0x19: 0, 0x1c: 4, 0x1e: 16, 0x20: 8, 0x21: 0, 0x24: 8, 0x25: 1,
+  0x26: 2, 0x27: 3, 0x28: 4, 0x29: 1, 0x2a: 2, 0x2b: 3, 0x2c: 4,
+}
+_OFFSET_FORMS = frozenset([0x0e, 0x17, 0x1d, 0x1f, 0x1f20, 0x1f21])
+_ULEB_FORMS = frozenset([0x0f, 0x15, 0x1a, 0x1b, 0x22, 0x23, 0x1f01, 0x1f02])
+_BLOCK_FORMS = {0x03: 2, 0x04: 4, 0x09: None, 0x0a: 1, 0x18: None}
+_STRX_FORMS = frozenset([0x1a, 0x25, 0x26, 0x27, 0x28])
+
+# Addresses are stored in the widest unsigned array type available; Python 2
+# has no 'Q'.
+_ADDRESS_TYPECODE = 'L' if array.array('L').itemsize >= 8 else 'd'
+
+# File id of the row which terminates a sequence.
+_NO_FILE = -1
+
+
+def _Str(data):
+  """Converts raw bytes from the file to a native string."""
+  data = bytes(data)
+  if str is bytes:
+    return data
+  return data.decode('utf-8', 'replace')
+
+
+def _ReadULEB(data, pos):
+  result = 0
+  shift = 0
+  while True:
+    b = data[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if b < 0x80:
+      return result, pos
+    shift += 7
+
+
+def _ReadSLEB(data, pos):
+  result = 0
+  shift = 0
+  while True:
+    b = data[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    shift += 7
+    if b < 0x80:
+      if b & 0x40:
+        result -= 1 << shift
+      return result, pos
+
+
+def _ReadCString(data, pos):
+  end = data.find(b'\0', pos)
+  return _Str(data[pos:end]), end + 1
+
+
+class ElfFile(object):
+  """Memory-mapped, read-only access to the sections of an ELF file."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    ident = bytearray(self._map[:16])
+    if ident[:4] != bytearray(b'\x7fELF'):
+      raise ValueError('%s is not an ELF file.' % path)
+    self.is_64 = ident[4] == 2
+    self.endian = '<' if ident[5] == 1 else '>'
+    e = self.endian
+    self.type, = struct.unpack_from(e + 'H', self._map, 16)
+    if self.is_64:
+      shoff, = struct.unpack_from(e + 'Q', self._map, 0x28)
+      shentsize, shnum, shstrndx = struct.unpack_from(e + 'HHH', self._map,
+                                                      0x3a)
+      section_format = e + 'IIQQQQIIQQ'
+    else:
+      shoff, = struct.unpack_from(e + 'I', self._map, 0x20)
+      shentsize, shnum, shstrndx = struct.unpack_from(e + 'HHH', self._map,
+                                                      0x2e)
+      section_format = e + 'IIIIIIIIII'
+
+    def ReadSectionHeader(index):
+      return struct.unpack_from(section_format, self._map,
+                                shoff + index * shentsize)
+
+    # (name, type, flags, addr, offset, size, ...) by section name.
+    self._sections = {}
+    if not shoff:
+      return
+    first = ReadSectionHeader(0)
+    if shnum == 0:
+      shnum = first[5]  # Too many sections; the real count is in sh_size.
+    if shstrndx == 0xffff:
+      shstrndx = first[6]  # Likewise, in sh_link.
+    headers = [ReadSectionHeader(i) for i in range(shnum)]
+    names_offset = headers[shstrndx][4]
+    for header in headers:
+      name, _ = _ReadCString(self._map, names_offset + header[0])
+      self._sections.setdefault(name, header)
+
+  def HasSection(self, name):
+    return name in self._sections or self._ZName(name) in self._sections
+
+  @staticmethod
+  def _ZName(name):
+    return '.z' + name[1:]
+
+  def SectionData(self, name):
+    """Returns the (decompressed) contents of a section as a bytearray.
+
+    Returns None if there is no such section.
+    """
+    header = self._sections.get(name)
+    if header is None:
+      header = self._sections.get(self._ZName(name))
+      if header is None:
+        return None
+      # Old-style GNU compression: 'ZLIB', a big-endian size, then the data.
+      offset, size = header[4], header[5]
+      return bytearray(zlib.decompress(self._map[offset + 12:offset + size]))
+    sh_type, sh_flags, offset, size = header[1], header[2], header[4], header[5]
+    if sh_type == SHT_NOBITS:
+      return None
+    if not sh_flags & SHF_COMPRESSED:
+      return bytearray(self._map[offset:offset + size])
+    # The compression header starts with its type; the rest is only sizes.
+    ch_type, = struct.unpack_from(self.endian + 'I', self._map, offset)
+    header_size = 24 if self.is_64 else 12
+    if ch_type != ELFCOMPRESS_ZLIB:
+      raise ValueError('Unsupported compression type %d for %s in %s.' %
+                       (ch_type, name, self.path))
+    return bytearray(zlib.decompress(
+        self._map[offset + header_size:offset + size]))
+
+  def BuildId(self):
+    """Returns the GNU build ID as a hex string, or None if there is none."""
+    note = self.SectionData('.note.gnu.build-id')
+    if note is None or len(note) < 16:
+      return None
+    name_size, desc_size, _ = struct.unpack_from(self.endian + 'III', note, 0)
+    desc = 12 + (name_size + 3) // 4 * 4
+    return ''.join('%02x' % b for b in note[desc:desc + desc_size])
+
+  def Close(self):
+    self._map.close()
+
+
+class _Reader(object):
+  """Reads fixed-size integers of one ELF file's endianness."""
+
+  def __init__(self, data, endian):
+    self.data = data
+    self._endian = endian
+
+  def Unsigned(self, pos, size):
+    if size == 1:
+      return self.data[pos]
+    if size == 3:
+      b = self.data[pos:pos + 3]
+      if self._endian == '<':
+        return b[0] | b[1] << 8 | b[2] << 16
+      return b[2] | b[1] << 8 | b[0] << 16
+    return struct.unpack_from(self._endian + {2: 'H', 4: 'I', 8: 'Q'}[size],
+                              self.data, pos)[0]
+
+  def UnitLength(self, pos):
+    """Reads an initial length field; returns (length, offset size, pos)."""
+    length = self.Unsigned(pos, 4)
+    if length == 0xffffffff:
+      return self.Unsigned(pos + 4, 8), 8, pos + 12
+    return length, 4, pos + 4
+
+
+class LineTable(object):
+  """A sorted index of the address ranges in an ELF file's line tables.
+
+  Rows are stored as three parallel arrays (address, file id, line); file
+  paths are interned in a single list.
+  """
+
+  def __init__(self, elf_file_path):
+    elf = ElfFile(elf_file_path)
+    try:
+      if elf.type == ET_REL:
+        raise ValueError('%s is a relocatable object; link it first.' %
+                         elf_file_path)
+      self._endian = elf.endian
+      self._paths = []
+      self._path_ids = {}
+      try:
+        line_data = elf.SectionData('.debug_line')
+        if line_data is None:
+          raise ValueError('%s has no .debug_line section.' % elf_file_path)
+        self._line_str = elf.SectionData('.debug_line_str')
+        self._str = elf.SectionData('.debug_str')
+        comp_dirs = self._ReadCompDirs(elf)
+        sequences = self._ReadSequences(_Reader(line_data, elf.endian),
+                                        comp_dirs)
+      except (IndexError, KeyError, ZeroDivisionError, struct.error,
+              zlib.error) as e:
+        # Reads past the end of a section, or unknown forms and opcodes.
+        raise ValueError('%s has truncated or corrupt debug info: %s' %
+                         (elf_file_path, e))
+    finally:
+      elf.Close()
+
+    # Sequences are sorted by start address and concatenated; each ends with a
+    # _NO_FILE row marking the end of its range.
+    sequences.sort(key=lambda s: s[0][0])
+    self._addrs = array.array(_ADDRESS_TYPECODE)
+    self._files = array.array('i')
+    self._lines = array.array('i')
+    for addrs, files, lines in sequences:
+      self._addrs.extend(addrs)
+      self._files.extend(files)
+      self._lines.extend(lines)
+
+  def __len__(self):
+    return len(self._addrs)
+
+  def _InternPath(self, path):
+    path_id = self._path_ids.get(path)
+    if path_id is None:
+      path_id = len(self._paths)
+      self._paths.append(path)
+      self._path_ids[path] = path_id
+    return path_id
+
+  def Lookup(self, addr):
+    """Returns the (source path, line) of |addr|, or (None, None)."""
+    return self._RowAt(bisect.bisect_right(self._addrs, addr) - 1)
+
+  def LookupMany(self, addrs):
+    """Returns a list of Lookup(addr) for every address in |addrs|.
+
+    The addresses are visited in sorted order, so each search only covers the
+    rows past the previous match.
+    """
+    results = [None] * len(addrs)
+    lo = 0
+    for i in sorted(range(len(addrs)), key=addrs.__getitem__):
+      lo = bisect.bisect_right(self._addrs, addrs[i], lo)
+      results[i] = self._RowAt(lo - 1)
+    return results
+
+  def _RowAt(self, row):
+    if row < 0 or self._files[row] == _NO_FILE:
+      return None, None
+    return self._paths[self._files[row]], self._lines[row]
+
+  def _String(self, form, value):
+    section = {0x0e: self._str, 0x1f: self._line_str}.get(form)
+    if section is None:
+      return None
+    return _ReadCString(section, value)[0]
+
+  def _ReadCompDirs(self, elf):
+    """Maps each compile unit's line table offset to its compilation dir.
+
+    Only the unit's top-level DIE is decoded.
+    """
+    info = elf.SectionData('.debug_info')
+    abbrev = elf.SectionData('.debug_abbrev')
+    if info is None or abbrev is None:
+      return {}
+    str_offsets = elf.SectionData('.debug_str_offsets')
+    reader = _Reader(info, elf.endian)
+    comp_dirs = {}
+    pos = 0
+    while pos < len(info):
+      length, offset_size, unit_start = reader.UnitLength(pos)
+      end = unit_start + length
+      version = reader.Unsigned(unit_start, 2)
+      p = unit_start + 2
+      if version >= 5:
+        unit_type = info[p]
+        address_size = info[p + 1]
+        abbrev_offset = reader.Unsigned(p + 2, offset_size)
+        p += 2 + offset_size
+        if unit_type in (2, 6):  # Type units: signature and type offset.
+          p += 8 + offset_size
+        elif unit_type in (4, 5):  # Skeleton and split units: dwo id.
+          p += 8
+      else:
+        abbrev_offset = reader.Unsigned(p, offset_size)
+        address_size = info[p + offset_size]
+        p += offset_size + 1
+      pos = end
+      if version < 2 or version > 5:
+        continue
+      code, p = _ReadULEB(info, p)
+      specs = self._FindAbbrev(abbrev, abbrev_offset, code)
+      if specs is None:
+        continue
+      attrs = {}
+      for name, form, implicit in specs:
+        value, p = self._ReadForm(reader, p, form, implicit, version,
+                                  offset_size, address_size)
+        attrs[name] = (form, value)
+      if DW_AT_stmt_list not in attrs or DW_AT_comp_dir not in attrs:
+        continue
+      form, value = attrs[DW_AT_comp_dir]
+      if form in _STRX_FORMS:
+        if str_offsets is None or DW_AT_str_offsets_base not in attrs:
+          continue
+        base = attrs[DW_AT_str_offsets_base][1]
+        value = _Reader(str_offsets, elf.endian).Unsigned(
+            base + value * offset_size, offset_size)
+        form = 0x0e
+      comp_dir = value if form == 0x08 else self._String(form, value)
+      if comp_dir is not None:
+        comp_dirs[attrs[DW_AT_stmt_list][1]] = comp_dir
+    return comp_dirs
+
+  @staticmethod
+  def _FindAbbrev(abbrev, pos, code):
+    """Returns the [(attribute, form, implicit const)] of abbrev |code|."""
+    while True:
+      entry_code, pos = _ReadULEB(abbrev, pos)
+      if entry_code == 0:
+        return None
+      _, pos = _ReadULEB(abbrev, pos)  # Tag.
+      pos += 1  # Has children.
+      specs = []
+      while True:
+        name, pos = _ReadULEB(abbrev, pos)
+        form, pos = _ReadULEB(abbrev, pos)
+        if name == 0 and form == 0:
+          break
+        implicit = None
+        if form == DW_FORM_implicit_const:
+          implicit, pos = _ReadSLEB(abbrev, pos)
+        specs.append((name, form, implicit))
+      if entry_code == code:
+        return specs
+
+  @staticmethod
+  def _ReadForm(reader, pos, form, implicit, version, offset_size,
+                address_size):
+    """Reads an attribute value; returns (value, pos after it).
+
+    Strings are returned as strings, blocks as None and everything else as an
+    integer.
+    """
+    data = reader.data
+    if form == DW_FORM_indirect:
+      form, pos = _ReadULEB(data, pos)
+    if form == DW_FORM_implicit_const:
+      return implicit, pos
+    if form == 0x08:
+      return _ReadCString(data, pos)
+    if form == 0x0d:
+      return _ReadSLEB(data, pos)
+    if form in _ULEB_FORMS:
+      return _ReadULEB(data, pos)
+    if form in _BLOCK_FORMS:
+      size = _BLOCK_FORMS[form]
+      if size is None:
+        length, pos = _ReadULEB(data, pos)
+      else:
+        length = reader.Unsigned(pos, size)
+        pos += size
+      return None, pos + length
+    if form == 0x01:
+      size = address_size
+    elif form == 0x10:
+      size = address_size if version == 2 else offset_size
+    elif form in _OFFSET_FORMS:
+      size = offset_size
+    else:
+      size = _FIXED_FORM_SIZES[form]
+    if size == 0:
+      return 1, pos
+    if size > 8:
+      return None, pos + size
+    return reader.Unsigned(pos, size), pos + size
+
+  def _ReadSequences(self, reader, comp_dirs):
+    """Runs every line program; returns [(addresses, file ids, lines)]."""
+    data = reader.data
+    sequences = []
+    pos = 0
+    while pos < len(data):
+      unit_offset = pos
+      length, offset_size, p = reader.UnitLength(pos)
+      end = p + length
+      if end > len(data):
+        raise IndexError('line table at %d runs past the end of .debug_line' %
+                         unit_offset)
+      pos = end
+      version = reader.Unsigned(p, 2)
+      p += 2
+      if version < 2 or version > 5:
+        continue
+      if version >= 5:
+        p += 2  # Address and segment selector sizes.
+      header_length = reader.Unsigned(p, offset_size)
+      p += offset_size
+      program = p + header_length
+      min_inst_length = data[p]
+      p += 1
+      if version >= 4:
+        p += 1  # Maximum operations per instruction; VLIW is not supported.
+      p += 1  # default_is_stmt
+      line_base = data[p] - 256 if data[p] >= 128 else data[p]
+      line_range = data[p + 1]
+      opcode_base = data[p + 2]
+      opcode_lengths = data[p + 3:p + 2 + opcode_base]
+      p += 2 + opcode_base
+
+      if version >= 5:
+        files, dirs = self._ReadV5FileTable(reader, p, offset_size)
+      else:
+        files, dirs = self._ReadFileTable(data, p,
+                                          comp_dirs.get(unit_offset, ''))
+      sequences.extend(self._RunProgram(
+          reader, program, end, files, dirs, version, min_inst_length,
+          line_base, line_range, opcode_base, opcode_lengths))
+    return sequences
+
+  def _ReadFileTable(self, data, p, comp_dir):
+    """Reads the DWARF 2-4 directory and file tables.
+
+    Returns (path id of each file number, path of each directory number).
+    """
+    dirs = [comp_dir]
+    while data[p]:
+      name, p = _ReadCString(data, p)
+      dirs.append(posixpath.join(comp_dir, name))
+    p += 1
+    files = [None]  # File numbers start at 1.
+    while data[p]:
+      name, p = _ReadCString(data, p)
+      dir_index, p = _ReadULEB(data, p)
+      _, p = _ReadULEB(data, p)  # Modification time.
+      _, p = _ReadULEB(data, p)  # Length.
+      directory = dirs[dir_index] if dir_index < len(dirs) else ''
+      files.append(self._InternPath(posixpath.join(directory, name)))
+    return files, dirs
+
+  def _ReadV5FileTable(self, reader, p, offset_size):
+    """Reads the DWARF 5 directory and file tables, as _ReadFileTable()."""
+    data = reader.data
+
+    def ReadEntries(p):
+      format_count = data[p]
+      p += 1
+      formats = []
+      for _ in range(format_count):
+        content_type, p = _ReadULEB(data, p)
+        form, p = _ReadULEB(data, p)
+        formats.append((content_type, form))
+      count, p = _ReadULEB(data, p)
+      entries = []
+      for _ in range(count):
+        entry = {}
+        for content_type, form in formats:
+          value, p = self._ReadForm(reader, p, form, None, 5, offset_size, 0)
+          if form in (0x0e, 0x1f):
+            value = self._String(form, value)
+          entry[content_type] = value
+        entries.append(entry)
+      return entries, p
+
+    dirs, p = ReadEntries(p)
+    dirs = [d.get(DW_LNCT_path) or '' for d in dirs]
+    if dirs:
+      dirs = [dirs[0]] + [posixpath.join(dirs[0], d) for d in dirs[1:]]
+    entries, p = ReadEntries(p)
+    files = []
+    for entry in entries:
+      dir_index = entry.get(DW_LNCT_directory_index, 0)
+      directory = dirs[dir_index] if dir_index < len(dirs) else ''
+      files.append(self._InternPath(
+          posixpath.join(directory, entry.get(DW_LNCT_path) or '')))
+    return files, dirs
+
+  def _RunProgram(self, reader, p, end, files, dirs, version, min_inst_length,
+                  line_base, line_range, opcode_base, opcode_lengths):
+    """Runs one line number program; returns its sequences.
+
+    Sequences the linker discarded (which start at address 0 or at an
+    all-ones tombstone) are dropped.
+    """
+    data = reader.data
+    sequences = []
+    addrs = []
+    file_ids = []
+    lines = []
+    address = 0
+    file_index = 1
+    line = 1
+    tombstone = 0xffffffff
+    const_add_pc = (255 - opcode_base) // line_range * min_inst_length
+    while p < end:
+      opcode = data[p]
+      p += 1
+      emit = False
+      if opcode >= opcode_base:
+        adjusted = opcode - opcode_base
+        address += adjusted // line_range * min_inst_length
+        line += line_base + adjusted % line_range
+        emit = True
+      elif opcode == 0:
+        length, p = _ReadULEB(data, p)
+        sub_opcode = data[p]
+        if sub_opcode == DW_LNE_end_sequence:
+          start = addrs[0] if addrs else address
+          if addrs and 0 < start < tombstone - 1:
+            addrs.append(address)
+            file_ids.append(_NO_FILE)
+            lines.append(0)
+            sequences.append((addrs, file_ids, lines))
+          addrs = []
+          file_ids = []
+          lines = []
+          address = 0
+          file_index = 1
+          line = 1
+        elif sub_opcode == DW_LNE_set_address:
+          address = reader.Unsigned(p + 1, length - 1)
+          tombstone = (1 << (8 * (length - 1))) - 1
+        elif sub_opcode == DW_LNE_define_file and version < 5:
+          name, q = _ReadCString(data, p + 1)
+          dir_index, q = _ReadULEB(data, q)
+          directory = dirs[dir_index] if dir_index < len(dirs) else ''
+          files.append(self._InternPath(posixpath.join(directory, name)))
+        p += length
+      elif opcode == DW_LNS_copy:
+        emit = True
+      elif opcode == DW_LNS_advance_pc:
+        advance, p = _ReadULEB(data, p)
+        address += advance * min_inst_length
+      elif opcode == DW_LNS_advance_line:
+        advance, p = _ReadSLEB(data, p)
+        line += advance
+      elif opcode == DW_LNS_set_file:
+        file_index, p = _ReadULEB(data, p)
+      elif opcode == DW_LNS_const_add_pc:
+        address += const_add_pc
+      elif opcode == DW_LNS_fixed_advance_pc:
+        address += reader.Unsigned(p, 2)
+        p += 2
+      else:
+        # Skip the ULEB operands of every other standard opcode.
+        for _ in range(opcode_lengths[opcode - 1]):
+          _, p = _ReadULEB(data, p)
+      if emit:
+        path_id = files[file_index] if file_index < len(files) else None
+        if addrs and addrs[-1] == address:
+          # Only the last row at an address matters for lookups.
+          file_ids[-1] = _NO_FILE if path_id is None else path_id
+          lines[-1] = line
+        else:
+          addrs.append(address)
+          file_ids.append(_NO_FILE if path_id is None else path_id)
+          lines.append(line)
+    return sequences
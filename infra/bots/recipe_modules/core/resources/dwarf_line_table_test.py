@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Tests for dwarf_line_table, checked against addr2line."""
+
+
+import distutils.spawn
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+import dwarf_line_table
+
+
+SOURCE = r'''
+static int square(int x) {
+  return x * x;
+}
+
+int main(int argc, char** argv) {
+  int total = 0;
+  for (int i = 0; i < argc; i++) {
+    total += square(i);
+  }
+  return total;
+}
+'''
+
+TOOLS = ('gcc', 'addr2line', 'nm', 'objcopy')
+
+
+@unittest.skipUnless(all(distutils.spawn.find_executable(t) for t in TOOLS),
+                     'needs %s' % ', '.join(TOOLS))
+class LineTableTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'test.c')
+    with open(self.src, 'w') as f:
+      f.write(SOURCE)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def compile(self, name, flags):
+    exe = os.path.join(self.tmp, name)
+    subprocess.check_call(['gcc', '-O0', '-o', exe, self.src] + flags,
+                          cwd=self.tmp)
+    return exe
+
+  def code_addresses(self, exe):
+    """Every address in the functions defined in SOURCE."""
+    addrs = []
+    for line in subprocess.check_output(['nm', '-S', exe]).splitlines():
+      fields = line.split()
+      if len(fields) == 4 and fields[3] in ('main', 'square'):
+        start, size = int(fields[0], 16), int(fields[1], 16)
+        addrs.extend(range(start, start + size))
+    self.assertTrue(addrs)
+    return addrs
+
+  def check_against_addr2line(self, exe):
+    addrs = self.code_addresses(exe)
+    out = subprocess.check_output(
+        ['addr2line', '-e', exe] + ['0x%x' % a for a in addrs])
+    expected = []
+    for line in out.splitlines():
+      # Drop any ' (discriminator N)'.
+      path, _, number = line.split(' ')[0].rpartition(':')
+      expected.append((path, int(number)))
+
+    table = dwarf_line_table.LineTable(exe)
+    self.assertEqual([table.Lookup(a) for a in addrs], expected)
+    self.assertEqual(table.LookupMany(addrs), expected)
+    self.assertEqual(set(path for path, _ in expected), set([self.src]))
+
+  def test_dwarf_versions(self):
+    for version in (2, 4, 5):
+      self.check_against_addr2line(
+          self.compile('test%d' % version, ['-g', '-gdwarf-%d' % version]))
+
+  def test_compressed_sections(self):
+    exe = self.compile('test', ['-g'])
+    for style in ('zlib', 'zlib-gnu'):
+      compressed = exe + '.' + style
+      subprocess.check_call(['objcopy', '--compress-debug-sections=' + style,
+                             exe, compressed])
+      elf = dwarf_line_table.ElfFile(compressed)
+      try:
+        if style == 'zlib':
+          self.assertTrue(elf._sections['.debug_line'][2] &
+                          dwarf_line_table.SHF_COMPRESSED)
+        else:
+          self.assertIn('.zdebug_line', elf._sections)
+      finally:
+        elf.Close()
+      self.check_against_addr2line(compressed)
+
+  def test_outside_line_table(self):
+    table = dwarf_line_table.LineTable(self.compile('test', ['-g']))
+    self.assertEqual(table.Lookup(0), (None, None))
+    self.assertEqual(table.Lookup(2 ** 40), (None, None))
+
+  def replace_line_section(self, exe, edit):
+    """Returns a copy of exe with edit applied to its .debug_line."""
+    section = os.path.join(self.tmp, 'debug_line')
+    subprocess.check_call(['objcopy', '--dump-section',
+                           '.debug_line=' + section, exe])
+    with open(section, 'rb') as f:
+      data = edit(f.read())
+    with open(section, 'wb') as f:
+      f.write(data)
+    edited = exe + '.edited'
+    subprocess.check_call(['objcopy', '--update-section',
+                           '.debug_line=' + section, exe, edited])
+    return edited
+
+  def test_truncated_section(self):
+    exe = self.compile('test', ['-g'])
+    for size in (2, 10, 40):
+      truncated = self.replace_line_section(exe, lambda d: d[:size])
+      with self.assertRaises(ValueError):
+        dwarf_line_table.LineTable(truncated)
+
+  def test_corrupt_unit_length(self):
+    exe = self.compile('test', ['-g'])
+    corrupt = self.replace_line_section(
+        exe, lambda d: struct.pack('<I', len(d)) + d[4:])
+    with self.assertRaises(ValueError):
+      dwarf_line_table.LineTable(corrupt)
+
+  def test_unknown_version_skipped(self):
+    exe = self.compile('test', ['-g'])
+    corrupt = self.replace_line_section(
+        exe, lambda d: d[:4] + struct.pack('<H', 99) + d[6:])
+    table = dwarf_line_table.LineTable(corrupt)
+    self.assertEqual(len(table), 0)
+
+  def test_not_elf(self):
+    with self.assertRaises(ValueError):
+      dwarf_line_table.LineTable(self.src)
+
+  def test_relocatable_object(self):
+    obj = os.path.join(self.tmp, 'test.o')
+    subprocess.check_call(['gcc', '-g', '-c', '-o', obj, self.src])
+    with self.assertRaises(ValueError):
+      dwarf_line_table.LineTable(obj)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -9,6 +9,8 @@ chromium/src/build/android/pylib/symbols/elf_symbolizer.py.
 
 Main changes:
 -- Added prefix_to_remove param to remove path prefix from tree data.
+-- Added ELFLineTableSymbolizer, which answers lookups in-process from the
+   DWARF line tables instead of through addr2line.
 """
 
 import collections
@@ -23,6 +25,8 @@ import subprocess
 import sys
 import threading
 
+import dwarf_line_table
+
 
 # addr2line builds a possibly infinite memory cache that can exhaust
 # the computer's memory if allowed to grow for too long. This constant
@@ -134,9 +138,11 @@ class ELFSymbolizer(object):
     self.disambiguate = source_root_path is not None
     self.disambiguation_table = {}
     self.strip_base_path = strip_base_path
+    self.source_root_path = None
     if(self.disambiguate):
       self.source_root_path = os.path.abspath(source_root_path)
-      self._CreateDisambiguationTable()
+      self.disambiguation_table = _CreateDisambiguationTable(
+          self.source_root_path)
 
     # Create one addr2line instance. More instances will be created on demand
     # (up to |max_concurrent_jobs|) depending on the rate of the requests.
@@ -195,15 +201,6 @@ class ELFSymbolizer(object):
     self._a2l_instances.append(a2l)
     return a2l
 
-  def _CreateDisambiguationTable(self):
-    """ Non-unique file names will result in None entries"""
-    self.disambiguation_table = {}
-
-    for root, _, filenames in os.walk(self.source_root_path):
-      for f in filenames:
-        self.disambiguation_table[f] = os.path.join(root, f) if (f not in
-                                       self.disambiguation_table) else None
-
 
   class Addr2Line(object):
     """A python wrapper around an addr2line instance.
@@ -355,29 +352,8 @@ class ELFSymbolizer(object):
         else:
           logging.warning('Got invalid symbol path from addr2line: %s' % line2)
 
-        # In case disambiguation is on, and needed
-        was_ambiguous = False
-        disambiguated = False
-        if self._symbolizer.disambiguate:
-          if source_path and not posixpath.isabs(source_path):
-            path = self._symbolizer.disambiguation_table.get(source_path)
-            was_ambiguous = True
-            disambiguated = path is not None
-            source_path = path if disambiguated else source_path
-
-          # Use absolute paths (so that paths are consistent, as disambiguation
-          # uses absolute paths)
-          if source_path and not was_ambiguous:
-            source_path = os.path.abspath(source_path)
-
-        if source_path and self._symbolizer.strip_base_path:
-          # Strip the base path
-          source_path = re.sub('^' + self._symbolizer.strip_base_path,
-              self._symbolizer.source_root_path or '', source_path)
-
-        sym_info = ELFSymbolInfo(name, source_path, source_line, was_ambiguous,
-                                 disambiguated,
-                                 self._symbolizer.prefix_to_remove)
+        sym_info = _MakeSymbolInfo(self._symbolizer, name, source_path,
+                                   source_line)
         if prev_sym_info:
           prev_sym_info.inlined_by = sym_info
         if not innermost_sym_info:
@@ -455,6 +431,114 @@ class ELFSymbolizer(object):
       return self._request_queue[0][2] if self._request_queue else 0
 
 
+class ELFLineTableSymbolizer(object):
+  """An in-process ELF symbolizer backed by the DWARF line tables.
+
+  This has the same SymbolizeAsync()/Join() interface as ELFSymbolizer, but
+  instead of piping addresses through addr2line it decodes .debug_line once
+  (see dwarf_line_table.LineTable) and resolves every request with a binary
+  search. Requests are only buffered by SymbolizeAsync(); Join() looks them
+  all up at once and issues the callbacks.
+
+  Only source paths and lines come from the line tables; symbol names are
+  always None. Addresses no line table covers (e.g. data) are handed to an
+  ELFSymbolizer instead, if |addr2line_path| is given.
+  """
+
+  def __init__(self, elf_file_path, callback, addr2line_path=None,
+               max_concurrent_jobs=None, source_root_path=None,
+               strip_base_path=None, prefix_to_remove=None):
+    """Args are as for ELFSymbolizer; |addr2line_path| is optional."""
+    self.elf_file_path = elf_file_path
+    self.callback = callback
+    self.prefix_to_remove = prefix_to_remove
+    self.strip_base_path = strip_base_path
+    self.disambiguate = source_root_path is not None
+    self.disambiguation_table = {}
+    self.source_root_path = None
+    if self.disambiguate:
+      self.source_root_path = os.path.abspath(source_root_path)
+      self.disambiguation_table = _CreateDisambiguationTable(
+          self.source_root_path)
+    self._fallback_args = None
+    if addr2line_path:
+      self._fallback_args = (addr2line_path, max_concurrent_jobs,
+                             source_root_path, strip_base_path,
+                             prefix_to_remove)
+    self._addrs = []
+    self._callback_args = []
+
+  def SymbolizeAsync(self, addr, callback_arg=None):
+    """Requests symbolization of a given address. Never blocks."""
+    self._addrs.append(addr)
+    self._callback_args.append(callback_arg)
+
+  def Join(self):
+    """Resolves all the outstanding requests, issuing their callbacks."""
+    line_table = dwarf_line_table.LineTable(self.elf_file_path)
+    locations = line_table.LookupMany(self._addrs)
+    misses = []
+    for addr, callback_arg, (source_path, source_line) in zip(
+        self._addrs, self._callback_args, locations):
+      if source_path is None and self._fallback_args:
+        misses.append((addr, callback_arg))
+        continue
+      self.callback(_MakeSymbolInfo(self, None, source_path, source_line),
+                    callback_arg)
+    self._addrs = []
+    self._callback_args = []
+
+    if misses:
+      addr2line_path, jobs, source_root_path, strip_base_path, prefix = (
+          self._fallback_args)
+      fallback = ELFSymbolizer(self.elf_file_path, addr2line_path,
+                               self.callback, max_concurrent_jobs=jobs,
+                               source_root_path=source_root_path,
+                               strip_base_path=strip_base_path,
+                               prefix_to_remove=prefix)
+      for addr, callback_arg in misses:
+        fallback.SymbolizeAsync(addr, callback_arg)
+      fallback.Join()
+
+
+def _CreateDisambiguationTable(source_root_path):
+  """Maps file names to paths under |source_root_path|.
+
+  Non-unique file names will result in None entries."""
+  disambiguation_table = {}
+  for root, _, filenames in os.walk(source_root_path):
+    for f in filenames:
+      disambiguation_table[f] = os.path.join(root, f) if (f not in
+                                disambiguation_table) else None
+  return disambiguation_table
+
+
+def _MakeSymbolInfo(symbolizer, name, source_path, source_line):
+  """Applies |symbolizer|'s path disambiguation and rewriting rules."""
+  # In case disambiguation is on, and needed
+  was_ambiguous = False
+  disambiguated = False
+  if symbolizer.disambiguate:
+    if source_path and not posixpath.isabs(source_path):
+      path = symbolizer.disambiguation_table.get(source_path)
+      was_ambiguous = True
+      disambiguated = path is not None
+      source_path = path if disambiguated else source_path
+
+    # Use absolute paths (so that paths are consistent, as disambiguation
+    # uses absolute paths)
+    if source_path and not was_ambiguous:
+      source_path = os.path.abspath(source_path)
+
+  if source_path and symbolizer.strip_base_path:
+    # Strip the base path
+    source_path = re.sub('^' + symbolizer.strip_base_path,
+        symbolizer.source_root_path or '', source_path)
+
+  return ELFSymbolInfo(name, source_path, source_line, was_ambiguous,
+                       disambiguated, symbolizer.prefix_to_remove)
+
+
 class ELFSymbolInfo(object):
   """The result of the symbolization passed as first arg. of each callback."""
 
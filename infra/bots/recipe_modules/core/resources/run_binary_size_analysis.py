@@ -14,6 +14,7 @@ chromium/src/tools/binary_size/run_binary_size_analysis.py. Main changes:
     TreeMap JSON data into a Google Storage bucket.
 -- Adds githash and total_size to the JSON data.
 -- Outputs another summary data in JSON Bench format for skiaperf ingestion.
+-- Optionally diffs the tree against another binary's, see binary_size_diff.py.
 
 The output JSON data for visualization is in the following format:
 
@@ -76,6 +77,8 @@ In the binary size case, outputs look like:
 
 import collections
 import datetime
+import errno
+import gzip
 import json
 import logging
 import multiprocessing
@@ -90,7 +93,9 @@ import tempfile
 import time
 import urllib2
 
+import binary_size_diff
 import binary_size_utils
+import dwarf_line_table
 import elf_symbolizer
 
 # Node dictionary keys. These are output in json read by the webapp so
@@ -325,6 +330,7 @@ def DumpCompactTree(symbols, symbol_path_origin_dir, ha, ts, issue, dest):
   with open(dest, 'w') as out:
     # Use separators without whitespace to get a smaller file.
     json.dump(json_data, out, separators=(',', ':'))
+  return tree_root
 
 
 def MakeSourceMap(symbols):
@@ -371,16 +377,118 @@ class Progress():
     self.was_ambiguous = 0
 
 
+class SymbolCache(object):
+  """An on-disk cache of symbolized nm output, keyed by GNU build ID.
+
+  Entries are the gzipped --nm-out files, so they can be used as --nm-in.
+  When a Git hash is known, it is mapped to the build ID too, so that a later
+  run can use the results for its parent commit as a baseline.
+  """
+
+  def __init__(self, cache_dir):
+    self._dir = cache_dir
+
+  def _BuildIdPath(self, build_id):
+    return os.path.join(self._dir, 'build-id', build_id + '.nm.gz')
+
+  def _GithashPath(self, githash):
+    return os.path.join(self._dir, 'githash', githash)
+
+  def Lookup(self, build_id):
+    """Returns the path of the cached nm output for |build_id|, or None."""
+    path = self._BuildIdPath(build_id)
+    return path if os.path.isfile(path) else None
+
+  def LookupGithash(self, githash):
+    """Returns the path of the cached nm output for |githash|, or None."""
+    try:
+      with open(self._GithashPath(githash)) as f:
+        return self.Lookup(f.read().strip())
+    except IOError:
+      return None
+
+  def Store(self, build_id, nm_file, githash=None):
+    """Adds the symbolized nm output in |nm_file| to the cache."""
+    path = self._BuildIdPath(build_id)
+    _MakeDirs(os.path.dirname(path))
+    # Write to a temporary file and rename, so concurrent runs never see a
+    # partial entry.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as raw:
+      with gzip.GzipFile(fileobj=raw, mode='wb') as out:
+        with open(nm_file, 'rb') as f:
+          shutil.copyfileobj(f, out)
+    os.rename(tmp, path)
+    self.Tag(build_id, githash)
+
+  def Tag(self, build_id, githash):
+    """Records that |githash| was built into |build_id|."""
+    if githash and githash != 'latest':
+      path = self._GithashPath(githash)
+      _MakeDirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write(build_id + '\n')
+
+
+def _MakeDirs(path):
+  try:
+    os.makedirs(path)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+
+def _OpenNmFile(path):
+  if path.endswith('.gz'):
+    return gzip.open(path, 'r')
+  return open(path, 'r')
+
+
+def LoadKnownLocations(nm_file):
+  """Maps symbol names to their location in symbolized nm output.
+
+  Names which occur more than once (e.g. static functions in several files)
+  can't be matched up reliably and are left out.
+  """
+  locations = {}
+  ambiguous = set()
+  with _OpenNmFile(nm_file) as infile:
+    for line in infile:
+      match = sNmPattern.match(line.rstrip('\n'))
+      if not match or not match.group(5):
+        continue
+      name = match.group(4)
+      if name in locations:
+        ambiguous.add(name)
+      locations[name] = match.group(5)
+  for name in ambiguous:
+    del locations[name]
+  return locations
+
+
 def RunElfSymbolizer(outfile, library, addr2line_binary, nm_binary, jobs,
-                     disambiguate, src_path):
-  nm_output = RunNm(library, nm_binary)
-  nm_output_lines = nm_output.splitlines()
-  nm_output_lines_len = len(nm_output_lines)
-  address_symbol = {}
+                     disambiguate, src_path, use_addr2line=False,
+                     known_locations=None):
+  """Writes nm output for |library| with source locations to |outfile|.
+
+  The nm output is streamed: lines are spooled to a temporary file rather
+  than kept in memory, and only the location of each looked up address is
+  kept, as an interned path and a line number.
+
+  Symbols in |known_locations| (see LoadKnownLocations) whose names are unique
+  in |library| reuse the location found there instead of being looked up.
+  """
+  symbol_path_origin_dir = os.path.dirname(library)
+  # Skia specific: path prefix to strip.
+  symbol_path_prefix = symbol_path_origin_dir.replace(LIBSKIA_RELATIVE_PATH, '')
+
+  # Maps addresses to their (path, line) output location.
+  address_location = {}
+  interned_paths = {}
   progress = Progress()
   def map_address_symbol(symbol, addr):
     progress.count += 1
-    if addr in address_symbol:
+    if addr in address_location:
       # 'Collision between %s and %s.' % (str(symbol.name),
       #                                   str(address_symbol[addr].name))
       progress.collisions += 1
@@ -390,7 +498,11 @@ def RunElfSymbolizer(outfile, library, addr2line_binary, nm_binary, jobs,
       if symbol.was_ambiguous:
         progress.was_ambiguous += 1
 
-      address_symbol[addr] = symbol
+      path = '??'
+      if symbol.source_path is not None:
+        path = symbol.source_path.replace(symbol_path_prefix, '')
+      path = interned_paths.setdefault(path, path)
+      address_location[addr] = (path, symbol.source_line or 0)
 
     progress_output()
 
@@ -408,43 +520,61 @@ def RunElfSymbolizer(outfile, library, addr2line_binary, nm_binary, jobs,
           speed = chunk_size / time_spent
         else:
           speed = 0
-        progress_percent = (100.0 * (progress.count + progress.skip_count) /
-                            nm_output_lines_len)
         disambiguation_percent = 0
         if progress.disambiguations != 0:
           disambiguation_percent = (100.0 * progress.disambiguations /
                                     progress.was_ambiguous)
 
-        sys.stdout.write('\r%.1f%%: Looked up %d symbols (%d collisions, '
+        # The total number of symbols isn't known while nm is streaming.
+        sys.stdout.write('\rLooked up %d symbols (%d collisions, '
               '%d disambiguations where %.1f%% succeeded)'
               ' - %.1f lookups/s.' %
-              (progress_percent, progress.count, progress.collisions,
+              (progress.count, progress.collisions,
                progress.disambiguations, disambiguation_percent, speed))
 
   # In case disambiguation was disabled, we remove the source path (which upon
   # being set signals the symbolizer to enable disambiguation)
   if not disambiguate:
     src_path = None
-  symbol_path_origin_dir = os.path.dirname(library)
-  # Skia specific.
-  symbol_path_prefix = symbol_path_origin_dir.replace(LIBSKIA_RELATIVE_PATH, '')
-  symbolizer = elf_symbolizer.ELFSymbolizer(library, addr2line_binary,
-                                            map_address_symbol,
-                                            max_concurrent_jobs=jobs,
-                                            source_root_path=src_path,
-                                            prefix_to_remove=symbol_path_prefix)
+  if use_addr2line:
+    symbolizer = elf_symbolizer.ELFSymbolizer(
+        library, addr2line_binary, map_address_symbol,
+        max_concurrent_jobs=jobs, source_root_path=src_path,
+        prefix_to_remove=symbol_path_prefix)
+  else:
+    # Looks everything up in-process from the DWARF line tables, leaving only
+    # what they don't cover (data symbols) to addr2line.
+    symbolizer = elf_symbolizer.ELFLineTableSymbolizer(
+        library, map_address_symbol, addr2line_path=addr2line_binary,
+        max_concurrent_jobs=jobs, source_root_path=src_path,
+        prefix_to_remove=symbol_path_prefix)
+
+  # Whether a known name is unique is only known once nm is done, so those
+  # symbols are held back until then.
+  known_locations = known_locations or {}
+  known_name_counts = collections.Counter()
+  known_addrs = {}
+  reused_locations = {}
+  spool = tempfile.TemporaryFile()
   user_interrupted = False
   try:
-    for line in nm_output_lines:
+    for line in IterNm(library, nm_binary):
+      spool.write(line + '\n')
       match = sNmPattern.match(line)
       if match:
         location = match.group(5)
         if not location:
           addr = int(match.group(1), 16)
           size = int(match.group(2), 16)
-          if addr in address_symbol:  # Already looked up, shortcut
-                                      # ELFSymbolizer.
-            map_address_symbol(address_symbol[addr], addr)
+          name = match.group(4)
+          if name in known_locations:
+            known_name_counts[name] += 1
+            known_addrs[addr] = name
+            continue
+          elif addr in address_location:  # Already looked up, shortcut
+                                          # ELFSymbolizer.
+            progress.count += 1
+            progress.collisions += 1
             continue
           elif size == 0:
             # Save time by not looking up empty symbols (do they even exist?)
@@ -454,6 +584,12 @@ def RunElfSymbolizer(outfile, library, addr2line_binary, nm_binary, jobs,
             continue
 
       progress.skip_count += 1
+
+    for addr, name in known_addrs.iteritems():
+      if known_name_counts[name] == 1:
+        reused_locations[addr] = known_locations[name]
+      else:
+        symbolizer.SymbolizeAsync(addr, addr)
   except KeyboardInterrupt:
     user_interrupted = True
     print('Interrupting - killing subprocesses. Please wait.')
@@ -471,67 +607,95 @@ def RunElfSymbolizer(outfile, library, addr2line_binary, nm_binary, jobs,
     print('Skipping the rest of the file mapping. '
           'Output will not be fully classified.')
 
-  symbol_path_origin_dir = os.path.dirname(library)
-  # Skia specific: path prefix to strip.
-  symbol_path_prefix = symbol_path_origin_dir.replace(LIBSKIA_RELATIVE_PATH, '')
-
+  spool.seek(0)
   with open(outfile, 'w') as out:
-    for line in nm_output_lines:
+    for line in spool:
+      line = line.rstrip('\n')
       match = sNmPattern.match(line)
       if match:
         location = match.group(5)
         if not location:
           addr = int(match.group(1), 16)
-          symbol = address_symbol.get(addr)
-          if symbol is not None:
-            path = '??'
-            if symbol.source_path is not None:
-              path = symbol.source_path.replace(symbol_path_prefix, '')
-            line_number = 0
-            if symbol.source_line is not None:
-              line_number = symbol.source_line
-            out.write('%s\t%s:%d\n' % (line, path, line_number))
+          if addr in reused_locations:
+            out.write('%s\t%s\n' % (line, reused_locations[addr]))
+            continue
+          location = address_location.get(addr)
+          if location is not None:
+            out.write('%s\t%s:%d\n' % (line, location[0], location[1]))
             continue
 
       out.write('%s\n' % line)
+  spool.close()
 
-  print('%d symbols in the results.' % len(address_symbol))
+  print('%d symbols in the results.' % len(address_location))
+  if known_locations:
+    print('%d symbols reused from the baseline.' % len(reused_locations))
 
 
-def RunNm(binary, nm_binary):
+def IterNm(binary, nm_binary):
+  """Yields the lines of nm's output for |binary| as nm produces them."""
   cmd = [nm_binary, '-C', '--print-size', '--size-sort', '--reverse-sort',
          binary]
-  nm_process = subprocess.Popen(cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-  (process_output, err_output) = nm_process.communicate()
-
-  if nm_process.returncode != 0:
-    if err_output:
-      raise Exception, err_output
-    else:
-      raise Exception, process_output
+  # stderr goes to a file so that a chatty nm can't block on a full pipe
+  # while we're reading stdout.
+  with tempfile.TemporaryFile() as err:
+    nm_process = subprocess.Popen(cmd,
+                                  stdout=subprocess.PIPE,
+                                  stderr=err)
+    for line in nm_process.stdout:
+      yield line.rstrip('\n')
+    nm_process.stdout.close()
 
-  return process_output
+    if nm_process.wait() != 0:
+      err.seek(0)
+      raise Exception, err.read() or 'nm failed on %s' % binary
 
 
 def GetNmSymbols(nm_infile, outfile, library, jobs, verbose,
-                 addr2line_binary, nm_binary, disambiguate, src_path):
+                 addr2line_binary, nm_binary, disambiguate, src_path,
+                 use_addr2line=False, cache=None, githash=None,
+                 baseline_nm=None):
+  build_id = None
+  if nm_infile is None and cache:
+    elf = dwarf_line_table.ElfFile(library)
+    try:
+      build_id = elf.BuildId()
+    finally:
+      elf.Close()
+    if build_id:
+      nm_infile = cache.Lookup(build_id)
+      if nm_infile:
+        print 'Using cached symbols for build ID ' + build_id
+        # Let later runs use these as the baseline for this commit too.
+        cache.Tag(build_id, githash)
+        if outfile:
+          # --nm-out is still expected to hold the (uncompressed) symbols.
+          with _OpenNmFile(nm_infile) as src, open(outfile, 'w') as dst:
+            shutil.copyfileobj(src, dst)
+
   if nm_infile is None:
     if outfile is None:
       outfile = tempfile.NamedTemporaryFile(delete=False).name
 
+    known_locations = None
+    if baseline_nm:
+      if verbose:
+        print 'Reusing symbol locations from ' + baseline_nm
+      known_locations = LoadKnownLocations(baseline_nm)
+
     if verbose:
-      print 'Running parallel addr2line, dumping symbols to ' + outfile
+      print 'Symbolizing, dumping symbols to ' + outfile
     RunElfSymbolizer(outfile, library, addr2line_binary, nm_binary, jobs,
-                     disambiguate, src_path)
+                     disambiguate, src_path, use_addr2line, known_locations)
 
     nm_infile = outfile
+    if build_id:
+      cache.Store(build_id, outfile, githash)
 
   elif verbose:
     print 'Using nm input from ' + nm_infile
-  with file(nm_infile, 'r') as infile:
-    return list(binary_size_utils.ParseNm(infile))
+  with _OpenNmFile(nm_infile) as infile:
+    return binary_size_utils.SymbolTable.FromNm(infile)
 
 
 PAK_RESOURCE_ID_TO_STRING = { "inited": False }
@@ -640,6 +804,26 @@ def CheckDebugFormatSupport(library, addr2line_binary):
     sys.exit(1)
 
 
+def GetDiffBaseTree(opts, addr2line_binary, nm_binary, cache,
+                    symbol_path_origin_dir):
+  """Returns the tree to diff against, as selected by --diff-base-*."""
+  if opts.diff_base_tree:
+    return binary_size_diff.LoadTree(opts.diff_base_tree)
+
+  nm_in = opts.diff_base_nm
+  if opts.diff_base_githash:
+    nm_in = cache.LookupGithash(opts.diff_base_githash)
+    if not nm_in:
+      raise Exception('No cached symbols for ' + opts.diff_base_githash)
+  symbols = GetNmSymbols(nm_in, None, opts.diff_base_library, opts.jobs,
+                         opts.verbose is True, addr2line_binary, nm_binary,
+                         opts.disable_disambiguation is None,
+                         opts.source_path, opts.use_addr2line is True, cache)
+  if opts.pak:
+    AddPakData(symbols, opts.pak)
+  return MakeCompactTree(symbols, symbol_path_origin_dir)
+
+
 def main():
   usage = """%prog [options]
 
@@ -693,6 +877,40 @@ def main():
                     'and ramp this number up until your machine begins to '
                     'struggle with RAM. '
                     'This argument is only valid when using --library.')
+  parser.add_option('--use-addr2line', action='store_true',
+                    help='look up every symbol with a pool of addr2line '
+                    'processes instead of reading the DWARF line tables '
+                    'in-process. Much slower; addr2line is otherwise only '
+                    'used for symbols the line tables do not cover.')
+  parser.add_option('--cache-dir', metavar='PATH',
+                    help='cache symbolized nm output in <path>, keyed by the '
+                    'GNU build ID of --library. If the library was analyzed '
+                    'before, nm and symbolization are skipped entirely.')
+  parser.add_option('--baseline-githash',
+                    help='with --cache-dir, reuse the source locations of '
+                    'symbols from the cached analysis of this commit '
+                    '(usually the parent), only looking up new symbols.')
+  parser.add_option('--baseline-nm', metavar='PATH',
+                    help='like --baseline-githash, but reuse the locations in '
+                    'the given --nm-out file (optionally gzipped).')
+  parser.add_option('--diff-base-library', metavar='PATH',
+                    help='diff the analysis of --library against that of the '
+                    'library at <path>, reporting added, removed, grown and '
+                    'shrunk symbols, files and directories.')
+  parser.add_option('--diff-base-nm', metavar='PATH',
+                    help='like --diff-base-library, but diff against the '
+                    'given --nm-out file (optionally gzipped).')
+  parser.add_option('--diff-base-githash',
+                    help='with --cache-dir, like --diff-base-library, but diff '
+                    'against the cached analysis of this commit.')
+  parser.add_option('--diff-base-tree', metavar='PATH',
+                    help='like --diff-base-library, but diff against a '
+                    '--dest file from an earlier run.')
+  parser.add_option('--diff-dest', metavar='PATH',
+                    help='write the diff report to <path> as JSON.')
+  parser.add_option('--diff-top', type='int', default=20,
+                    help='number of entries of each kind to print in the '
+                    'diff summary.')
   parser.add_option('-v', dest='verbose', action='store_true',
                     help='be verbose, printing lots of status information.')
   parser.add_option('--nm-out', metavar='PATH',
@@ -725,6 +943,12 @@ def main():
 
   if ((not opts.library) and (not opts.nm_in)) or (opts.library and opts.nm_in):
     parser.error('exactly one of --library or --nm-in is required')
+  diff_bases = [b for b in (opts.diff_base_library, opts.diff_base_nm,
+                            opts.diff_base_githash, opts.diff_base_tree) if b]
+  if len(diff_bases) > 1:
+    parser.error('at most one --diff-base-* option may be given')
+  if opts.diff_base_githash and not opts.cache_dir:
+    parser.error('--diff-base-githash requires --cache-dir')
   if (opts.nm_in):
     if opts.jobs:
       print >> sys.stderr, ('WARNING: --jobs has no effect '
@@ -741,8 +965,8 @@ def main():
     addr2line_binary = opts.addr2line_binary
   else:
     addr2line_binary = _find_in_system_path('addr2line')
-    assert addr2line_binary, 'Unable to find addr2line in the path. '\
-        'Use --addr2line-binary to specify location.'
+    assert addr2line_binary or not opts.use_addr2line, 'Unable to find '\
+        'addr2line in the path. Use --addr2line-binary to specify location.'
 
   if opts.nm_binary:
     assert os.path.isfile(opts.nm_binary)
@@ -758,14 +982,25 @@ def main():
   print('addr2line: %s' % addr2line_binary)
   print('nm: %s' % nm_binary)
 
-  if opts.library:
+  if opts.library and addr2line_binary:
     CheckDebugFormatSupport(opts.library, addr2line_binary)
 
+  cache = SymbolCache(opts.cache_dir) if opts.cache_dir else None
+  baseline_nm = opts.baseline_nm
+  if opts.baseline_githash:
+    if not cache:
+      parser.error('--baseline-githash requires --cache-dir')
+    baseline_nm = cache.LookupGithash(opts.baseline_githash)
+    if not baseline_nm:
+      print('No cached symbols for %s; symbolizing everything.' %
+            opts.baseline_githash)
+
   symbols = GetNmSymbols(opts.nm_in, opts.nm_out, opts.library,
                          opts.jobs, opts.verbose is True,
                          addr2line_binary, nm_binary,
                          opts.disable_disambiguation is None,
-                         opts.source_path)
+                         opts.source_path, opts.use_addr2line is True,
+                         cache, opts.githash, baseline_nm)
 
   if opts.pak:
     AddPakData(symbols, opts.pak)
@@ -779,10 +1014,18 @@ def main():
     else:
       # Just a guess. Hopefully all paths in the input file are absolute.
       symbol_path_origin_dir = os.path.abspath(os.getcwd())
-    DumpCompactTree(symbols, symbol_path_origin_dir, opts.githash,
-                    opts.commit_ts, opts.issue_number, opts.dest)
+    tree_root = DumpCompactTree(symbols, symbol_path_origin_dir, opts.githash,
+                                opts.commit_ts, opts.issue_number, opts.dest)
     print 'Report data uploaded to GS.'
 
+    if diff_bases:
+      base_tree = GetDiffBaseTree(opts, addr2line_binary, nm_binary, cache,
+                                  symbol_path_origin_dir)
+      report = binary_size_diff.DiffTrees(base_tree, tree_root)
+      binary_size_diff.PrintReport(report, opts.diff_top)
+      if opts.diff_dest:
+        binary_size_diff.WriteReport(report, opts.diff_dest)
+
 
 if __name__ == '__main__':
   sys.exit(main())
@@ -12,7 +12,8 @@ class GSUtilApi(recipe_api.RecipeApi):
     """Run gsutil with the given args."""
     return self.m.step(step_name, cmd=['gsutil'] + list(args))
 
-  def cp(self, name, src, dst, extra_args=None, multithread=False):
+  def cp(self, name, src, dst, extra_args=None, multithread=False,
+         headers=None):
     """Attempt to upload or download files to/from Google Cloud Storage (GCS).
 
     Args:
@@ -23,23 +24,72 @@ class GSUtilApi(recipe_api.RecipeApi):
         all files be compressed with gzip after upload and before download.
       multi_thread: if the -m argument should be used to copy multiple items
         at once (e.g. gsutil -m cp foo* gs://bar/dir)
+      headers: optional list of headers to set on the uploaded objects, e.g.
+        ['Content-Encoding:gzip'] for files compressed by precompress().
 
     If the operation fails, it will be retried multiple times.
     """
     cmd = ['cp']
+    for header in reversed(headers or []):
+      cmd = ['-h', header] + cmd
     if multithread:
       cmd = ['-m'] + cmd
     if extra_args:
       cmd.extend(extra_args)
     cmd.extend([src, dst])
+    self._retry('upload %s' % name, lambda step_name: self(step_name, *cmd))
 
-    name = 'upload %s' % name
+  def upload_new_digests(self, name, src_dir, dst, index_dir, patterns=None,
+                         extra_args=None, pack=False, shared_index=None):
+    """Upload the files in src_dir which aren't already in dst.
+
+    Args:
+      name: string. Will be used to fill out the step name.
+      src_dir: Path. Directory of files named by their MD5, like DM's images.
+      dst: string. GCS directory to upload to (e.g. gs://...)
+      index_dir: Path. Where to keep the index of digests known to be in dst
+        between runs; ideally a named cache. Each dst needs its own.
+      patterns: optional list of patterns of files in src_dir to upload.
+        Defaults to PNGs and PDFs.
+      extra_args: optional list of args to be passed to gsutil cp.
+      pack: optional bool. If set, new files are uploaded to dst in a few
+        large packs, each with an index, rather than one by one.
+      shared_index: optional string. GCS directory holding a copy of the
+        index shared by all bots, which is fetched rather than listing dst
+        when index_dir's is missing or old. Each dst needs its own.
+
+    See resources/upload_new_digests.py. If the upload fails, it will be
+    retried multiple times; files which were uploaded aren't uploaded again.
+    """
+    cmd = ['python', self.resource('upload_new_digests.py'),
+           src_dir, dst, '--index_dir', index_dir]
+    for pattern in patterns or []:
+      cmd.extend(['--pattern', pattern])
+    for arg in extra_args or []:
+      cmd.append('--gsutil_arg=%s' % arg)
+    if pack:
+      cmd.append('--pack')
+    if shared_index:
+      cmd.extend(['--shared_index', shared_index])
+    self._retry('upload %s' % name,
+                lambda step_name: self.m.step(step_name, cmd=cmd))
+
+  def precompress(self, name, paths):
+    """Gzip the given files in place, in parallel.
+
+    Upload them with cp(..., headers=['Content-Encoding:gzip']) to get the
+    same objects as with cp(..., extra_args=['-z', ...]).
+    """
+    return self.m.step(name, cmd=['python', self.resource('precompress.py')] +
+                       list(paths))
+
+  def _retry(self, name, fn):
     for i in xrange(UPLOAD_ATTEMPTS):
       step_name = name
       if i > 0:
         step_name += ' (attempt %d)' % (i+1)
       try:
-        self(step_name, *cmd)
+        fn(step_name)
         break
       except self.m.step.StepFailure:
         if i == UPLOAD_ATTEMPTS - 1:
@@ -20,6 +20,22 @@ DEPS = [
 def RunSteps(api):
   api.gsutil.cp('test file', '/foo/file', 'gs://bar-bucket/file',
                 extra_args=['-Z'], multithread=True)
+  api.gsutil.upload_new_digests('test images',
+                                api.path['start_dir'].join('images'),
+                                'gs://bar-bucket/images',
+                                api.path['cache'].join('digests'),
+                                patterns=['*.png'],
+                                extra_args=['-a', 'public-read'],
+                                shared_index='gs://bar-bucket/images-index')
+  api.gsutil.upload_new_digests('test packs',
+                                api.path['start_dir'].join('images'),
+                                'gs://bar-bucket/packs',
+                                api.path['cache'].join('pack_digests'),
+                                pack=True)
+  api.gsutil.precompress('compress logs',
+                         [api.path['start_dir'].join('logs', 'a.log')])
+  api.gsutil.cp('logs', api.path['start_dir'].join('logs', '*'),
+                'gs://bar-bucket/logs', headers=['Content-Encoding:gzip'])
 
 def GenTests(api):
   yield (
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Gzip files in place, several at a time.
+
+Each file keeps its name, so that uploading it with "gsutil -h
+Content-Encoding:gzip cp" stores the same object as "gsutil cp -z" would,
+without compressing in gsutil as it uploads.
+"""
+
+
+import argparse
+import gzip
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import sys
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def compress(path):
+  """Replace path with its gzipped contents."""
+  tmp = path + '.gz.tmp'
+  with open(path, 'rb') as src:
+    # mtime=0, so that compressing the same file always gives the same bytes.
+    with open(tmp, 'wb') as f:
+      with gzip.GzipFile(os.path.basename(path), 'wb', 9, f, 0) as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+  if os.name == 'nt':
+    os.remove(path)
+  os.rename(tmp, path)
+
+
+def compress_all(paths, jobs=None):
+  """Compress each of paths in place.
+
+  Up to jobs (default: one per CPU) files are compressed at once.
+  """
+  pool = multiprocessing.pool.ThreadPool(jobs or multiprocessing.cpu_count())
+  try:
+    pool.map(compress, paths)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('paths', nargs='+')
+  parser.add_argument('--jobs', type=int)
+  args = parser.parse_args()
+  compress_all(args.paths, args.jobs)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
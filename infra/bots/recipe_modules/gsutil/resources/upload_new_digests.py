@@ -0,0 +1,629 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Upload the files in a directory which the destination doesn't have yet.
+
+DM names each image after the MD5 of its contents, so an image which was
+uploaded once never needs to be uploaded again, and most runs produce only a
+handful of new ones. Rather than asking the destination about each file, we
+keep a local index of the digests known to be there: a sorted file of raw
+digests, and a Bloom filter over them which answers "never uploaded" without
+touching the sorted file. The index is rebuilt from a listing of the
+destination when it's missing or too old, and uploaded digests are added to
+it after each batch. New files are uploaded in batches, several at a time.
+
+Listing a destination of millions of objects takes a long time, so bots can
+share the index (--shared_index): a bot whose own index is missing or too old
+downloads the shared one, and only lists the destination if that's too old
+as well, replacing the shared index afterwards. The listing is sorted in
+bounded runs on disk rather than in memory.
+
+Files whose names aren't <md5>.<ext> are always uploaded.
+
+Optionally (--pack), new files are instead concatenated into pack files of
+up to --pack_size_mb, so that a run uploads a few large objects rather than
+thousands of small ones. Each pack is named by its SHA1 and comes with an
+index, <sha1>.idx, listing the name, offset and size of each file in it; the
+index is uploaded after its pack. A packed destination is listed by reading
+its pack indices, which are cached in the index directory so that each is
+only downloaded once. Files in packs aren't at the destination under their
+own names, so a packed destination needs its own index directory. Nothing
+but extract_pack reads packs yet, so anything which needs the files, like
+Gold, must still get them unpacked.
+"""
+
+
+import argparse
+import binascii
+import fnmatch
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import multiprocessing.pool
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+
+DIGEST_SIZE = 16
+DIGEST_NAME_RE = re.compile(r'^([0-9a-f]{32})\.[A-Za-z0-9]+$')
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_JOBS = 4
+DEFAULT_MAX_AGE_HOURS = 24
+DEFAULT_PATTERNS = ['*.png', '*.pdf']
+DEFAULT_PACK_SIZE_MB = 64
+
+PACK_SUFFIX = '.pack'
+PACK_INDEX_SUFFIX = '.idx'
+CHUNK_SIZE = 1024 * 1024
+
+# Digests are sorted this many at a time (about 64MB of Python strings) when
+# rebuilding the index.
+SORT_RUN_SIZE = 1024 * 1024
+
+# The Bloom filter is sized for this false positive rate. False positives only
+# cost a lookup in the sorted digests.
+BLOOM_ERROR_RATE = 0.01
+
+
+def digest_of(name):
+  """Return the raw digest a file or object is named after, or None."""
+  m = DIGEST_NAME_RE.match(os.path.basename(name))
+  if m:
+    return binascii.unhexlify(m.group(1))
+  return None
+
+
+def _replace(tmp, dst):
+  if os.name == 'nt' and os.path.exists(dst):
+    os.remove(dst)
+  os.rename(tmp, dst)
+
+
+class GSStore(object):
+  """Uploads to and lists a Google Storage directory using gsutil."""
+
+  def __init__(self, url, gsutil='gsutil', extra_args=None):
+    self._url = url.rstrip('/') + '/'
+    self._gsutil = gsutil
+    self._extra_args = extra_args or []
+
+  def list_names(self):
+    """Yield the name of each object in the directory."""
+    proc = subprocess.Popen([self._gsutil, 'ls', self._url],
+                            stdout=subprocess.PIPE)
+    for line in proc.stdout:
+      line = line.strip()
+      if line and not line.endswith('/'):
+        yield line.rsplit('/', 1)[-1]
+    if proc.wait() != 0:
+      raise subprocess.CalledProcessError(proc.returncode, 'gsutil ls')
+
+  def upload(self, paths):
+    """Upload the given files into the directory."""
+    cmd = [self._gsutil, '-m', 'cp'] + self._extra_args + ['-I', self._url]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    proc.communicate(''.join(p + '\n' for p in paths))
+    if proc.returncode != 0:
+      raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
+
+  def read(self, name):
+    """Return the contents of the named object."""
+    return subprocess.check_output([self._gsutil, 'cat', self._url + name])
+
+  def download(self, names, dst_dir):
+    """Download the named objects into dst_dir. Return whether all existed."""
+    for name in names:
+      if subprocess.call([self._gsutil, '-q', 'cp', self._url + name,
+                          dst_dir]) != 0:
+        return False
+    return True
+
+
+class LocalStore(object):
+  """A local directory standing in for GSStore, eg. in tests."""
+
+  def __init__(self, root):
+    self.root = root
+    if not os.path.isdir(root):
+      os.makedirs(root)
+
+  def list_names(self):
+    return os.listdir(self.root)
+
+  def upload(self, paths):
+    for path in paths:
+      dst = os.path.join(self.root, os.path.basename(path))
+      shutil.copyfile(path, dst + '.tmp')
+      _replace(dst + '.tmp', dst)
+
+  def read(self, name):
+    with open(os.path.join(self.root, name), 'rb') as f:
+      return f.read()
+
+  def download(self, names, dst_dir):
+    for name in names:
+      if not os.path.isfile(os.path.join(self.root, name)):
+        return False
+      shutil.copyfile(os.path.join(self.root, name),
+                      os.path.join(dst_dir, name))
+    return True
+
+
+class BloomFilter(object):
+  """A Bloom filter over digests.
+
+  The digests are already uniformly distributed, so the bit positions are
+  derived from them directly by double hashing.
+  """
+
+  def __init__(self, num_bits, num_hashes, bits=None):
+    self.num_bits = num_bits
+    self.num_hashes = num_hashes
+    self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+  @classmethod
+  def for_capacity(cls, capacity, error_rate=BLOOM_ERROR_RATE):
+    capacity = max(capacity, 1024)
+    num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+    num_hashes = max(1, int(round(num_bits * math.log(2) / capacity)))
+    return cls(num_bits, num_hashes)
+
+  def _positions(self, digest):
+    h1, h2 = struct.unpack('<QQ', digest)
+    h2 |= 1
+    for i in xrange(self.num_hashes):
+      yield (h1 + i * h2) % self.num_bits
+
+  def add(self, digest):
+    for pos in self._positions(digest):
+      self.bits[pos >> 3] |= 1 << (pos & 7)
+
+  def __contains__(self, digest):
+    for pos in self._positions(digest):
+      if not self.bits[pos >> 3] & (1 << (pos & 7)):
+        return False
+    return True
+
+
+class DigestIndex(object):
+  """The digests known to be at the destination, kept in index_dir.
+
+  index_dir holds 'digests', the sorted raw digests; 'bloom', the Bloom
+  filter's bits; 'index.json', describing both and when the destination
+  was last listed; and 'packs', the indices of any packs.
+  """
+
+  DIGESTS = 'digests'
+  BLOOM = 'bloom'
+  INFO = 'index.json'
+
+  # Pack indices are cached in this subdirectory.
+  PACKS = 'packs'
+
+  def __init__(self, index_dir):
+    self.dir = index_dir
+    self._info = None
+    self._bloom = None
+    self._digests_file = None
+    self._digests = None
+
+  def _path(self, name):
+    return os.path.join(self.dir, name)
+
+  def load(self):
+    """Load the index, if there is one. Return whether there was."""
+    self.close()
+    try:
+      with open(self._path(self.INFO)) as f:
+        info = json.load(f)
+      with open(self._path(self.BLOOM), 'rb') as f:
+        bits = bytearray(f.read())
+      bloom = BloomFilter(info['bloom_bits'], info['bloom_hashes'], bits)
+      if (len(bits) != (bloom.num_bits + 7) // 8 or
+          os.path.getsize(self._path(self.DIGESTS)) !=
+          DIGEST_SIZE * info['count']):
+        return False
+    except (IOError, OSError, ValueError, KeyError):
+      return False
+    self._info = info
+    self._bloom = bloom
+    if info['count']:
+      self._digests_file = open(self._path(self.DIGESTS), 'rb')
+      self._digests = mmap.mmap(self._digests_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+    return True
+
+  def close(self):
+    if self._digests is not None:
+      self._digests.close()
+      self._digests_file.close()
+    self._digests = None
+    self._digests_file = None
+
+  def __len__(self):
+    return self._info['count'] if self._info else 0
+
+  def age(self):
+    """Seconds since the destination was last listed, or None."""
+    if not self._info:
+      return None
+    return time.time() - self._info['listed']
+
+  def _digest_at(self, i):
+    return self._digests[DIGEST_SIZE * i:DIGEST_SIZE * (i + 1)]
+
+  def __contains__(self, digest):
+    if not self._info or digest not in self._bloom:
+      return False
+    # A binary search of the mmapped digests, so that they're never all read.
+    lo = 0
+    hi = self._info['count']
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._digest_at(mid) < digest:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo < self._info['count'] and self._digest_at(lo) == digest
+
+  def _write(self, digests, capacity, listed):
+    """Replace the index with the given sorted digests.
+
+    Duplicates are dropped; capacity is at least the number of digests.
+    """
+    if not os.path.isdir(self.dir):
+      os.makedirs(self.dir)
+    # Leave room for the index to grow before the next rebuild.
+    bloom = BloomFilter.for_capacity(2 * capacity)
+    count = 0
+    last = None
+    tmp = self._path(self.DIGESTS + '.tmp')
+    with open(tmp, 'wb') as f:
+      for digest in digests:
+        if digest == last:
+          continue
+        f.write(digest)
+        bloom.add(digest)
+        count += 1
+        last = digest
+    self.close()
+    _replace(tmp, self._path(self.DIGESTS))
+    tmp = self._path(self.BLOOM + '.tmp')
+    with open(tmp, 'wb') as f:
+      f.write(bloom.bits)
+    _replace(tmp, self._path(self.BLOOM))
+    # index.json goes last, so that a partially written index fails to load.
+    tmp = self._path(self.INFO + '.tmp')
+    with open(tmp, 'w') as f:
+      json.dump({'count': count,
+                 'listed': listed,
+                 'bloom_bits': bloom.num_bits,
+                 'bloom_hashes': bloom.num_hashes}, f)
+    _replace(tmp, self._path(self.INFO))
+    self.load()
+
+  def rebuild(self, names):
+    """Replace the index with the digests of the given object names.
+
+    The digests are sorted SORT_RUN_SIZE at a time into temporary files,
+    which are then merged, so that a listing of millions of objects is never
+    all in memory.
+    """
+    listed = time.time()
+    runs = []
+    run = []
+    count = 0
+    try:
+      for name in names:
+        digest = digest_of(name)
+        if not digest:
+          continue
+        run.append(digest)
+        count += 1
+        if len(run) == SORT_RUN_SIZE:
+          run.sort()
+          f = tempfile.TemporaryFile()
+          runs.append(f)
+          f.writelines(run)
+          f.seek(0)
+          run = []
+      run.sort()
+      self._write(heapq.merge(run, *[_read_digests(f) for f in runs]), count,
+                  listed)
+    finally:
+      for f in runs:
+        f.close()
+
+  def add(self, digests):
+    """Add the given digests to the index."""
+    new = sorted(set(d for d in digests if d not in self))
+    if not new:
+      return
+    old = (self._digest_at(i) for i in xrange(len(self)))
+    self._write(heapq.merge(old, new), len(self) + len(new),
+                self._info['listed'] if self._info else 0)
+
+  def share(self, store):
+    """Upload the index to store, for other bots to fetch."""
+    # index.json goes last, as when writing the index.
+    store.upload([self._path(self.DIGESTS), self._path(self.BLOOM)])
+    store.upload([self._path(self.INFO)])
+
+  def fetch(self, store):
+    """Replace the index with the one shared in store, if it's complete and
+    more recent. Return whether it was.
+    """
+    tmp_dir = self.dir + '.shared'
+    if os.path.isdir(tmp_dir):
+      shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    try:
+      shared = DigestIndex(tmp_dir)
+      if (not store.download([self.INFO, self.DIGESTS, self.BLOOM], tmp_dir) or
+          not shared.load()):
+        return False
+      shared.close()
+      if self.load() and self.age() <= shared.age():
+        return False
+      self.close()
+      if not os.path.isdir(self.dir):
+        os.makedirs(self.dir)
+      # index.json goes last, as when writing the index.
+      for name in (self.DIGESTS, self.BLOOM, self.INFO):
+        _replace(os.path.join(tmp_dir, name), self._path(name))
+    finally:
+      shutil.rmtree(tmp_dir)
+    return self.load()
+
+
+def _read_digests(f):
+  """Yield the digests in a file written by DigestIndex.rebuild."""
+  for digest in iter(lambda: f.read(DIGEST_SIZE), ''):
+    yield digest
+
+
+def find_files(src_dir, patterns):
+  """Return the sorted paths of the files in src_dir matching patterns."""
+  return sorted(os.path.join(src_dir, name)
+                for name in os.listdir(src_dir)
+                if any(fnmatch.fnmatch(name, p) for p in patterns) and
+                os.path.isfile(os.path.join(src_dir, name)))
+
+
+def write_pack(paths, out_dir):
+  """Concatenate the given files into a pack in out_dir.
+
+  Returns the paths of the pack, <sha1>.pack, and of its index, <sha1>.idx.
+  """
+  fd, tmp = tempfile.mkstemp(dir=out_dir)
+  h = hashlib.sha1()
+  files = []
+  offset = 0
+  with os.fdopen(fd, 'wb') as out:
+    for path in paths:
+      size = 0
+      with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+          h.update(chunk)
+          out.write(chunk)
+          size += len(chunk)
+      files.append([os.path.basename(path), offset, size])
+      offset += size
+  name = h.hexdigest()
+  pack = os.path.join(out_dir, name + PACK_SUFFIX)
+  _replace(tmp, pack)
+  pack_index = os.path.join(out_dir, name + PACK_INDEX_SUFFIX)
+  with open(pack_index, 'w') as f:
+    json.dump({'pack': name + PACK_SUFFIX, 'files': files}, f)
+  return pack, pack_index
+
+
+def extract_pack(pack, pack_index, out_dir, names=None):
+  """Extract the files in a pack, or those of them in names, to out_dir."""
+  with open(pack_index) as f:
+    files = json.load(f)['files']
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+  with open(pack, 'rb') as f:
+    for name, offset, size in files:
+      if names is not None and name not in names:
+        continue
+      f.seek(offset)
+      with open(os.path.join(out_dir, name), 'wb') as out:
+        while size:
+          chunk = f.read(min(size, CHUNK_SIZE))
+          if not chunk:
+            raise IOError('%s is truncated' % pack)
+          out.write(chunk)
+          size -= len(chunk)
+
+
+def _packed_names(store, cache_dir):
+  """Yield the name of each file in each pack in store."""
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  for name in store.list_names():
+    if not name.endswith(PACK_INDEX_SUFFIX):
+      continue
+    # Packs are named by their contents, so a cached index is never stale.
+    cached = os.path.join(cache_dir, name)
+    if not os.path.isfile(cached):
+      with open(cached + '.tmp', 'wb') as f:
+        f.write(store.read(name))
+      _replace(cached + '.tmp', cached)
+    with open(cached) as f:
+      for member in json.load(f)['files']:
+        yield member[0]
+
+
+def _pack_batches(paths, pack_size):
+  """Split paths into lists of files totalling at most pack_size bytes."""
+  batches = []
+  batch = []
+  size = 0
+  for path in paths:
+    file_size = os.path.getsize(path)
+    if batch and size + file_size > pack_size:
+      batches.append(batch)
+      batch = []
+      size = 0
+    batch.append(path)
+    size += file_size
+  if batch:
+    batches.append(batch)
+  return batches
+
+
+def upload_new(paths, store, index, max_age_hours=DEFAULT_MAX_AGE_HOURS,
+               batch_size=DEFAULT_BATCH_SIZE, jobs=DEFAULT_JOBS, log=None,
+               pack=False, pack_size=DEFAULT_PACK_SIZE_MB * 1024 * 1024,
+               shared_index=None):
+  """Upload the files in paths which aren't in index to store.
+
+  The index is rebuilt from a listing of store first if it's missing or
+  older than max_age_hours, unless shared_index, a store holding an index
+  shared between bots, has one which is recent enough. A rebuilt index
+  replaces the shared one once the new files are uploaded. If pack is set,
+  the files are uploaded in packs of up to pack_size bytes, and store is
+  listed by reading its pack indices. Returns the paths which were uploaded.
+  """
+  log = log or (lambda msg: None)
+  pack_cache_dir = os.path.join(index.dir, DigestIndex.PACKS)
+  max_age = max_age_hours * 3600
+
+  def stale():
+    return not index.load() or index.age() > max_age
+
+  if stale() and shared_index:
+    log('Fetching the shared digest index.')
+    index.fetch(shared_index)
+  rebuilt = stale()
+  if rebuilt:
+    log('Listing the destination to rebuild the digest index.')
+    if pack:
+      index.rebuild(_packed_names(store, pack_cache_dir))
+    else:
+      index.rebuild(store.list_names())
+  log('%d digests at the destination.' % len(index))
+
+  new = []
+  seen = set()
+  for path in paths:
+    digest = digest_of(path)
+    if digest is None or (digest not in index and digest not in seen):
+      new.append(path)
+      if digest is not None:
+        seen.add(digest)
+  log('%d of %d files are new.' % (len(new), len(paths)))
+
+  if pack:
+    batches = _pack_batches(new, pack_size)
+    pack_dir = tempfile.mkdtemp()
+    if not os.path.isdir(pack_cache_dir):
+      os.makedirs(pack_cache_dir)
+  else:
+    batches = [new[i:i + batch_size]
+               for i in xrange(0, len(new), batch_size)]
+
+  def upload(batch):
+    if pack:
+      pack_file, pack_index = write_pack(batch, pack_dir)
+      try:
+        store.upload([pack_file])
+        store.upload([pack_index])
+      finally:
+        os.remove(pack_file)
+      # Cache the pack's index for the next rebuild.
+      _replace(pack_index, os.path.join(pack_cache_dir,
+                                        os.path.basename(pack_index)))
+    else:
+      store.upload(batch)
+    return batch
+
+  uploaded = []
+  pool = multiprocessing.pool.ThreadPool(jobs)
+  try:
+    for batch in pool.imap_unordered(upload, batches):
+      uploaded.extend(batch)
+      log('Uploaded %d of %d files.' % (len(uploaded), len(new)))
+  finally:
+    pool.terminate()
+    pool.join()
+    # Record whatever was uploaded, so that a retry doesn't upload it again.
+    index.add(d for d in (digest_of(p) for p in uploaded) if d)
+    index.close()
+    if pack:
+      shutil.rmtree(pack_dir)
+  if rebuilt and shared_index:
+    log('Sharing the rebuilt digest index.')
+    index.share(shared_index)
+  return uploaded
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('src_dir')
+  parser.add_argument('dst', help='gs://bucket/dir, or a local directory')
+  parser.add_argument('--index_dir', required=True,
+                      help='where to keep the digest index between runs')
+  parser.add_argument('--pattern', action='append', dest='patterns',
+                      help='upload files matching this pattern; default: %s'
+                           % ' '.join(DEFAULT_PATTERNS))
+  parser.add_argument('--max_age_hours', type=float,
+                      default=DEFAULT_MAX_AGE_HOURS,
+                      help='rebuild the index if it is older than this')
+  parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+  parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                      help='number of batches to upload at once')
+  parser.add_argument('--pack', action='store_true',
+                      help='upload new files to dst in packs; dst needs its '
+                           'own --index_dir')
+  parser.add_argument('--pack_size_mb', type=int,
+                      default=DEFAULT_PACK_SIZE_MB,
+                      help='maximum size of each pack')
+  parser.add_argument('--shared_index',
+                      help='gs:// or local directory holding a digest index '
+                           'shared between bots; dst needs its own')
+  parser.add_argument('--gsutil', default='gsutil')
+  parser.add_argument('--gsutil_arg', action='append', dest='gsutil_args',
+                      help='extra argument for "gsutil cp"')
+  args = parser.parse_args()
+
+  def open_store(url, extra_args=None):
+    if url.startswith('gs://'):
+      return GSStore(url, args.gsutil, extra_args)
+    return LocalStore(url)
+
+  store = open_store(args.dst, args.gsutil_args)
+  shared_index = open_store(args.shared_index) if args.shared_index else None
+
+  def log(msg):
+    print msg
+    sys.stdout.flush()
+
+  paths = find_files(args.src_dir, args.patterns or DEFAULT_PATTERNS)
+  upload_new(paths, store, DigestIndex(args.index_dir),
+             max_age_hours=args.max_age_hours, batch_size=args.batch_size,
+             jobs=args.jobs, log=log, pack=args.pack,
+             pack_size=args.pack_size_mb * 1024 * 1024,
+             shared_index=shared_index)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
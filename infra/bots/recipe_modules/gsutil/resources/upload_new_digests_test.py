@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Tests for upload_new_digests."""
+
+
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import precompress
+import upload_new_digests
+
+
+class _CountingStore(upload_new_digests.LocalStore):
+  """A LocalStore which records what it was asked to do."""
+
+  def __init__(self, root):
+    super(_CountingStore, self).__init__(root)
+    self.listings = 0
+    self.batches = []
+    self.fail_after = None
+
+  def list_names(self):
+    self.listings += 1
+    return super(_CountingStore, self).list_names()
+
+  def upload(self, paths):
+    if self.fail_after is not None and len(self.batches) >= self.fail_after:
+      raise IOError('upload failed')
+    self.batches.append(list(paths))
+    super(_CountingStore, self).upload(paths)
+
+
+class UploadNewDigestsTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'dm')
+    os.makedirs(self.src)
+    self.store = _CountingStore(os.path.join(self.tmp, 'gs'))
+    self.index_dir = os.path.join(self.tmp, 'index')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def write_images(self, contents, ext='png'):
+    """Write an image named by its MD5 for each of contents."""
+    paths = []
+    for c in contents:
+      path = os.path.join(self.src, '%s.%s' % (hashlib.md5(c).hexdigest(), ext))
+      with open(path, 'wb') as f:
+        f.write(c)
+      paths.append(path)
+    return sorted(paths)
+
+  def upload(self, store=None, index_dir=None, **kwargs):
+    paths = upload_new_digests.find_files(self.src, ['*.png', '*.pdf'])
+    index = upload_new_digests.DigestIndex(index_dir or self.index_dir)
+    return upload_new_digests.upload_new(paths, store or self.store, index,
+                                         **kwargs)
+
+  def test_bloom_filter(self):
+    bloom = upload_new_digests.BloomFilter.for_capacity(1000)
+    added = [hashlib.md5(str(i)).digest() for i in xrange(1000)]
+    for d in added:
+      bloom.add(d)
+    for d in added:
+      self.assertIn(d, bloom)
+    others = [hashlib.md5('x%d' % i).digest() for i in xrange(10000)]
+    false_positives = sum(1 for d in others if d in bloom)
+    self.assertLess(false_positives, 300)
+
+  def test_upload_only_new(self):
+    first = self.write_images(['a', 'b', 'c'])
+    self.assertEqual(self.upload(), first)
+    self.assertEqual(self.store.listings, 1)
+    self.assertEqual(sorted(os.listdir(self.store.root)),
+                     sorted(os.path.basename(p) for p in first))
+
+    # Only the new image is uploaded, without listing the store again.
+    second = self.write_images(['d'], ext='pdf')
+    self.assertEqual(self.upload(), second)
+    self.assertEqual(self.store.listings, 1)
+    self.assertEqual(self.upload(), [])
+    self.assertEqual(len(self.store.batches), 2)
+
+  def test_index_refreshed_from_listing(self):
+    # Images uploaded by another bot are picked up when the index is rebuilt.
+    paths = self.write_images(['a', 'b'])
+    self.store.upload(paths[:1])
+    self.assertEqual(self.upload(), paths[1:])
+
+    self.store.upload(self.write_images(['c']))
+    self.store.batches = []
+    self.assertEqual(self.upload(max_age_hours=0), [])
+    self.assertEqual(self.store.listings, 2)
+
+  def test_corrupt_index(self):
+    self.write_images(['a'])
+    self.upload()
+    with open(os.path.join(self.index_dir, 'digests'), 'ab') as f:
+      f.write('garbage')
+    self.assertEqual(self.upload(), [])
+    self.assertEqual(self.store.listings, 2)
+
+  def test_rebuild_in_runs(self):
+    digests = [hashlib.md5(str(i)).digest() for i in xrange(20)]
+    names = ['%s.png' % d.encode('hex') for d in digests]
+    old = upload_new_digests.SORT_RUN_SIZE
+    upload_new_digests.SORT_RUN_SIZE = 3
+    try:
+      index = upload_new_digests.DigestIndex(self.index_dir)
+      index.rebuild(names + names[:5] + ['other.png'])
+    finally:
+      upload_new_digests.SORT_RUN_SIZE = old
+    self.assertEqual(len(index), 20)
+    with open(os.path.join(self.index_dir, 'digests'), 'rb') as f:
+      self.assertEqual(f.read(), ''.join(sorted(digests)))
+    for d in digests:
+      self.assertIn(d, index)
+    self.assertNotIn(hashlib.md5('x').digest(), index)
+    index.close()
+
+  def test_shared_index(self):
+    shared = _CountingStore(os.path.join(self.tmp, 'shared'))
+    paths = self.write_images(['a', 'b'])
+    self.store.upload(paths[:1])
+    self.assertEqual(self.upload(shared_index=shared), paths[1:])
+    self.assertEqual(self.store.listings, 1)
+    self.assertEqual(sorted(os.listdir(shared.root)),
+                     ['bloom', 'digests', 'index.json'])
+
+    # Another bot fetches the shared index, which includes what the first
+    # bot uploaded, rather than listing the store.
+    other_index = os.path.join(self.tmp, 'other_index')
+    self.assertEqual(self.upload(index_dir=other_index, shared_index=shared),
+                     [])
+    self.assertEqual(self.store.listings, 1)
+    self.store.upload(self.write_images(['c']))
+
+    # Once the shared index is too old, the store is listed and the shared
+    # index replaced.
+    shared.batches = []
+    self.assertEqual(self.upload(shared_index=shared, max_age_hours=0), [])
+    self.assertEqual(self.store.listings, 2)
+    self.assertEqual(len(shared.batches), 2)
+
+  def test_batches(self):
+    paths = self.write_images([str(i) for i in xrange(25)])
+    self.assertEqual(sorted(self.upload(batch_size=10, jobs=3)), paths)
+    self.assertEqual(sorted(len(b) for b in self.store.batches), [5, 10, 10])
+
+  def test_failed_batch_is_retried(self):
+    paths = self.write_images([str(i) for i in xrange(25)])
+    self.store.fail_after = 1
+    with self.assertRaises(IOError):
+      self.upload(batch_size=10, jobs=1)
+    # The batch which made it isn't uploaded again.
+    self.store.fail_after = None
+    retried = self.upload(batch_size=10, jobs=1)
+    self.assertEqual(sorted(self.store.batches[0] + retried), paths)
+
+  def test_packs(self):
+    pack_store = _CountingStore(os.path.join(self.tmp, 'packs'))
+    paths = self.write_images([str(i) * 100 for i in xrange(10)])
+    self.assertEqual(sorted(self.upload(pack_store, pack=True, pack_size=300)),
+                     paths)
+    # Each pack and then its index, three files to a pack.
+    names = sorted(os.listdir(pack_store.root))
+    self.assertEqual(len(pack_store.batches), 8)
+    self.assertEqual(len(names), 8)
+    self.assertEqual(self.upload(pack_store, pack=True), [])
+
+    # Unpacking gives the original files.
+    out = os.path.join(self.tmp, 'out')
+    for name in names:
+      if name.endswith(upload_new_digests.PACK_SUFFIX):
+        self.assertEqual(name[:-len(upload_new_digests.PACK_SUFFIX)],
+                         hashlib.sha1(pack_store.read(name)).hexdigest())
+        upload_new_digests.extract_pack(
+            os.path.join(pack_store.root, name),
+            os.path.join(pack_store.root,
+                         name.replace(upload_new_digests.PACK_SUFFIX,
+                                      upload_new_digests.PACK_INDEX_SUFFIX)),
+            out)
+    self.assertEqual(sorted(os.listdir(out)),
+                     sorted(os.path.basename(p) for p in paths))
+    for path in paths:
+      with open(path, 'rb') as a, open(
+          os.path.join(out, os.path.basename(path)), 'rb') as b:
+        self.assertEqual(a.read(), b.read())
+
+  def test_index_rebuilt_from_packs(self):
+    pack_store = _CountingStore(os.path.join(self.tmp, 'packs'))
+    self.write_images(['a', 'b'])
+    self.upload(pack_store, pack=True)
+    pack_store.batches = []
+    # Another bot uploads a pack holding an image which this bot then makes.
+    other = os.path.join(self.tmp, 'other')
+    os.makedirs(other)
+    path = self.write_images(['c'])[0]
+    pack, pack_index = upload_new_digests.write_pack([path], other)
+    pack_store.upload([pack, pack_index])
+    shutil.rmtree(self.index_dir)
+    self.assertEqual(self.upload(pack_store, pack=True), [])
+
+  def test_packs_not_counted_as_uploaded(self):
+    # Images which were only packed are still uploaded as files, since a
+    # packed destination keeps its own index.
+    pack_store = _CountingStore(os.path.join(self.tmp, 'packs'))
+    paths = self.write_images(['a', 'b'])
+    self.upload(pack_store, os.path.join(self.tmp, 'pack_index'), pack=True)
+    self.assertEqual(self.upload(), paths)
+    self.assertEqual(sorted(os.listdir(self.store.root)),
+                     sorted(os.path.basename(p) for p in paths))
+
+  def test_precompress(self):
+    path = os.path.join(self.tmp, 'dm.json')
+    contents = '{"results": []}\n' * 1000
+    with open(path, 'wb') as f:
+      f.write(contents)
+    precompress.compress_all([path], jobs=2)
+    with gzip.open(path, 'rb') as f:
+      self.assertEqual(f.read(), contents)
+    self.assertLess(os.path.getsize(path), len(contents))
+
+  def test_not_named_by_digest(self):
+    with open(os.path.join(self.src, 'other.png'), 'wb') as f:
+      f.write('other')
+    self.upload()
+    self.assertEqual(len(self.upload()), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -394,6 +394,9 @@ class SwarmingApi(recipe_api.RecipeApi):
               links that will be included in the buildbot output.
           "args": an optional list of additional arguments to pass to the
               above script.
+          "incremental": if True, merge the outputs of finished shards while
+              the others are still running. The script must then accept its
+              own output as one of the files to merge.
     """
     if idempotent is None:
       idempotent = self.default_idempotent
@@ -624,6 +627,8 @@ class SwarmingApi(recipe_api.RecipeApi):
       '--merge-script', merge_script,
       '--merge-additional-args', self.m.json.dumps(merge_args),
     ])
+    if task.merge.get('incremental'):  # pragma: no cover
+      task_args.append('--incremental-merge')
 
     if task.build_properties:  # pragma: no cover
       properties = dict(task.build_properties)
@@ -852,6 +857,9 @@ class SwarmingTask(object):
               collected outputs from the tasks.
           "args": an optional list of additional arguments to pass to the
               above script.
+          "incremental": if True, merge the outputs of finished shards while
+              the others are still running. The script must then accept its
+              own output as one of the files to merge.
     """
     self._trigger_output = None
     self.build_properties = build_properties
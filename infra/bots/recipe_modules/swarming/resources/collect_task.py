@@ -7,13 +7,100 @@ import argparse
 import json
 import logging
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
+
+
+# How often to look for newly finished shards when merging incrementally.
+POLL_INTERVAL_SECONDS = 5
+
+
+def _list_task_output_dir(task_output_dir):
+  return [os.path.join(task_output_dir, p)
+          for p in os.listdir(task_output_dir)]
+
+
+def _shard_json_files(task_output_dir):
+  """Return the output.json paths of the shards seen so far."""
+  try:
+    contents = _list_task_output_dir(task_output_dir)
+  except (OSError, IOError):
+    return []
+  return [os.path.join(p, 'output.json') for p in contents if os.path.isdir(p)]
+
+
+def _run_merge(merge_script, build_properties, merge_arguments,
+               summary_json_file, output_json, shard_json_files):
+  merge_cmd = [sys.executable, merge_script]
+  if build_properties:
+    merge_cmd.extend(('--build-properties', build_properties))
+  if summary_json_file:
+    merge_cmd.extend(('--summary-json', summary_json_file))
+  if merge_arguments:
+    merge_cmd.extend(json.loads(merge_arguments))
+  merge_cmd.extend(('-o', output_json))
+  merge_cmd.extend(shard_json_files)
+
+  logging.info('merge_cmd: %s', ' '.join(merge_cmd))
+  return subprocess.call(merge_cmd)
+
+
+def _collect_and_merge_incrementally(
+    collect_cmd, merge_script, build_properties, merge_arguments,
+    task_output_dir, partial_dir):
+  """Run collect_cmd, merging shard results as they are downloaded.
+
+  Every POLL_INTERVAL_SECONDS, the shards whose output.json appeared and then
+  stopped changing are merged into the results merged so far, by running
+  merge_script over the previous partial result plus the new shards. If a
+  merge fails, merging stops, leaving the remaining shards to the final merge.
+
+  Returns:
+    (collect_cmd exit code, path of the latest partial result or None,
+     set of shard JSON files merged into it)
+  """
+  collect_proc = subprocess.Popen(collect_cmd)
+  partial = None
+  merged = set()
+  last_seen = {}
+  while collect_proc.poll() is None:
+    time.sleep(POLL_INTERVAL_SECONDS)
+    ready = []
+    for f in _shard_json_files(task_output_dir):
+      if f in merged:
+        continue
+      try:
+        st = os.stat(f)
+      except OSError:
+        continue
+      seen = (st.st_size, st.st_mtime)
+      if st.st_size and last_seen.get(f) == seen:
+        ready.append(f)
+      last_seen[f] = seen
+    if not ready:
+      continue
+
+    new_partial = os.path.join(partial_dir, 'partial_%d.json' % len(merged))
+    inputs = ([partial] if partial else []) + sorted(ready)
+    result = _run_merge(merge_script, build_properties, merge_arguments, None,
+                        new_partial, inputs)
+    if result != 0 or not os.path.exists(new_partial):
+      # Retrying would most likely fail the same way, on ever more shards.
+      logging.warn('Incremental merge had non-zero return code: %s; leaving '
+                   'the remaining shards to the final merge.', result)
+      break
+    partial = new_partial
+    merged.update(ready)
+    logging.info('Merged %d of the shards so far.', len(merged))
+  return collect_proc.wait(), partial, merged
 
 
 def collect_task(
     collect_cmd, merge_script, build_properties, merge_arguments,
-    task_output_dir, output_json):
+    task_output_dir, output_json, incremental=False):
   """Collect and merge the results of a task.
 
   This is a relatively thin wrapper script around a `swarming.py collect`
@@ -48,6 +135,11 @@ def collect_task(
       and may optionally contain a top level "links" field that may contain a
       dict mapping link text to URLs, for a set of links that will be included
       in the buildbot output.
+    incremental: If True, merge the results of shards that have finished while
+      collect_cmd is still waiting for the rest, so that only the last shards
+      remain to be merged once it exits. The merge script must accept its own
+      output as one of the shard JSONs (results_merger based scripts do), and
+      is only passed the summary JSON for the final merge.
   Returns:
     The exit code of collect_cmd or merge_cmd.
   """
@@ -66,15 +158,23 @@ def collect_task(
   collect_cmd.extend(['--task-output-dir', task_output_dir])
 
   logging.info('collect_cmd: %s', ' '.join(collect_cmd))
-  collect_result = subprocess.call(collect_cmd)
+  partial_dir = None
+  partial = None
+  merged = set()
+  if incremental:
+    # Not in task_output_dir, where it would look like a shard.
+    partial_dir = tempfile.mkdtemp(prefix='collect_task')
+    collect_result, partial, merged = _collect_and_merge_incrementally(
+        collect_cmd, merge_script, build_properties, merge_arguments,
+        task_output_dir, partial_dir)
+  else:
+    collect_result = subprocess.call(collect_cmd)
   if collect_result != 0:
     logging.warn('collect_cmd had non-zero return code: %s', collect_result)
 
   task_output_dir_contents = []
   try:
-    task_output_dir_contents.extend(
-        os.path.join(task_output_dir, p)
-        for p in os.listdir(task_output_dir))
+    task_output_dir_contents.extend(_list_task_output_dir(task_output_dir))
   except (OSError, IOError) as e:
     logging.error('Error while processing task_output_dir: %s', e)
 
@@ -108,23 +208,22 @@ def collect_task(
   logging.debug('Found shard_json_files: %r', shard_json_files)
 
   summary_json_file = os.path.join(task_output_dir, 'summary.json')
-
-  merge_result = 0
-
-  merge_cmd = [sys.executable, merge_script]
-  if build_properties:
-    merge_cmd.extend(('--build-properties', build_properties))
-  if os.path.exists(summary_json_file):
-    merge_cmd.extend(('--summary-json', summary_json_file))
-  else:
+  if not os.path.exists(summary_json_file):
     logging.warn('Summary json file missing: %r', summary_json_file)
-  if merge_arguments:
-    merge_cmd.extend(json.loads(merge_arguments))
-  merge_cmd.extend(('-o', output_json))
-  merge_cmd.extend(extant_shard_json_files)
+    summary_json_file = None
 
-  logging.info('merge_cmd: %s', ' '.join(merge_cmd))
-  merge_result = subprocess.call(merge_cmd)
+  if partial:
+    logging.info('%d shards were merged while collecting.', len(merged))
+    extant_shard_json_files = [partial] + [
+        f for f in extant_shard_json_files if f not in merged]
+
+  try:
+    merge_result = _run_merge(merge_script, build_properties, merge_arguments,
+                              summary_json_file, output_json,
+                              extant_shard_json_files)
+  finally:
+    if partial_dir:
+      shutil.rmtree(partial_dir, ignore_errors=True)
   if merge_result != 0:
     logging.warn('merge_cmd had non-zero return code: %s', merge_result)
 
@@ -142,6 +241,9 @@ def main():
   parser.add_argument('--merge-script', required=True)
   parser.add_argument('--task-output-dir', required=True)
   parser.add_argument('-o', '--output-json', required=True)
+  parser.add_argument('--incremental-merge', action='store_true',
+                      help='merge the results of finished shards while '
+                           'waiting for the others')
   parser.add_argument('--verbose', action='store_true')
   parser.add_argument('collect_cmd', nargs='+')
 
@@ -152,7 +254,7 @@ def main():
   return collect_task(
       args.collect_cmd,
       args.merge_script, args.build_properties, args.merge_additional_args,
-      args.task_output_dir, args.output_json)
+      args.task_output_dir, args.output_json, args.incremental_merge)
 
 
 if __name__ == '__main__':
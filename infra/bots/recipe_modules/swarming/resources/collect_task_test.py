@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Tests for collect_task's incremental merging."""
+
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import collect_task
+
+
+# Stands in for `swarming.py collect`: writes shards 0 and 1, then shard 2 a
+# while later, then the summary.
+FAKE_COLLECT = r'''
+import json, os, sys, time
+out = sys.argv[sys.argv.index('--task-output-dir') + 1]
+def shard(i):
+  os.makedirs(os.path.join(out, str(i)))
+  with open(os.path.join(out, str(i), 'output.json'), 'w') as f:
+    json.dump({'shards': [i]}, f)
+shard(0)
+shard(1)
+time.sleep(1)
+shard(2)
+with open(os.path.join(out, 'summary.json'), 'w') as f:
+  json.dump({'shards': [{}, {}, {}]}, f)
+'''
+
+# Stands in for a merge script: the union of its inputs' shards, which fails
+# if $FAIL_INCREMENTAL_MERGE is set and there's no summary. Each run's
+# arguments are appended to $MERGE_LOG.
+FAKE_MERGE = r'''
+import json, os, sys
+args = sys.argv[1:]
+with open(os.environ['MERGE_LOG'], 'a') as f:
+  f.write(json.dumps(args) + '\n')
+summary = None
+if '--summary-json' in args:
+  summary = args.pop(args.index('--summary-json') + 1)
+  args.remove('--summary-json')
+if os.environ.get('FAIL_INCREMENTAL_MERGE') and not summary:
+  sys.exit(1)
+output = args.pop(args.index('-o') + 1)
+args.remove('-o')
+shards = set()
+for path in args:
+  with open(path) as f:
+    shards.update(json.load(f)['shards'])
+with open(output, 'w') as f:
+  json.dump({'shards': sorted(shards), 'summary': bool(summary)}, f)
+'''
+
+
+class CollectTaskTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.collect = os.path.join(self.tmp, 'collect.py')
+    with open(self.collect, 'w') as f:
+      f.write(FAKE_COLLECT)
+    self.merge = os.path.join(self.tmp, 'merge.py')
+    with open(self.merge, 'w') as f:
+      f.write(FAKE_MERGE)
+    self.merge_log = os.path.join(self.tmp, 'merge_log')
+    self.output_json = os.path.join(self.tmp, 'output.json')
+    self.task_output_dir = os.path.join(self.tmp, 'task_output')
+    self.old_environ = dict(os.environ)
+    os.environ['MERGE_LOG'] = self.merge_log
+    self.old_interval = collect_task.POLL_INTERVAL_SECONDS
+    collect_task.POLL_INTERVAL_SECONDS = 0.05
+
+  def tearDown(self):
+    collect_task.POLL_INTERVAL_SECONDS = self.old_interval
+    os.environ.clear()
+    os.environ.update(self.old_environ)
+    shutil.rmtree(self.tmp)
+
+  def run_collect_task(self, incremental=True):
+    result = collect_task.collect_task(
+        [sys.executable, self.collect], self.merge, None, None,
+        self.task_output_dir, self.output_json, incremental)
+    with open(self.output_json) as f:
+      output = json.load(f)
+    with open(self.merge_log) as f:
+      merges = [json.loads(line) for line in f]
+    return result, output, merges
+
+  def shard_inputs(self, args):
+    return sorted(os.path.basename(os.path.dirname(a)) for a in args
+                  if a.startswith(self.task_output_dir) and
+                  a.endswith('output.json'))
+
+  def test_not_incremental(self):
+    result, output, merges = self.run_collect_task(incremental=False)
+    self.assertEqual(result, 0)
+    self.assertEqual(output, {'shards': [0, 1, 2], 'summary': True})
+    self.assertEqual(len(merges), 1)
+
+  def test_incremental(self):
+    result, output, merges = self.run_collect_task()
+    self.assertEqual(result, 0)
+    self.assertEqual(output, {'shards': [0, 1, 2], 'summary': True})
+    # Shards 0 and 1 are merged while waiting for shard 2, which is merged
+    # into their partial result with the summary once collect exits.
+    self.assertEqual(self.shard_inputs(merges[0]), ['0', '1'])
+    self.assertNotIn('--summary-json', merges[0])
+    self.assertIn('--summary-json', merges[-1])
+    self.assertNotIn('0', self.shard_inputs(merges[-1]))
+
+  def test_failed_incremental_merge(self):
+    os.environ['FAIL_INCREMENTAL_MERGE'] = '1'
+    result, output, merges = self.run_collect_task()
+    self.assertEqual(result, 0)
+    self.assertEqual(output, {'shards': [0, 1, 2], 'summary': True})
+    # Merging isn't retried after the failure; every shard is left to the
+    # final merge.
+    self.assertEqual(len(merges), 2)
+    self.assertEqual(self.shard_inputs(merges[1]), ['0', '1', '2'])
+
+
+if __name__ == '__main__':
+  unittest.main()
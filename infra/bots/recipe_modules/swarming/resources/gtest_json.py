@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Reads gtest JSON output for standard_gtest_merge.
+
+Nothing here needs the build scripts, so these can be tested on their own.
+"""
+
+import base64
+import json
+import os
+import re
+
+
+def index_shard_jsons(jsons_to_merge):
+  """Returns a dict mapping shard index strings to their output.json paths."""
+  # 'output.json' is set in swarming/api.py, gtest_task method.
+  shard_jsons = {}
+  for j in jsons_to_merge:
+    if os.path.basename(j) == 'output.json':
+      index = os.path.basename(os.path.dirname(j))
+      shard_jsons.setdefault(index, []).append(j)
+  return shard_jsons
+
+
+TRUNCATED_MSG = '\n<truncated %d bytes>\n'
+
+
+def truncate_snippets(runs, max_bytes):
+  """Truncates the output snippets of a test's runs to max_bytes."""
+  for run in runs:
+    snippet = run.get('output_snippet')
+    if snippet and len(snippet) > max_bytes:
+      run['output_snippet'] = snippet[:max_bytes] + (
+          TRUNCATED_MSG % (len(snippet) - max_bytes))
+    snippet = run.get('output_snippet_base64')
+    if snippet and len(snippet) > max_bytes:
+      # Cut on a 4 character boundary, so the base64 remains valid.
+      cut = max_bytes - max_bytes % 4
+      run['output_snippet_base64'] = snippet[:cut] + base64.b64encode(
+          TRUNCATED_MSG % ((len(snippet) - cut) * 3 / 4))
+  return runs
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER = re.compile(r'[-+.0-9eE]*')
+
+
+class JsonStream(object):
+  """Decodes a JSON document a piece at a time from a file.
+
+  The caller walks the outer objects and arrays with items() and elements(),
+  and decodes whatever it wants to keep whole with value(). Only the current
+  piece is buffered. head is whatever the caller has already read from f.
+  """
+
+  CHUNK_SIZE = 1024 * 1024
+
+  def __init__(self, f, head=''):
+    self._f = f
+    self._buf = head
+    self._pos = 0
+    self._eof = False
+    self._decoder = json.JSONDecoder()
+
+  def _fill(self):
+    # Read at least as much as is buffered, so that a huge value takes a
+    # logarithmic number of decoding attempts.
+    chunk = self._f.read(max(self.CHUNK_SIZE, len(self._buf) - self._pos))
+    if not chunk:
+      self._eof = True
+      return False
+    self._buf = self._buf[self._pos:] + chunk
+    self._pos = 0
+    return True
+
+  def peek(self):
+    """Returns the next non-whitespace character, or '' at the end."""
+    while True:
+      self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+      if self._pos < len(self._buf):
+        return self._buf[self._pos]
+      if not self._fill():
+        return ''
+
+  def expect(self, c):
+    if self.peek() != c:
+      raise ValueError('Expected %r, found %r' % (c, self.peek()))
+    self._pos += 1
+
+  def value(self):
+    """Decodes the next complete value."""
+    self.peek()
+    while True:
+      # A number running up to the end of the buffer, eg. '1.' of '1.25', may
+      # continue in the next chunk, so only decode it once something follows.
+      if (self._eof or _NUMBER.match(self._buf, self._pos).end() <
+          len(self._buf)):
+        try:
+          value, end = self._decoder.raw_decode(self._buf, self._pos)
+          self._pos = end
+          return value
+        except ValueError:
+          if self._eof:
+            raise
+      self._fill()
+
+  def items(self):
+    """Yields the keys of an object; the caller must consume each value."""
+    self.expect('{')
+    if self.peek() == '}':
+      self._pos += 1
+      return
+    while True:
+      key = self.value()
+      self.expect(':')
+      yield key
+      if self.peek() != ',':
+        break
+      self._pos += 1
+    self.expect('}')
+
+  def elements(self):
+    """Yields once per array element; the caller must consume each one."""
+    self.expect('[')
+    if self.peek() == ']':
+      self._pos += 1
+      return
+    while True:
+      yield
+      if self.peek() != ',':
+        break
+      self._pos += 1
+    self.expect(']')
+
+
+def load_json_incrementally(f, max_snippet_bytes=None):
+  """Loads gtest JSON output, one test result at a time.
+
+  Equivalent to json.load (followed by truncate_snippets), but the whole file
+  is never in memory at once: with max_snippet_bytes set, memory use is
+  bounded by the truncated results.
+  """
+  stream = JsonStream(f)
+  data = {}
+  for key in stream.items():
+    if key == 'per_iteration_data':
+      iterations = data[key] = []
+      for _ in stream.elements():
+        iteration = {}
+        for test in stream.items():
+          runs = stream.value()
+          if max_snippet_bytes is not None:
+            truncate_snippets(runs, max_snippet_bytes)
+          iteration[test] = runs
+        iterations.append(iteration)
+    else:
+      data[key] = stream.value()
+  if stream.peek():
+    raise ValueError('Extra data after the JSON document')
+  return data
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Tests for gtest_json."""
+
+import base64
+import json
+import StringIO
+import unittest
+
+import gtest_json
+
+
+OUTPUT = {
+  'all_tests': ['A.a', 'A.b', 'B.a'],
+  'disabled_tests': [],
+  'global_tags': ['CPU_64_BITS'],
+  'per_iteration_data': [
+    {
+      'A.a': [{'elapsed_time_ms': 1.25, 'losless_snippet': True,
+               'output_snippet': 'ok\n' * 10, 'status': 'SUCCESS'}],
+      'A.b': [{'elapsed_time_ms': 10, 'output_snippet': u'\u2713',
+               'output_snippet_base64': base64.b64encode('x' * 30),
+               'status': 'FAILURE'},
+              {'elapsed_time_ms': -3.5e-2, 'status': 'SUCCESS'}],
+    },
+    {'B.a': [{'elapsed_time_ms': 123456789, 'status': 'SKIPPED'}]},
+  ],
+  'test_locations': None,
+  'seconds_since_epoch': 1500000000.125,
+}
+
+
+class GtestJsonTest(unittest.TestCase):
+  def load(self, text, chunk_size, max_snippet_bytes=None):
+    old = gtest_json.JsonStream.CHUNK_SIZE
+    gtest_json.JsonStream.CHUNK_SIZE = chunk_size
+    try:
+      return gtest_json.load_json_incrementally(
+          StringIO.StringIO(text), max_snippet_bytes)
+    finally:
+      gtest_json.JsonStream.CHUNK_SIZE = old
+
+  def test_load_over_chunk_sizes(self):
+    for text in (json.dumps(OUTPUT), json.dumps(OUTPUT, indent=2)):
+      # Every chunk size up to the length of the longest number, so that each
+      # number gets cut at each of its characters.
+      for chunk_size in range(1, 20) + [len(text)]:
+        self.assertEqual(self.load(text, chunk_size), OUTPUT,
+                         'chunk size %d' % chunk_size)
+
+  def test_load_number_at_end(self):
+    for chunk_size in range(1, 5):
+      self.assertEqual(self.load('{"a": 1.25}', chunk_size), {'a': 1.25})
+
+  def test_load_truncates_snippets(self):
+    expected = json.loads(json.dumps(OUTPUT))
+    for iteration in expected['per_iteration_data']:
+      for runs in iteration.itervalues():
+        gtest_json.truncate_snippets(runs, 8)
+    self.assertEqual(self.load(json.dumps(OUTPUT), 7, 8), expected)
+
+  def test_load_invalid(self):
+    for text in ('', '{"a": 1', '{"a": 1}}', '{"a" 1}', '[]'):
+      with self.assertRaises(ValueError):
+        self.load(text, 3)
+
+  def test_truncate_snippets(self):
+    runs = [{'output_snippet': 'abcdefghij',
+             'output_snippet_base64': base64.b64encode('0123456789')},
+            {'output_snippet': 'short'},
+            {}]
+    gtest_json.truncate_snippets(runs, 6)
+    self.assertEqual(runs[0]['output_snippet'],
+                     'abcdef' + gtest_json.TRUNCATED_MSG % 4)
+    # The base64 is cut to 4 characters, which decode to 3 bytes.
+    self.assertEqual(base64.b64decode(runs[0]['output_snippet_base64']),
+                     '012' + gtest_json.TRUNCATED_MSG % 9)
+    self.assertEqual(runs[1], {'output_snippet': 'short'})
+    self.assertEqual(runs[2], {})
+
+  def test_index_shard_jsons(self):
+    self.assertEqual(
+        gtest_json.index_shard_jsons([
+            '/out/0/output.json',
+            '/out/1/output.json',
+            '/out/1/other.json',
+            '/out/2/output.json',
+            '/dup/2/output.json',
+        ]),
+        {'0': ['/out/0/output.json'],
+         '1': ['/out/1/output.json'],
+         '2': ['/out/2/output.json', '/dup/2/output.json']})
+
+
+if __name__ == '__main__':
+  unittest.main()
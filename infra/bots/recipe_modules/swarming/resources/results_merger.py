@@ -4,6 +4,7 @@
 
 import copy
 import json
+import multiprocessing
 import sys
 
 # These fields must appear in the test result output
@@ -58,11 +59,17 @@ def merge_test_results(shard_results_list):
     a dictionary that represent the merged results. Its format follow the same
     format of all results in |shard_results_list|.
   """
+  return _merge_test_results(shard_results_list, copy_inputs=True)
+
+
+def _merge_test_results(shard_results_list, copy_inputs):
+  # Merging consumes the shard results, so unless the caller is done with them
+  # they must be copied first.
   if not shard_results_list:
     return {}
 
   if 'seconds_since_epoch' in shard_results_list[0]:
-    return _merge_json_test_result_format(shard_results_list)
+    return _merge_json_test_result_format(shard_results_list, copy_inputs)
   else:
     return _merge_simplified_json_format(shard_results_list)
 
@@ -94,7 +101,7 @@ def _merge_simplified_json_format(shard_results_list):
   return merged_results
 
 
-def _merge_json_test_result_format(shard_results_list):
+def _merge_json_test_result_format(shard_results_list, copy_inputs=True):
   # This code is specialized to the Chromium JSON test results format version 3:
   # https://www.chromium.org/developers/the-json-test-results-format
 
@@ -109,11 +116,9 @@ def _merge_json_test_result_format(shard_results_list):
   }
 
   # To make sure that we don't mutate existing shard_results_list.
-  shard_results_list = copy.deepcopy(shard_results_list)
+  if copy_inputs:
+    shard_results_list = copy.deepcopy(shard_results_list)
   for result_json in shard_results_list:
-    # TODO(tansell): check whether this deepcopy is actually neccessary.
-    result_json = copy.deepcopy(result_json)
-
     # Check the version first
     version = result_json.pop('version', -1)
     if version != 3:
@@ -261,16 +266,93 @@ def merge_value(source, dest, key, merge_func):
   del source[key]
 
 
+def _load_json(path):
+  with open(path) as f:
+    return json.load(f)
+
+
+def _merge_file_chunk(paths):
+  """Loads and merges the results in |paths|. Runs in a pool worker."""
+  return _merge_test_results([_load_json(p) for p in paths], copy_inputs=False)
+
+
+def _merge_pair(pair):
+  """Merges two partial results. Runs in a pool worker."""
+  return _merge_test_results(list(pair), copy_inputs=False)
+
+
+# Below this many files, merging in-process beats starting a pool.
+MIN_FILES_FOR_POOL = 8
+
+
+def merge_files(paths, jobs=None):
+  """ Merges the results in the JSON files |paths|.
+
+  The files are split into one chunk per job. Each worker of a process pool
+  parses and merges one chunk, then the partial results are merged pairwise
+  (in order, so list results are concatenated in file order) until one is
+  left. Shard results are never copied, unlike with merge_test_results.
+
+  Args:
+    paths: list of JSON files to merge, as accepted by merge_test_results.
+    jobs: number of worker processes; defaults to the number of CPUs.
+
+  Returns:
+    the merged results, as returned by merge_test_results.
+  """
+  jobs = min(jobs or multiprocessing.cpu_count(), len(paths))
+  if len(paths) < MIN_FILES_FOR_POOL or jobs < 2:
+    return _merge_file_chunk(paths)
+
+  # Contiguous chunks, to preserve file order.
+  chunk_size = (len(paths) + jobs - 1) / jobs
+  chunks = [paths[i:i + chunk_size] for i in xrange(0, len(paths), chunk_size)]
+  pool = multiprocessing.Pool(jobs)
+  try:
+    results = pool.map(_merge_file_chunk, chunks)
+    while len(results) > 1:
+      pairs = zip(results[0::2], results[1::2])
+      odd = results[-1:] if len(results) % 2 else []
+      results = pool.map(_merge_pair, pairs) + odd
+  finally:
+    pool.terminate()
+    pool.join()
+  return results[0]
+
+
+def dump_test_results(results, f):
+  """ Writes |results| to |f| as JSON, one test subtree at a time.
+
+  This avoids building the whole JSON string in memory, while still encoding
+  each piece with the fast one-shot encoder.
+  """
+  f.write('{')
+  for i, (key, value) in enumerate(results.iteritems()):
+    if i:
+      f.write(', ')
+    f.write(json.dumps(key))
+    f.write(': ')
+    if key == 'tests' and isinstance(value, dict):
+      f.write('{')
+      for j, (test, subtree) in enumerate(value.iteritems()):
+        if j:
+          f.write(', ')
+        f.write(json.dumps(test))
+        f.write(': ')
+        f.write(json.dumps(subtree))
+      f.write('}')
+    else:
+      f.write(json.dumps(value))
+  f.write('}')
+
+
 def main(files):
   if len(files) < 2:
     sys.stderr.write("Not enough JSON files to merge.\n")
     return 1
-  sys.stderr.write('Starting with %s\n' % files[0])
-  result = json.load(open(files[0]))
-  for f in files[1:]:
-    sys.stderr.write('Merging %s\n' % f)
-    result = merge_test_results([result, json.load(open(f))])
-  print json.dumps(result)
+  sys.stderr.write('Merging %d files\n' % len(files))
+  dump_test_results(merge_files(files), sys.stdout)
+  sys.stdout.write('\n')
   return 0
 
 
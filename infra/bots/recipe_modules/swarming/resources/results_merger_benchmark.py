@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmark results_merger on synthetic shard results.
+
+Writes --shards JSON test results files in the version 3 format, each with
+--tests disjoint tests nested a few levels deep like DM's, then times merging
+them one at a time with merge_test_results (as results_merger.py used to) and
+with merge_files, and checks that both give the same results.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import results_merger
+
+
+def make_shard(shard, num_tests, rand):
+  tests = {}
+  for i in xrange(num_tests):
+    config = 'config%d' % (i % 7)
+    source = 'source%d' % (i % 13)
+    name = 'shard%d_test%d' % (shard, i)
+    passed = rand.random() > 0.01
+    tests.setdefault(config, {}).setdefault(source, {})[name] = {
+      'expected': 'PASS',
+      'actual': 'PASS' if passed else 'FAIL',
+      'times': [round(rand.random(), 3)],
+    }
+  return {
+    'version': 3,
+    'interrupted': False,
+    'seconds_since_epoch': 1500000000.0 + shard,
+    'path_delimiter': '/',
+    'num_failures_by_type': {'PASS': num_tests, 'FAIL': 0},
+    'tests': tests,
+  }
+
+
+def merge_one_at_a_time(paths):
+  result = json.load(open(paths[0]))
+  for p in paths[1:]:
+    result = results_merger.merge_test_results([result, json.load(open(p))])
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--shards', type=int, default=200)
+  parser.add_argument('--tests', type=int, default=2000,
+                      help='tests per shard')
+  parser.add_argument('--jobs', type=int)
+  args = parser.parse_args()
+
+  tmp = tempfile.mkdtemp()
+  try:
+    rand = random.Random(0)
+    paths = []
+    for shard in xrange(args.shards):
+      path = os.path.join(tmp, '%d.json' % shard)
+      with open(path, 'w') as f:
+        json.dump(make_shard(shard, args.tests, rand), f)
+      paths.append(path)
+    size = sum(os.path.getsize(p) for p in paths)
+    print '%d shards, %.1f MB of JSON' % (args.shards, size / 1e6)
+
+    start = time.time()
+    expected = merge_one_at_a_time(paths)
+    print 'merge_test_results, one at a time: %.2fs' % (time.time() - start)
+
+    start = time.time()
+    actual = results_merger.merge_files(paths, args.jobs)
+    print 'merge_files: %.2fs' % (time.time() - start)
+
+    start = time.time()
+    with open(os.path.join(tmp, 'out.json'), 'w') as f:
+      results_merger.dump_test_results(actual, f)
+    print 'dump_test_results: %.2fs' % (time.time() - start)
+
+    if actual != expected:
+      print 'Merged results differ!'
+      return 1
+  finally:
+    shutil.rmtree(tmp)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -15,6 +15,10 @@ from common import gtest_utils
 from slave import annotation_utils
 from slave import slave_utils
 
+from gtest_json import index_shard_jsons
+from gtest_json import load_json_incrementally
+from gtest_json import truncate_snippets
+
 
 MISSING_SHARDS_MSG = r"""Missing results from the following shard(s): %s
 
@@ -35,9 +39,12 @@ def emit_warning(title, log=None):
     slave_utils.WriteLogLines(title, log.split('\n'))
 
 
-def merge_shard_results(summary_json, jsons_to_merge):
+def merge_shard_results(summary_json, jsons_to_merge, max_snippet_bytes=None):
   """Reads JSON test output from all shards and combines them into one.
 
+  If max_snippet_bytes is set, test output snippets are truncated to that
+  size as each shard is loaded, bounding the size of the merged output.
+
   Returns dict with merged test output on success or None on failure. Emits
   annotations.
   """
@@ -61,6 +68,7 @@ def merge_shard_results(summary_json, jsons_to_merge):
     'per_iteration_data': [],
     'swarming_summary': summary,
   }
+  shard_jsons = index_shard_jsons(jsons_to_merge)
   for index, result in enumerate(summary['shards']):
     if result is not None:
       # Author note: this code path doesn't trigger convert_to_old_format() in
@@ -77,15 +85,16 @@ def merge_shard_results(summary_json, jsons_to_merge):
             'Either it ran for too long (hard timeout) or it didn\'t produce '
             'I/O for an extended period of time (I/O timeout)')
       elif state == u'COMPLETED':
-        json_data, err_msg = load_shard_json(index, jsons_to_merge)
+        json_data, err_msg = load_shard_json(
+            index, shard_jsons, max_snippet_bytes)
         if json_data:
           # Set-like fields.
           for key in ('all_tests', 'disabled_tests', 'global_tags'):
-            merged[key].update(json_data.get(key), [])
+            merged[key].update(json_data.get(key, []))
 
           # 'per_iteration_data' is a list of dicts. Dicts should be merged
           # together, not the 'per_iteration_data' list itself.
-          merged['per_iteration_data'] = merge_list_of_dicts(
+          merge_list_of_dicts(
               merged['per_iteration_data'],
               json_data.get('per_iteration_data', []))
           continue
@@ -112,26 +121,24 @@ def merge_shard_results(summary_json, jsons_to_merge):
   return merged
 
 
+# Shard output bigger than this is parsed incrementally rather than all at once.
 OUTPUT_JSON_SIZE_LIMIT = 100 * 1024 * 1024  # 100 MB
 
 
-def load_shard_json(index, jsons_to_merge):
+def load_shard_json(index, shard_jsons, max_snippet_bytes=None):
   """Reads JSON output of the specified shard.
 
   Args:
-    output_dir: The directory in which to look for the JSON output to load.
     index: The index of the shard to load data for.
+    shard_jsons: The output.json paths by shard, from index_shard_jsons.
+    max_snippet_bytes: If set, the size to truncate output snippets to.
 
   Returns: A tuple containing:
     * The contents of path, deserialized into a python object.
     * An error string.
     (exactly one of the tuple elements will be non-None).
   """
-  # 'output.json' is set in swarming/api.py, gtest_task method.
-  matching_json_files = [
-      j for j in jsons_to_merge
-      if (os.path.basename(j) == 'output.json'
-          and os.path.basename(os.path.dirname(j)) == str(index))]
+  matching_json_files = shard_jsons.get(str(index), [])
 
   if not matching_json_files:
     print >> sys.stderr, 'shard %s test output missing' % index
@@ -144,13 +151,17 @@ def load_shard_json(index, jsons_to_merge):
 
   try:
     filesize = os.stat(path).st_size
-    if filesize > OUTPUT_JSON_SIZE_LIMIT:
-      print >> sys.stderr, 'output.json is %d bytes. Max size is %d' % (
-           filesize, OUTPUT_JSON_SIZE_LIMIT)
-      return (None, 'shard %s test output exceeded the size limit' % index)
-
     with open(path) as f:
-      return (json.load(f), None)
+      if filesize > OUTPUT_JSON_SIZE_LIMIT:
+        print >> sys.stderr, (
+            'output.json is %d bytes; parsing it incrementally' % filesize)
+        return (load_json_incrementally(f, max_snippet_bytes), None)
+      data = json.load(f)
+      if max_snippet_bytes is not None:
+        for iteration in data.get('per_iteration_data', []):
+          for runs in iteration.itervalues():
+            truncate_snippets(runs, max_snippet_bytes)
+      return (data, None)
   except (IOError, ValueError, OSError) as e:
     print >> sys.stderr, 'Missing or invalid gtest JSON file: %s' % path
     print >> sys.stderr, '%s: %s' % (type(e).__name__, e)
@@ -159,21 +170,23 @@ def load_shard_json(index, jsons_to_merge):
 
 
 def merge_list_of_dicts(left, right):
-  """Merges dicts left[0] with right[0], left[1] with right[1], etc."""
-  output = []
-  for i in xrange(max(len(left), len(right))):
-    left_dict = left[i] if i < len(left) else {}
-    right_dict = right[i] if i < len(right) else {}
-    merged_dict = left_dict.copy()
-    merged_dict.update(right_dict)
-    output.append(merged_dict)
-  return output
+  """Merges dicts right[0] into left[0], right[1] into left[1], etc.
+
+  left is updated in place, so merging N shards is linear in the number of
+  test results rather than copying the results merged so far for each shard.
+  """
+  for i, right_dict in enumerate(right):
+    if i < len(left):
+      left[i].update(right_dict)
+    else:
+      left.append(dict(right_dict))
+  return left
 
 
 def standard_gtest_merge(
-    output_json, summary_json, jsons_to_merge):
+    output_json, summary_json, jsons_to_merge, max_snippet_bytes=None):
 
-  output = merge_shard_results(summary_json, jsons_to_merge)
+  output = merge_shard_results(summary_json, jsons_to_merge, max_snippet_bytes)
   with open(output_json, 'wb') as f:
     json.dump(output, f)
 
@@ -186,12 +199,15 @@ def main(raw_args):
   parser.add_argument('--build-properties')
   parser.add_argument('--summary-json')
   parser.add_argument('-o', '--output-json', required=True)
+  parser.add_argument('--max-snippet-bytes', type=int,
+                      help='truncate test output snippets to this size')
   parser.add_argument('jsons_to_merge', nargs='*')
 
   args = parser.parse_args(raw_args)
 
   return standard_gtest_merge(
-      args.output_json, args.summary_json, args.jsons_to_merge)
+      args.output_json, args.summary_json, args.jsons_to_merge,
+      args.max_snippet_bytes)
 
 
 if __name__ == '__main__':
@@ -4,7 +4,6 @@
 # found in the LICENSE file.
 
 import argparse
-import json
 import sys
 
 import results_merger
@@ -18,14 +17,10 @@ def StandardIsolatedScriptMerge(output_json, jsons_to_merge):
       written.
     jsons_to_merge: A list of paths to JSON files that should be merged.
   """
-  shard_results_list = []
-  for j in jsons_to_merge:
-    with open(j) as f:
-      shard_results_list.append(json.load(f))
-  merged_results = results_merger.merge_test_results(shard_results_list)
+  merged_results = results_merger.merge_files(jsons_to_merge)
 
   with open(output_json, 'w') as f:
-    json.dump(merged_results, f)
+    results_merger.dump_test_results(merged_results, f)
 
   return 0
 
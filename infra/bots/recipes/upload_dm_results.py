@@ -23,6 +23,10 @@ DEPS = [
 GS_BUCKET_IMAGES = 'skia-infra-gm'
 DM_JSON = 'dm.json'
 VERBOSE_LOG = 'verbose.log'
+DIGEST_INDEX_CACHE = 'dm_image_digests'
+# The digest indices shared by all bots, so that each doesn't have to list
+# the millions of images itself.
+SHARED_DIGEST_INDICES = 'dm-image-digest-indices-v1'
 
 
 def RunSteps(api):
@@ -41,19 +45,26 @@ def RunSteps(api):
   api.file.remove('rm old dm.json', json_file)
   api.file.remove('rm old verbose.log', log_file)
 
-  # Upload the images.
-  image_dest_path = 'gs://%s/dm-images-v1' % GS_BUCKET_IMAGES
-  for ext in ['.png', '.pdf']:
-    files_to_upload = api.file.glob_paths(
-        'find images',
-        results_dir,
-        '*%s' % ext,
-        test_data=['someimage.png'])
-    # For some reason, glob returns results_dir when it should return nothing.
-    files_to_upload = [f for f in files_to_upload if str(f).endswith(ext)]
-    if len(files_to_upload) > 0:
-      api.gsutil.cp('images', results_dir.join('*%s' % ext),
-                       image_dest_path, multithread=True)
+  # If compact_results is set, new images are also uploaded in a few large
+  # packs, and the JSON and logs are compressed before they're uploaded rather
+  # than by gsutil as it uploads them. Gold only reads images from
+  # dm-images-v1, and nothing reads the packs yet, so they're only an extra.
+  compact = api.properties.get('compact_results')
+
+  # Upload the images. DM names them by digest, so only new ones are
+  # uploaded; the digests already at each destination are indexed in a
+  # subdirectory of a named cache, and shared in GS.
+  def upload_images(name, image_dir, pack=False):
+    api.gsutil.upload_new_digests(
+        name, results_dir, 'gs://%s/%s' % (GS_BUCKET_IMAGES, image_dir),
+        api.path['cache'].join(DIGEST_INDEX_CACHE, image_dir),
+        patterns=['*.png', '*.pdf'], pack=pack,
+        shared_index='gs://%s/%s/%s' % (
+            GS_BUCKET_IMAGES, SHARED_DIGEST_INDICES, image_dir))
+
+  upload_images('images', 'dm-images-v1')
+  if compact:
+    upload_images('image packs', 'dm-image-packs-v1', pack=True)
 
   # Upload the JSON summary and verbose.log.
   now = api.time.utcnow()
@@ -77,8 +88,14 @@ def RunSteps(api):
   summary_dest_path = 'gs://%s/%s' % (api.properties['gs_bucket'],
                                       summary_dest_path)
 
-  api.gsutil.cp('JSON and logs', tmp_dir.join('*'), summary_dest_path,
-                   extra_args=['-z', 'json,log'])
+  if compact:
+    api.gsutil.precompress('compress JSON and logs',
+                           [tmp_dir.join(DM_JSON), tmp_dir.join(VERBOSE_LOG)])
+    api.gsutil.cp('JSON and logs', tmp_dir.join('*'), summary_dest_path,
+                  headers=['Content-Encoding:gzip'])
+  else:
+    api.gsutil.cp('JSON and logs', tmp_dir.join('*'), summary_dest_path,
+                  extra_args=['-z', 'json,log'])
 
 
 def GenTests(api):
@@ -99,6 +116,15 @@ def GenTests(api):
                    path_config='kitchen')
   )
 
+  yield (
+    api.test('compact') +
+    api.properties(buildername=builder,
+                   gs_bucket='skia-infra-gm',
+                   revision='abc123',
+                   path_config='kitchen',
+                   compact_results=True)
+  )
+
   yield (
     api.test('failed_once') +
     api.properties(buildername=builder,
@@ -9,11 +9,40 @@
 """Utilities for zipping and unzipping files."""
 
 
+import collections
 import fnmatch
+import multiprocessing
+import multiprocessing.pool
 import ntpath
 import os
 import posixpath
+import shutil
+import sys
+import tempfile
+import threading
 import zipfile
+import zlib
+
+
+# Files are read, compressed and written this much at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# Patterns of files whose contents are already compressed, so that deflating
+# them again only costs time. Pass as zip(..., store=ALREADY_COMPRESSED).
+ALREADY_COMPRESSED = [
+  '*.png',
+  '*.jpg',
+  '*.jpeg',
+  '*.gif',
+  '*.webp',
+  '*.skp',
+  '*.mskp',
+  '*.zip',
+  '*.gz',
+  '*.tgz',
+  '*.bz2',
+  '*.xz',
+]
 
 
 def filtered(names, blacklist):
@@ -24,36 +53,147 @@ def filtered(names, blacklist):
   return rv
 
 
-def zip(target_dir, zip_file, blacklist=None):  # pylint: disable=W0622
-  """Zip the given directory, write to the given zip file."""
+def _matches_any(name, patterns):
+  return any(fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def _arcname(filepath, target_dir):
+  arcname = os.path.relpath(filepath, target_dir)
+  if os.name == 'nt':
+    # Dumb path separator replacement for Windows.
+    arcname = arcname.replace(ntpath.sep, posixpath.sep)
+  return arcname
+
+
+def _zip_info(filepath, target_dir):
+  zi = zipfile.ZipInfo(filepath)
+  zi.filename = _arcname(filepath, target_dir)
+  perms = os.stat(filepath).st_mode
+  zi.external_attr = perms << 16L
+  zi.compress_type = zipfile.ZIP_DEFLATED
+  return zi
+
+
+def _compress(filepath, zi):
+  """Deflate filepath, to be written as the member described by zi.
+
+  Runs in a worker thread; zlib releases the GIL while it works. Fills in the
+  CRC and sizes of zi and returns a temporary file holding the member's data.
+  """
+  crc = 0
+  size = 0
+  out = tempfile.TemporaryFile()
+  compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+  with open(filepath, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+      crc = zlib.crc32(chunk, crc)
+      size += len(chunk)
+      out.write(compressor.compress(chunk))
+  out.write(compressor.flush())
+  zi.CRC = crc & 0xffffffff
+  zi.file_size = size
+  zi.compress_size = out.tell()
+  out.seek(0)
+  return out
+
+
+def _write_member(z, zi, data):
+  """Append a member whose data was prepared by _compress to z.
+
+  This does what ZipFile.write does, minus the compression. Python 2.7's
+  zipfile has no public way to write data which is already compressed, so
+  this uses its internals; Python 3 also tracks the end of the members in
+  z.start_dir, which this doesn't update.
+  """
+  assert sys.version_info[:2] == (2, 7), 'needs Python 2.7\'s zipfile'
+  zi.header_offset = z.fp.tell()
+  z._writecheck(zi)  # pylint: disable=W0212
+  z._didModify = True  # pylint: disable=W0212
+  z.fp.write(zi.FileHeader(zi.file_size > zipfile.ZIP64_LIMIT or
+                           zi.compress_size > zipfile.ZIP64_LIMIT))
+  shutil.copyfileobj(data, z.fp, CHUNK_SIZE)
+  z.filelist.append(zi)
+  z.NameToInfo[zi.filename] = zi
+
+
+def zip(target_dir, zip_file, blacklist=None, store=None,
+        jobs=None):  # pylint: disable=W0622
+  """Zip the given directory, write to the given zip file.
+
+  Files are streamed rather than read into memory. Files matching any of the
+  patterns in store (e.g. ALREADY_COMPRESSED) are stored rather than deflated.
+  Up to jobs files (default: one per CPU) are compressed at once; the
+  resulting zip file is the same whatever the number of jobs.
+  """
   if not os.path.isdir(target_dir):
     raise IOError('%s does not exist!' % target_dir)
   blacklist = blacklist or []
-  with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, True) as z:
-    for r, d, f in os.walk(target_dir, topdown=True):
-      d[:] = filtered(d, blacklist)
-      for filename in filtered(f, blacklist):
-        filepath = os.path.join(r, filename)
-        zi = zipfile.ZipInfo(filepath)
-        zi.filename = os.path.relpath(filepath, target_dir)
-        if os.name == 'nt':
-          # Dumb path separator replacement for Windows.
-          zi.filename = zi.filename.replace(ntpath.sep, posixpath.sep)
-        perms = os.stat(filepath).st_mode
-        zi.external_attr = perms << 16L
-        zi.compress_type = zipfile.ZIP_DEFLATED
-        with open(filepath, 'rb') as f:
-          content = f.read()
-        z.writestr(zi, content)
-      for dirname in d:
-        dirpath = os.path.join(r, dirname)
-        z.write(dirpath, os.path.relpath(dirpath, target_dir))
-
-
-def unzip(zip_file, target_dir):
-  """Unzip the given zip file into the target dir."""
+  store = store or []
+  jobs = jobs or multiprocessing.cpu_count()
+  pool = multiprocessing.pool.ThreadPool(jobs)
+  # Members being compressed, in the order they're written. Bounded, so that
+  # we don't hold on to too many compressed temporary files.
+  pending = collections.deque()
+
+  def write_oldest(z):
+    filepath, zi, result = pending.popleft()
+    if result is None:
+      # Stored as is; ZipFile.write streams it.
+      z.write(filepath, _arcname(filepath, target_dir), zipfile.ZIP_STORED)
+      return
+    with result.get() as data:
+      _write_member(z, zi, data)
+
+  try:
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, True) as z:
+      for r, d, f in os.walk(target_dir, topdown=True):
+        d[:] = filtered(d, blacklist)
+        for filename in filtered(f, blacklist):
+          filepath = os.path.join(r, filename)
+          if _matches_any(filename, store):
+            pending.append((filepath, None, None))
+          else:
+            zi = _zip_info(filepath, target_dir)
+            pending.append((filepath, zi,
+                            pool.apply_async(_compress, (filepath, zi))))
+          if len(pending) > 2 * jobs:
+            write_oldest(z)
+        while pending:
+          write_oldest(z)
+        for dirname in d:
+          dirpath = os.path.join(r, dirname)
+          z.write(dirpath, os.path.relpath(dirpath, target_dir))
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def unzip(zip_file, target_dir, jobs=None):
+  """Unzip the given zip file into the target dir.
+
+  Members are streamed to disk rather than read into memory, up to jobs
+  (default: one per CPU) at once.
+  """
   if not os.path.isdir(target_dir):
     os.makedirs(target_dir)
+  local = threading.local()
+  handles = []
+
+  def extract(zi, dst_path):
+    # ZipFile objects can't be shared between threads.
+    if not hasattr(local, 'zip'):
+      local.zip = zipfile.ZipFile(zip_file, 'r', zipfile.ZIP_DEFLATED, True)
+      handles.append(local.zip)
+    src = local.zip.open(zi)
+    try:
+      with open(dst_path, 'wb') as f:
+        shutil.copyfileobj(src, f, CHUNK_SIZE)
+    finally:
+      src.close()
+    os.chmod(dst_path, zi.external_attr >> 16L)
+
+  dirs = []
+  files = []
   with zipfile.ZipFile(zip_file, 'r', zipfile.ZIP_DEFLATED, True) as z:
     for zi in z.infolist():
       dst_subpath = zi.filename
@@ -63,8 +203,21 @@ def unzip(zip_file, target_dir):
       dst_path = os.path.join(target_dir, dst_subpath)
       if dst_path.endswith(os.path.sep):
         os.mkdir(dst_path)
+        dirs.append((zi, dst_path))
       else:
-        with open(dst_path, 'wb') as f:
-          f.write(z.read(zi))
-      perms = zi.external_attr >> 16L
-      os.chmod(dst_path, perms)
+        files.append((zi, dst_path))
+
+  pool = multiprocessing.pool.ThreadPool(jobs or multiprocessing.cpu_count())
+  try:
+    # Wait on each result, so that the first error is raised.
+    for result in [pool.apply_async(extract, f) for f in files]:
+      result.get()
+  finally:
+    pool.terminate()
+    pool.join()
+    for z in handles:
+      z.close()
+
+  # Directory permissions last, in case they don't allow writing the files.
+  for zi, dst_path in reversed(dirs):
+    os.chmod(dst_path, zi.external_attr >> 16L)
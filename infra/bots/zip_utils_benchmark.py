@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Benchmark zip_utils on an asset directory.
+
+Zips the given directory (or, without one, a synthetic asset directory with a
+mix of text, incompressible binaries and PNGs) the way zip_utils used to, by
+reading each file into memory and deflating everything, then with zip_utils
+as it is, with and without storing already-compressed files. Each zip file is
+then unzipped and checked against the input.
+"""
+
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import zipfile
+
+import test_utils
+import zip_utils
+
+
+def make_assets(dest, megabytes):
+  """Write roughly megabytes MB of files resembling an asset into dest."""
+  os.makedirs(os.path.join(dest, 'include'))
+  os.makedirs(os.path.join(dest, 'bin'))
+  os.makedirs(os.path.join(dest, 'images'))
+  total = megabytes * 1024 * 1024
+  i = 0
+  written = 0
+  while written < total:
+    # Small headers, medium images, the occasional big binary.
+    path = os.path.join(dest, 'include', 'header%d.h' % i)
+    contents = ''.join('#define SK_THING_%d_%d %d\n' % (i, j, j)
+                       for j in xrange(2000))
+    with open(path, 'wb') as f:
+      f.write(contents)
+    written += len(contents)
+
+    path = os.path.join(dest, 'images', 'image%d.png' % i)
+    contents = os.urandom(256 * 1024)
+    with open(path, 'wb') as f:
+      f.write(contents)
+    written += len(contents)
+
+    if i % 8 == 0:
+      path = os.path.join(dest, 'bin', 'tool%d' % i)
+      contents = os.urandom(1024 * 1024) + '\0' * (1024 * 1024)
+      with open(path, 'wb') as f:
+        f.write(contents)
+      os.chmod(path, 0755)
+      written += len(contents)
+    i += 1
+
+
+def old_zip(target_dir, zip_file):
+  """zip_utils.zip before it streamed files and stored compressed ones."""
+  with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, True) as z:
+    for r, d, f in os.walk(target_dir, topdown=True):
+      for filename in f:
+        filepath = os.path.join(r, filename)
+        zi = zipfile.ZipInfo(filepath)
+        zi.filename = os.path.relpath(filepath, target_dir)
+        zi.external_attr = os.stat(filepath).st_mode << 16L
+        zi.compress_type = zipfile.ZIP_DEFLATED
+        with open(filepath, 'rb') as f:
+          z.writestr(zi, f.read())
+      for dirname in d:
+        dirpath = os.path.join(r, dirname)
+        z.write(dirpath, os.path.relpath(dirpath, target_dir))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('dir', nargs='?',
+                      help='asset directory; a synthetic one by default')
+  parser.add_argument('--megabytes', type=int, default=200,
+                      help='size of the synthetic asset directory')
+  parser.add_argument('--jobs', type=int)
+  args = parser.parse_args()
+
+  tmp = tempfile.mkdtemp()
+  try:
+    target_dir = args.dir
+    if not target_dir:
+      target_dir = os.path.join(tmp, 'input')
+      make_assets(target_dir, args.megabytes)
+    size = sum(os.path.getsize(os.path.join(r, f))
+               for r, _, files in os.walk(target_dir) for f in files)
+    print '%s: %.1f MB' % (target_dir, size / 1e6)
+
+    # Only used for compare_trees' assertions.
+    test = unittest.TestCase('__init__')
+    runs = [
+      ('old zip, deflate everything', lambda z: old_zip(target_dir, z)),
+      ('zip, deflate everything',
+       lambda z: zip_utils.zip(target_dir, z, jobs=args.jobs)),
+      ('zip, store ALREADY_COMPRESSED',
+       lambda z: zip_utils.zip(target_dir, z,
+                               store=zip_utils.ALREADY_COMPRESSED,
+                               jobs=args.jobs)),
+    ]
+    for i, (name, fn) in enumerate(runs):
+      zip_file = os.path.join(tmp, '%d.zip' % i)
+      start = time.time()
+      fn(zip_file)
+      elapsed = time.time() - start
+      print '%-32s %6.2fs  %7.1f MB' % (name + ':', elapsed,
+                                        os.path.getsize(zip_file) / 1e6)
+
+      output = os.path.join(tmp, 'output%d' % i)
+      start = time.time()
+      zip_utils.unzip(zip_file, output, jobs=args.jobs)
+      print '%-32s %6.2fs' % ('  unzip:', time.time() - start)
+      test_utils.compare_trees(test, target_dir, output)
+      shutil.rmtree(output)
+      os.remove(zip_file)
+  finally:
+    shutil.rmtree(tmp)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -16,6 +16,7 @@ import unittest
 import utils
 import uuid
 import zip_utils
+import zipfile
 
 
 class ZipUtilsTest(unittest.TestCase):
@@ -64,6 +65,66 @@ class ZipUtilsTest(unittest.TestCase):
       # Compare results.
       test_utils.compare_trees(self, 'input', 'output')
 
+  def test_store(self):
+    with utils.tmp_dir():
+      fw = test_utils.FileWriter(os.path.join(os.getcwd(), 'input'))
+      fw.mkdir('skps')
+      fw.write(os.path.join('skps', 'a.skp'))
+      fw.write('b.png')
+      fw.write('c.txt')
+
+      zip_utils.zip('input', 'test.zip', store=['*.skp', '*.png'])
+      with zipfile.ZipFile('test.zip') as z:
+        # Stored and deflated members both read back intact.
+        self.assertIsNone(z.testzip())
+        compress_types = dict((zi.filename, zi.compress_type)
+                              for zi in z.infolist())
+      self.assertEqual(compress_types[os.path.join('skps', 'a.skp')],
+                       zipfile.ZIP_STORED)
+      self.assertEqual(compress_types['b.png'], zipfile.ZIP_STORED)
+      self.assertEqual(compress_types['c.txt'], zipfile.ZIP_DEFLATED)
+
+      zip_utils.unzip('test.zip', 'output')
+      test_utils.compare_trees(self, 'input', 'output')
+
+  def test_jobs(self):
+    with utils.tmp_dir():
+      fw = test_utils.FileWriter(os.path.join(os.getcwd(), 'input'))
+      fw.mkdir('subdir')
+      for i in xrange(20):
+        fw.write('%d.txt' % i)
+        fw.write(os.path.join('subdir', '%d.png' % i), 0600)
+
+      # The zip file doesn't depend on the number of jobs.
+      zip_utils.zip('input', 'serial.zip', store=['*.png'], jobs=1)
+      zip_utils.zip('input', 'parallel.zip', store=['*.png'], jobs=4)
+      self.assertTrue(filecmp.cmp('serial.zip', 'parallel.zip', shallow=False))
+      with zipfile.ZipFile('parallel.zip') as z:
+        self.assertIsNone(z.testzip())
+
+      zip_utils.unzip('parallel.zip', 'output', jobs=4)
+      test_utils.compare_trees(self, 'input', 'output')
+
+  def test_large_file(self):
+    with utils.tmp_dir():
+      os.mkdir('input')
+      with open(os.path.join('input', 'big.bin'), 'wb') as f:
+        for _ in xrange(10):
+          f.write(os.urandom(1000))
+          f.write('x' * 1000)
+
+      # Files span several chunks.
+      orig_chunk_size = zip_utils.CHUNK_SIZE
+      zip_utils.CHUNK_SIZE = 1024
+      try:
+        zip_utils.zip('input', 'test.zip')
+        zip_utils.unzip('test.zip', 'output')
+      finally:
+        zip_utils.CHUNK_SIZE = orig_chunk_size
+      with zipfile.ZipFile('test.zip') as z:
+        self.assertIsNone(z.testzip())
+      test_utils.compare_trees(self, 'input', 'output')
+
   def test_nonexistent_dir(self):
     with utils.tmp_dir():
       with self.assertRaises(IOError):
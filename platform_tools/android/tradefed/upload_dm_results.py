@@ -11,18 +11,27 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
 
-def main(dm_dir, build_number, builder_name):
+# Where to keep the index of images already in Google Storage between runs.
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'skia',
+                                 'dm_image_digests')
+
+def main(dm_dir, build_number, builder_name, index_dir=DEFAULT_INDEX_DIR):
   """Upload DM output PNG files and JSON summary to Google Storage.
 
     dm_dir:        path to PNG files and JSON summary    (str)
     build_number:  nth build on this builder             (str or int)
     builder_name:  name of this builder                  (str)
+    index_dir:     where to keep the uploaded image index (str)
   """
-  # import gs_utils
+  # import gs_utils and upload_new_digests
   current_dir = os.path.dirname(os.path.abspath(__file__))
   sys.path.insert(0, os.path.join(current_dir, "../../../common/py/utils"))
+  sys.path.insert(0, os.path.join(current_dir, "../../../infra/bots/"
+                                  "recipe_modules/gsutil/resources"))
   import gs_utils
+  import upload_new_digests
 
   # Private, but Google-readable.
   ACL = gs_utils.GSUtils.PredefinedACL.PRIVATE
@@ -40,14 +49,38 @@ def main(dm_dir, build_number, builder_name):
   shutil.move(os.path.join(dm_dir, 'dm.json'),
               os.path.join(tmp,    'dm.json'))
 
-  # Only images are left in dm_dir.  Upload any new ones.
+  # Only images are left in dm_dir.  Upload any new ones, as judged by a local
+  # index of the images already uploaded, rather than asking about each.
+  class Store(object):
+    def __init__(self):
+      self._local = threading.local()
+
+    def _gs(self):
+      # Each upload thread gets its own connection.
+      if not hasattr(self._local, 'gs'):
+        self._local.gs = gs_utils.GSUtils()
+      return self._local.gs
+
+    def list_names(self):
+      _, files = self._gs().list_bucket_contents('skia-android-dm',
+                                                 'dm-images-v1')
+      return files
+
+    def upload(self, paths):
+      for path in paths:
+        self._gs().upload_file(path,
+                               'skia-android-dm',
+                               'dm-images-v1/' + os.path.basename(path),
+                               predefined_acl = ACL,
+                               fine_grained_acl_list = FINE_ACLS)
+
+  upload_new_digests.upload_new(
+      upload_new_digests.find_files(dm_dir,
+                                    upload_new_digests.DEFAULT_PATTERNS),
+      Store(),
+      upload_new_digests.DigestIndex(index_dir))
+
   gs = gs_utils.GSUtils()
-  gs.upload_dir_contents(dm_dir,
-                         'skia-android-dm',
-                         'dm-images-v1',
-                         upload_if = gs.UploadIf.IF_NEW,
-                         predefined_acl = ACL,
-                         fine_grained_acl_list = FINE_ACLS)
 
 
   # /dm-json-v1/year/month/day/hour/build-number/builder/dm.json
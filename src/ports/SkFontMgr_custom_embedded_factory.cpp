@@ -11,7 +11,15 @@ struct SkEmbeddedResource { const uint8_t* data; size_t size; };
 struct SkEmbeddedResourceHeader { const SkEmbeddedResource* entries; int count; };
 sk_sp<SkFontMgr> SkFontMgr_New_Custom_Embedded(const SkEmbeddedResourceHeader* header);
 
+// Fonts embedded with 'embed_resources.py --compress' are inflated on first use.
+#if defined(SK_EMBEDDED_FONTS_COMPRESSED)
+extern "C" const SkEmbeddedResourceHeader* SK_EMBEDDED_FONTS();
+sk_sp<SkFontMgr> SkFontMgr::Factory() {
+    return SkFontMgr_New_Custom_Embedded(SK_EMBEDDED_FONTS());
+}
+#else
 extern "C" const SkEmbeddedResourceHeader SK_EMBEDDED_FONTS;
 sk_sp<SkFontMgr> SkFontMgr::Factory() {
     return SkFontMgr_New_Custom_Embedded(&SK_EMBEDDED_FONTS);
 }
+#endif
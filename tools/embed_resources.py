@@ -8,63 +8,138 @@ found in the LICENSE file.
 '''
 
 import argparse
+import hashlib
+import io
+import os
+import sys
+import zlib
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'gn'))
+import action_cache
 
-def bytes_from_file(f, chunksize=8192):
+# The text for each byte value, as written by the 'array' format.
+BYTE_TEXT = [hex(b) + ',' for b in range(256)]
+BYTES_PER_LINE = 32
+
+
+def write_array(out, f, chunksize=8192):
+  """Write the contents of f as lines of comma separated hex bytes.
+
+  Whole chunks are formatted at once through a lookup table rather than one
+  byte at a time.  Returns the number of bytes written.
+  """
+  bytes_written = 0
+  bytes_on_line = 0
   while True:
-    chunk = f.read(chunksize)
-    if chunk:
-      for b in chunk:
-        yield ord(b)
-    else:
+    chunk = bytearray(f.read(chunksize))
+    if not chunk:
       break
+    start = 0
+    while start < len(chunk):
+      end = min(len(chunk), start + BYTES_PER_LINE - bytes_on_line)
+      out(''.join(map(BYTE_TEXT.__getitem__, chunk[start:end])))
+      bytes_on_line += end - start
+      if bytes_on_line >= BYTES_PER_LINE:
+        out('\n')
+        bytes_on_line = 0
+      start = end
+    bytes_written += len(chunk)
+  return bytes_written
 
 
-def main():
-  parser = argparse.ArgumentParser(
-      formatter_class=argparse.RawDescriptionHelpFormatter,
-      description='Convert resource files to embedded read only data.',
-      epilog='''The output (when compiled and linked) can be used as:
-struct SkEmbeddedResource {const uint8_t* data; const size_t size;};
-struct SkEmbeddedHeader {const SkEmbeddedResource* entries; const int count;};
-extern "C" SkEmbeddedHeader const NAME;''')
-  parser.add_argument('--align', default=1, type=int,
-                      help='minimum alignment (in bytes) of resource data')
-  parser.add_argument('--name', default='_resource', type=str,
-                      help='the name of the c identifier to export')
-  parser.add_argument('--input', required=True, type=argparse.FileType('rb'),
-                      nargs='+', help='list of resource files to embed')
-  parser.add_argument('--output', required=True, type=argparse.FileType('w'),
-                      help='the name of the cpp file to output')
-  args = parser.parse_args()
+def write_resource_array(args, out, index, path):
+  out('static const uint8_t resource{0:d}[] SK_STRUCT_ALIGN({1:d}) = {{\n'
+      .format(index, args.align))
+  with open(path, 'rb') as f:
+    bytes_written = write_array(out, f)
+  out('};\n')
+  out('static const size_t resource{0:d}_size = {1:d};\n'
+      .format(index, bytes_written))
+
+
+def write_resource_deflated(args, out, index, path):
+  # Only the compressed bytes are stored; the inflated copy lives in a
+  # zero-initialized array, which costs no space in the binary and is only
+  # paged in once it is filled on first use.
+  with open(path, 'rb') as f:
+    data = f.read()
+  out('static const uint8_t resource{0:d}_z[] = {{\n'.format(index))
+  compressed_size = write_array(out, io.BytesIO(zlib.compress(data, 9)))
+  out('};\n')
+  out('static const size_t resource{0:d}_z_size = {1:d};\n'
+      .format(index, compressed_size))
+  out('static uint8_t resource{0:d}[{1:d}] SK_STRUCT_ALIGN({2:d});\n'
+      .format(index, max(len(data), 1), args.align))
+  out('static const size_t resource{0:d}_size = {1:d};\n'
+      .format(index, len(data)))
+
+
+def incbin_path(path):
+  """The path of an input as the generated .incbin directive names it."""
+  return os.path.abspath(path).replace('\\', '/')
+
+
+def write_resource_incbin(args, out, index, path):
+  # The assembler reads the file itself, so the compiler never sees its bytes.
+  # Neither compilers nor ninja track .incbin dependencies, so the digest of
+  # the contents is written too: the output changes whenever the input does.
+  symbol = '{0:s}_resource{1:d}'.format(args.name, index)
+  with open(path, 'rb') as f:
+    data = f.read()
+  out('// {0:s} sha1:{1:s}\n'.format(os.path.basename(path),
+                                     hashlib.sha1(data).hexdigest()))
+  out('extern "C" const uint8_t {0:s}[];\n'.format(symbol))
+  out('__asm__(SK_EMBED_SECTION "\\n"\n')
+  out('        ".balign {0:d}\\n"\n'.format(args.align))
+  out('        SK_EMBED_SYMBOL({0:s}) ":\\n"\n'.format(symbol))
+  out('        ".incbin \\"{0:s}\\"\\n"\n'.format(incbin_path(path)))
+  out('        SK_EMBED_SECTION_END "\\n");\n')
+  out('static constexpr const uint8_t* resource{0:d} = {1:s};\n'
+      .format(index, symbol))
+  out('static const size_t resource{0:d}_size = {1:d};\n'
+      .format(index, len(data)))
+
 
-  out = args.output.write;
+INCBIN_PRELUDE = '''#if defined(__APPLE__)
+    #define SK_EMBED_SECTION ".const"
+    #define SK_EMBED_SECTION_END ".text"
+    #define SK_EMBED_SYMBOL(name) "_" #name
+#else
+    #define SK_EMBED_SECTION ".section .rodata"
+    #define SK_EMBED_SECTION_END ".previous"
+    #define SK_EMBED_SYMBOL(name) #name
+#endif
+'''
+
+WRITERS = {
+  'array': write_resource_array,
+  'incbin': write_resource_incbin,
+}
+
+
+def write_cpp(args, out):
   out('#include "SkTypes.h"\n')
+  if args.format == 'incbin':
+    out(INCBIN_PRELUDE)
+
+  if args.compress:
+    out('#include "zlib.h"\n')
 
   # Write the resources.
+  write_resource = WRITERS[args.format]
+  if args.compress:
+    write_resource = write_resource_deflated
   index = 0
-  for f in args.input:
-    out('static const uint8_t resource{0:d}[] SK_STRUCT_ALIGN({1:d}) = {{\n'
-        .format(index, args.align))
-    bytes_written = 0
-    bytes_on_line = 0
-    for b in bytes_from_file(f):
-      out(hex(b) + ',')
-      bytes_written += 1
-      bytes_on_line += 1
-      if bytes_on_line >= 32:
-        out('\n')
-        bytes_on_line = 0
-    out('};\n')
-    out('static const size_t resource{0:d}_size = {1:d};\n'
-        .format(index, bytes_written))
+  for path in args.input:
+    write_resource(args, out, index, path)
     index += 1
 
   # Write the resource entries.
   out('struct SkEmbeddedResource { const uint8_t* d; const size_t s; };\n')
   out('static const SkEmbeddedResource header[] = {\n')
   index = 0
-  for f in args.input:
+  for _ in args.input:
     out('  {{ resource{0:d}, resource{0:d}_size }},\n'.format(index))
     index += 1
   out('};\n')
@@ -72,8 +147,82 @@ extern "C" SkEmbeddedHeader const NAME;''')
 
   # Export the resource header.
   out('struct SkEmbeddedHeader {const SkEmbeddedResource* e; const int c;};\n')
-  out('extern "C" const SkEmbeddedHeader {0:s} = {{ header, header_count }};\n'
-      .format(args.name))
+  if not args.compress:
+    out('extern "C" const SkEmbeddedHeader {0:s} = '
+        '{{ header, header_count }};\n'.format(args.name))
+    return
+
+  # Export an accessor which inflates every resource the first time it is
+  # called.  Function-local statics are initialized exactly once, even when
+  # called from several threads.
+  out('struct SkEmbeddedDeflated { const uint8_t* z; uLong zs; uint8_t* d; '
+      'uLongf s; };\n')
+  out('static const SkEmbeddedDeflated deflated[] = {\n')
+  for index in range(len(args.input)):
+    out('  {{ resource{0:d}_z, resource{0:d}_z_size, resource{0:d}, '
+        'resource{0:d}_size }},\n'.format(index))
+  out('};\n')
+  out('static const SkEmbeddedHeader* inflate_all() {\n')
+  out('  for (const SkEmbeddedDeflated& r : deflated) {\n')
+  out('    uLongf size = r.s;\n')
+  out('    if (uncompress(r.d, &size, r.z, r.zs) != Z_OK || size != r.s) {\n')
+  out('      SK_ABORT("Could not inflate embedded resource.");\n')
+  out('    }\n')
+  out('  }\n')
+  out('  static const SkEmbeddedHeader inflated = { header, header_count };\n')
+  out('  return &inflated;\n')
+  out('}\n')
+  out('extern "C" const SkEmbeddedHeader* {0:s}() {{\n'.format(args.name))
+  out('  static const SkEmbeddedHeader* inflated = inflate_all();\n')
+  out('  return inflated;\n')
+  out('}\n')
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.RawDescriptionHelpFormatter,
+      description='Convert resource files to embedded read only data.',
+      epilog='''The output (when compiled and linked) can be used as:
+struct SkEmbeddedResource {const uint8_t* data; const size_t size;};
+struct SkEmbeddedHeader {const SkEmbeddedResource* entries; const int count;};
+extern "C" SkEmbeddedHeader const NAME;
+
+With --compress, NAME is instead an accessor which inflates the resources on
+first use, and the output must be linked against zlib:
+extern "C" const SkEmbeddedHeader* NAME();''')
+  parser.add_argument('--align', default=1, type=int,
+                      help='minimum alignment (in bytes) of resource data')
+  parser.add_argument('--name', default='_resource', type=str,
+                      help='the name of the c identifier to export')
+  parser.add_argument('--format', default='array', choices=sorted(WRITERS),
+                      help='array: the bytes as a C++ array literal; '
+                           'incbin: have the assembler include the files '
+                           'directly (gcc/clang only, much faster to build)')
+  parser.add_argument('--compress', action='store_true',
+                      help='store the resources deflated, inflating them on '
+                           'first use (array format only)')
+  parser.add_argument('--input', required=True, nargs='+',
+                      help='list of resource files to embed')
+  parser.add_argument('--output', required=True,
+                      help='the name of the cpp file to output')
+  args = parser.parse_args()
+  if args.compress and args.format != 'array':
+    parser.error('--compress is only supported with --format=array')
+
+  def generate(staged):
+    with open(staged[args.output], 'w') as f:
+      write_cpp(args, f.write)
+
+  # Only rewrite the (large) output when it changes, and skip regenerating it
+  # entirely when the inputs match a cached run.  The incbin output names the
+  # inputs by absolute path, so a cached one is only good for the same paths.
+  key_args = ['--align', str(args.align),
+              '--name', args.name,
+              '--format', args.format,
+              '--compress=%s' % args.compress]
+  if args.format == 'incbin':
+    key_args += [incbin_path(path) for path in args.input]
+  action_cache.run([], args.input, key_args, [args.output], generate)
 
 
 if __name__ == "__main__":
@@ -8,193 +8,246 @@ found in the LICENSE file.
 '''
 
 '''
-Gathers diffs between 2 JSON expectations files, or between actual and
-expected results within a single JSON actual-results file,
-and generates an old-vs-new diff dictionary.
-
-TODO(epoger): Fix indentation in this file (2-space indents, not 4-space).
+Compares the digests of two DM runs, read from the dm.json files written by
+DM (see dm/DMJsonWriter.cpp), and lists the results which were added, removed
+or changed.
+
+Results are keyed by (name, config, source_type, source_options), like Gold's
+traces. Each run is turned into a DigestIndex: its keys in sorted order, and
+their MD5s packed into one string. dm.json is parsed a result at a time, so
+runs with tens of thousands of results are never in memory as JSON, and two
+indices are compared in a single pass over both. An index can be saved with
+--save-old/--save-new and passed instead of a dm.json in later comparisons.
 '''
 
 # System-level imports
 import argparse
+import binascii
+import bisect
+import gzip
 import json
 import os
 import sys
 import urllib2
 
-# Imports from within Skia
-#
-# We need to add the 'gm' directory, so that we can import gm_json.py within
-# that directory.  That script allows us to parse the actual-results.json file
-# written out by the GM tool.
-# Make sure that the 'gm' dir is in the PYTHONPATH, but add it at the *end*
-# so any dirs that are already in the PYTHONPATH will be preferred.
-#
-# This assumes that the 'gm' directory has been checked out as a sibling of
-# the 'tools' directory containing this script, which will be the case if
-# 'trunk' was checked out as a single unit.
-GM_DIRECTORY = os.path.realpath(
-    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'gm'))
-if GM_DIRECTORY not in sys.path:
-    sys.path.append(GM_DIRECTORY)
-import gm_json
-
-
-# Object that generates diffs between two JSON gm result files.
-class GMDiffer(object):
-
-    def __init__(self):
-        pass
-
-    def _GetFileContentsAsString(self, filepath):
-        """Returns the full contents of a file, as a single string.
-        If the filename looks like a URL, download its contents.
-        If the filename is None, return None."""
-        if filepath is None:
-            return None
-        elif filepath.startswith('http:') or filepath.startswith('https:'):
-            return urllib2.urlopen(filepath).read()
-        else:
-            return open(filepath, 'r').read()
-
-    def _GetExpectedResults(self, contents):
-        """Returns the dictionary of expected results from a JSON string,
-        in this form:
-
-        {
-          'test1' : 14760033689012826769,
-          'test2' : 9151974350149210736,
-          ...
-        }
-
-        We make these simplifying assumptions:
-        1. Each test has either 0 or 1 allowed results.
-        2. All expectations are of type JSONKEY_HASHTYPE_BITMAP_64BITMD5.
-
-        Any tests which violate those assumptions will cause an exception to
-        be raised.
-
-        Any tests for which we have no expectations will be left out of the
-        returned dictionary.
-        """
-        result_dict = {}
-        json_dict = gm_json.LoadFromString(contents)
-        all_expectations = json_dict[gm_json.JSONKEY_EXPECTEDRESULTS]
-
-        # Prevent https://code.google.com/p/skia/issues/detail?id=1588
-        if not all_expectations:
-            return result_dict
-
-        for test_name in all_expectations.keys():
-            test_expectations = all_expectations[test_name]
-            allowed_digests = test_expectations[
-                gm_json.JSONKEY_EXPECTEDRESULTS_ALLOWEDDIGESTS]
-            if allowed_digests:
-                num_allowed_digests = len(allowed_digests)
-                if num_allowed_digests > 1:
-                    raise ValueError(
-                        'test %s has %d allowed digests' % (
-                            test_name, num_allowed_digests))
-                digest_pair = allowed_digests[0]
-                if digest_pair[0] != gm_json.JSONKEY_HASHTYPE_BITMAP_64BITMD5:
-                    raise ValueError(
-                        'test %s has unsupported hashtype %s' % (
-                            test_name, digest_pair[0]))
-                result_dict[test_name] = digest_pair[1]
-        return result_dict
-
-    def _GetActualResults(self, contents):
-        """Returns the dictionary of actual results from a JSON string,
-        in this form:
-
-        {
-          'test1' : 14760033689012826769,
-          'test2' : 9151974350149210736,
-          ...
-        }
-
-        We make these simplifying assumptions:
-        1. All results are of type JSONKEY_HASHTYPE_BITMAP_64BITMD5.
-
-        Any tests which violate those assumptions will cause an exception to
-        be raised.
-
-        Any tests for which we have no actual results will be left out of the
-        returned dictionary.
-        """
-        result_dict = {}
-        json_dict = gm_json.LoadFromString(contents)
-        all_result_types = json_dict[gm_json.JSONKEY_ACTUALRESULTS]
-        for result_type in all_result_types.keys():
-            results_of_this_type = all_result_types[result_type]
-            if results_of_this_type:
-                for test_name in results_of_this_type.keys():
-                    digest_pair = results_of_this_type[test_name]
-                    if digest_pair[0] != gm_json.JSONKEY_HASHTYPE_BITMAP_64BITMD5:
-                        raise ValueError(
-                            'test %s has unsupported hashtype %s' % (
-                                test_name, digest_pair[0]))
-                    result_dict[test_name] = digest_pair[1]
-        return result_dict
-
-    def _DictionaryDiff(self, old_dict, new_dict):
-        """Generate a dictionary showing the diffs between old_dict and new_dict.
-        Any entries which are identical across them will be left out."""
-        diff_dict = {}
-        all_keys = set(old_dict.keys() + new_dict.keys())
-        for key in all_keys:
-            if old_dict.get(key) != new_dict.get(key):
-                new_entry = {}
-                new_entry['old'] = old_dict.get(key)
-                new_entry['new'] = new_dict.get(key)
-                diff_dict[key] = new_entry
-        return diff_dict
-
-    def GenerateDiffDict(self, oldfile, newfile=None):
-        """Generate a dictionary showing the diffs:
-        old = expectations within oldfile
-        new = expectations within newfile
-
-        If newfile is not specified, then 'new' is the actual results within
-        oldfile.
-        """
-        return self.GenerateDiffDictFromStrings(self._GetFileContentsAsString(oldfile),
-                                                self._GetFileContentsAsString(newfile))
-
-    def GenerateDiffDictFromStrings(self, oldjson, newjson=None):
-        """Generate a dictionary showing the diffs:
-        old = expectations within oldjson
-        new = expectations within newjson
-
-        If newfile is not specified, then 'new' is the actual results within
-        oldfile.
-        """
-        old_results = self._GetExpectedResults(oldjson)
-        if newjson:
-            new_results = self._GetExpectedResults(newjson)
-        else:
-            new_results = self._GetActualResults(oldjson)
-        return self._DictionaryDiff(old_results, new_results)
+# The same incremental JSON decoder as standard_gtest_merge uses.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'infra', 'bots', 'recipe_modules',
+                                'swarming', 'resources'))
+from gtest_json import JsonStream
+
+
+INDEX_MAGIC = 'dm-digest-index 1\n'
+DIGEST_SIZE = 16  # MD5
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+def _Intern(s):
+  return intern(s.encode('utf-8') if isinstance(s, unicode) else s)
+
+
+class DigestIndex(object):
+  """The digests of one DM run, sorted by key.
+
+  keys[i] is a (name, config, source_type, source_options) tuple, with ''
+  for results without source options, and digests[16*i:16*(i+1)] is its raw
+  MD5. info holds the run's other top-level dm.json values, except for
+  test_results.
+  """
+
+  def __init__(self, keys, digests, info=None):
+    self.keys = keys
+    self.digests = digests
+    self.info = info or {}
+
+  def __len__(self):
+    return len(self.keys)
+
+  def Digest(self, i):
+    """Returns the i'th digest, in hex."""
+    return binascii.hexlify(self.digests[DIGEST_SIZE*i:DIGEST_SIZE*(i+1)])
+
+  def Lookup(self, key):
+    """Returns the digest for key, in hex, or None."""
+    i = bisect.bisect_left(self.keys, key)
+    if i < len(self.keys) and self.keys[i] == key:
+      return self.Digest(i)
+    return None
+
+  @classmethod
+  def FromResults(cls, results, info=None):
+    """Builds an index from (key, hex digest) pairs.
+
+    If a key appears more than once, the last digest wins.
+    """
+    by_key = {}
+    for key, digest in results:
+      by_key[key] = digest
+    keys = sorted(by_key)
+    digests = ''.join(binascii.unhexlify(by_key[k]) for k in keys)
+    return cls(keys, digests, info)
+
+  @classmethod
+  def FromDMJson(cls, f, head=''):
+    """Builds an index from a dm.json file, read a result at a time."""
+    stream = JsonStream(f, head)
+    info = {}
+    results = []
+    for top_key in stream.items():
+      if top_key == 'results':
+        for _ in stream.elements():
+          result = stream.value()
+          key = result['key']
+          results.append(((_Intern(key['name']),
+                           _Intern(key['config']),
+                           _Intern(key['source_type']),
+                           _Intern(key.get('source_options', ''))),
+                          str(result['md5'])))
+      elif top_key == 'test_results':
+        stream.value()
+      else:
+        info[top_key] = stream.value()
+    if stream.peek():
+      raise ValueError('Extra data after the JSON document')
+    return cls.FromResults(results, info)
+
+  @classmethod
+  def Load(cls, f, head=''):
+    """Loads an index written by Save."""
+    data = head + f.read()
+    if not data.startswith(INDEX_MAGIC):
+      raise ValueError('Not a digest index')
+    pos = len(INDEX_MAGIC)
+    end = data.index('\n', pos)
+    header = json.loads(data[pos:end])
+    pos = end + 1
+    count = header['count']
+    keys = []
+    for _ in xrange(count):
+      end = data.index('\n', pos)
+      keys.append(tuple(_Intern(s) for s in data[pos:end].split('\t')))
+      pos = end + 1
+    digests = data[pos:]
+    if len(digests) != DIGEST_SIZE * count:
+      raise ValueError('Truncated digest index')
+    return cls(keys, digests, header['info'])
+
+  def Save(self, f):
+    """Writes the index: a header, a line per key, then the digests."""
+    f.write(INDEX_MAGIC)
+    f.write(json.dumps({'count': len(self.keys), 'info': self.info},
+                       sort_keys=True) + '\n')
+    for key in self.keys:
+      f.write('\t'.join(key) + '\n')
+    f.write(self.digests)
+
+
+def _Open(path):
+  """Opens a local file, gzipped if its name ends with .gz, or a URL."""
+  if path.startswith('http:') or path.startswith('https:'):
+    return urllib2.urlopen(path)
+  if path.endswith('.gz'):
+    return gzip.open(path, 'rb')
+  return open(path, 'rb')
+
+
+def LoadIndex(path):
+  """Returns the DigestIndex of a dm.json or a saved index."""
+  f = _Open(path)
+  try:
+    head = f.read(len(INDEX_MAGIC))
+    if head == INDEX_MAGIC:
+      return DigestIndex.Load(f, head)
+    return DigestIndex.FromDMJson(f, head)
+  finally:
+    f.close()
+
+
+def SaveIndex(index, path):
+  with (gzip.open(path, 'wb') if path.endswith('.gz') else
+        open(path, 'wb')) as f:
+    index.Save(f)
+
+
+def DiffIndices(old, new):
+  """Yields (key, status, old digest, new digest) for every key in either.
+
+  Digests are in hex, or None where the key is missing. This is a single
+  merge of the two sorted key lists.
+  """
+  i = 0
+  j = 0
+  while i < len(old.keys) or j < len(new.keys):
+    if j == len(new.keys) or (i < len(old.keys) and
+                              old.keys[i] < new.keys[j]):
+      yield old.keys[i], REMOVED, old.Digest(i), None
+      i += 1
+    elif i == len(old.keys) or new.keys[j] < old.keys[i]:
+      yield new.keys[j], ADDED, None, new.Digest(j)
+      j += 1
+    else:
+      a = old.digests[DIGEST_SIZE*i:DIGEST_SIZE*(i+1)]
+      b = new.digests[DIGEST_SIZE*j:DIGEST_SIZE*(j+1)]
+      status = UNCHANGED if a == b else CHANGED
+      yield old.keys[i], status, old.Digest(i), new.Digest(j)
+      i += 1
+      j += 1
+
+
+def GenerateDiff(old, new):
+  """Returns the differences between two DigestIndexes.
+
+  The result has a count of results per status in 'summary', and a list of
+  the added, removed and changed results in 'diffs'.
+  """
+  summary = dict((s, 0) for s in (ADDED, REMOVED, CHANGED, UNCHANGED))
+  diffs = []
+  for key, status, old_digest, new_digest in DiffIndices(old, new):
+    summary[status] += 1
+    if status != UNCHANGED:
+      name, config, source_type, source_options = key
+      diff = {'name': name, 'config': config, 'source_type': source_type,
+              'status': status, 'old': old_digest, 'new': new_digest}
+      if source_options:
+        diff['source_options'] = source_options
+      diffs.append(diff)
+  return {'summary': summary, 'diffs': diffs}
 
 
 def _Main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        'old',
-        help='Path to JSON file whose expectations to display on ' +
-        'the "old" side of the diff. This can be a filepath on ' +
-        'local storage, or a URL.')
-    parser.add_argument(
-        'new', nargs='?',
-        help='Path to JSON file whose expectations to display on ' +
-        'the "new" side of the diff; if not specified, uses the ' +
-        'ACTUAL results from the "old" JSON file. This can be a ' +
-        'filepath on local storage, or a URL.')
-    args = parser.parse_args()
-    differ = GMDiffer()
-    diffs = differ.GenerateDiffDict(oldfile=args.old, newfile=args.new)
-    json.dump(diffs, sys.stdout, sort_keys=True, indent=2)
+  parser = argparse.ArgumentParser(
+      description='Compares the digests of two DM runs.')
+  parser.add_argument(
+      'old',
+      help='dm.json (optionally gzipped) or saved digest index of the "old" '
+           'run. This can be a filepath on local storage, or a URL.')
+  parser.add_argument(
+      'new',
+      help='dm.json (optionally gzipped) or saved digest index of the "new" '
+           'run. This can be a filepath on local storage, or a URL.')
+  parser.add_argument('--save-old', metavar='PATH',
+                      help='Save the digest index of the "old" run here.')
+  parser.add_argument('--save-new', metavar='PATH',
+                      help='Save the digest index of the "new" run here.')
+  parser.add_argument('--summary', action='store_true',
+                      help='Only print the number of results per status.')
+  args = parser.parse_args()
+
+  old = LoadIndex(args.old)
+  new = LoadIndex(args.new)
+  if args.save_old:
+    SaveIndex(old, args.save_old)
+  if args.save_new:
+    SaveIndex(new, args.save_new)
+  diff = GenerateDiff(old, new)
+  json.dump(diff['summary'] if args.summary else diff, sys.stdout,
+            sort_keys=True, indent=2)
+  sys.stdout.write('\n')
 
 
 if __name__ == '__main__':
-    _Main()
+  _Main()
@@ -3,64 +3,156 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import argparse
+import collections
+import multiprocessing.pool
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
 
-def _Usage():
-  print 'Usage: merge_static_libs OUTPUT_LIB INPUT_LIB [INPUT_LIB]*'
-  sys.exit(1)
+THIN_ARCHIVE_MAGIC = '!<thin>\n'
 
-def MergeLibs(in_libs, out_lib):
+def _IsThinArchive(lib):
+  with open(lib, 'rb') as f:
+    return f.read(len(THIN_ARCHIVE_MAGIC)) == THIN_ARCHIVE_MAGIC
+
+def _Run(cmd, cwd=None):
+  proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+  # communicate() rather than wait(), which can deadlock on a full pipe.
+  output = proc.communicate()[0]
+  if proc.returncode != 0:
+    raise Exception('%s failed:\n%s' % (' '.join(cmd), output))
+  return output
+
+def _IsGnuAr(ar):
+  """ Whether ar is GNU ar, which alone has the 'N' and 'T' modifiers. """
+  try:
+    return 'GNU ar' in _Run([ar, '--version'])
+  except Exception:
+    return False
+
+def _ListMembers(ar, lib):
+  return [m for m in _Run([ar, '-t', lib]).splitlines() if m]
+
+def _ExtractLib(ar, lib, dest_dir, gnu_ar):
+  """ Returns the paths of the objects in lib, extracting them if needed.
+
+  Members of a regular archive are extracted into dest_dir. An archive may
+  hold several members with the same name; with GNU ar, each extra copy is
+  extracted into its own subdirectory rather than overwriting the others.
+  Other ars can't pick one copy out, so only the last one is kept.
+  """
+  members = _ListMembers(ar, lib)
+  if _IsThinArchive(lib):
+    # Thin archives only store the paths of their objects, relative to the
+    # archive.
+    return [os.path.join(os.path.dirname(lib), m) for m in members]
+
+  os.makedirs(dest_dir)
+  _Run([ar, '-x', lib], cwd=dest_dir)
+  objects = []
+  counts = collections.Counter(members)
+  seen = collections.Counter()
+  for m in members:
+    if counts[m] == 1:
+      objects.append(os.path.join(dest_dir, m))
+      continue
+    if not gnu_ar:
+      if not seen[m]:
+        print >> sys.stderr, ('merge_static_libs: %s has %d members named %s; '
+                              '%s is not GNU ar, so only the last one is '
+                              'kept' % (lib, counts[m], m, ar))
+        objects.append(os.path.join(dest_dir, m))
+      seen[m] += 1
+      continue
+    # 'ar -x' left only the last member with this name; 'N' picks the n-th.
+    seen[m] += 1
+    instance_dir = os.path.join(dest_dir, '%s.%d' % (m, seen[m]))
+    os.makedirs(instance_dir)
+    _Run([ar, '-xN', str(seen[m]), lib, m], cwd=instance_dir)
+    objects.append(os.path.join(instance_dir, m))
+  return objects
+
+def _WarnAboutDuplicates(objects):
+  by_name = collections.defaultdict(list)
+  for obj in objects:
+    by_name[os.path.basename(obj)].append(obj)
+  for name, paths in sorted(by_name.iteritems()):
+    if len(paths) > 1:
+      print >> sys.stderr, ('merge_static_libs: %d objects named %s; keeping '
+                            'all of them:\n\t%s' % (len(paths), name,
+                                                    '\n\t'.join(paths)))
+
+def MergeLibs(in_libs, out_lib, thin=False, jobs=None):
   """ Merges multiple static libraries into one.
 
   in_libs: list of paths to static libraries to be merged
   out_lib: path to the static library which will be created from in_libs
+  thin: create a thin archive, which refers to the objects rather than
+    containing copies of them. Objects of thin input libraries are used in
+    place; those of regular ones are extracted next to out_lib.
+  jobs: number of libraries to extract at once; defaults to the CPU count.
   """
   if os.name == 'posix':
-    tempdir = tempfile.mkdtemp()
-    abs_in_libs = []
-    for in_lib in in_libs:
-      abs_in_libs.append(os.path.abspath(in_lib))
-    curdir = os.getcwd()
-    os.chdir(tempdir)
-    objects = []
     ar = os.environ.get('AR', 'ar')
-    for in_lib in abs_in_libs:
-      proc = subprocess.Popen([ar, '-t', in_lib], stdout=subprocess.PIPE)
-      proc.wait()
-      obj_str = proc.communicate()[0]
-      current_objects = obj_str.rstrip().split('\n')
-      proc = subprocess.Popen([ar, '-x', in_lib], stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT)
-      proc.wait()
-      if proc.poll() == 0:
-        # The static library is non-thin, and we extracted objects
-        for obj in current_objects:
-          objects.append(os.path.abspath(obj))
-      elif 'thin archive' in proc.communicate()[0]:
-        # The static library is thin, so it contains the paths to its objects
-        for obj in current_objects:
-          objects.append(obj)
-      else:
-        raise Exception('Failed to extract objects from %s.' % in_lib)
-    os.chdir(curdir)
-    if not subprocess.call([ar, '-crs', out_lib] + objects) == 0:
-      raise Exception('Failed to add object files to %s' % out_lib)
-    shutil.rmtree(tempdir)
+    abs_in_libs = [os.path.abspath(in_lib) for in_lib in in_libs]
+    gnu_ar = _IsGnuAr(ar)
+    if thin and not gnu_ar:
+      print >> sys.stderr, ('merge_static_libs: %s is not GNU ar, so %s will '
+                            'be a regular archive' % (ar, out_lib))
+      thin = False
+    if thin:
+      # The objects must outlive this script.
+      extract_dir = os.path.abspath(out_lib) + '.objects'
+      if os.path.exists(extract_dir):
+        shutil.rmtree(extract_dir)
+    else:
+      extract_dir = tempfile.mkdtemp()
+    try:
+      pool = multiprocessing.pool.ThreadPool(
+          jobs or multiprocessing.cpu_count())
+      try:
+        per_lib_objects = pool.map(
+            lambda (i, lib): _ExtractLib(ar, lib,
+                                         os.path.join(extract_dir, str(i)),
+                                         gnu_ar),
+            enumerate(abs_in_libs))
+      finally:
+        pool.close()
+        pool.join()
+      objects = [obj for objs in per_lib_objects for obj in objs]
+      _WarnAboutDuplicates(objects)
+
+      # 'q' appends without replacing members with the same name, so start
+      # from scratch.
+      if os.path.exists(out_lib):
+        os.remove(out_lib)
+      flags = '-qcsT' if thin else '-qcs'
+      if not subprocess.call([ar, flags, out_lib] + objects) == 0:
+        raise Exception('Failed to add object files to %s' % out_lib)
+    finally:
+      if not thin:
+        shutil.rmtree(extract_dir)
   elif os.name == 'nt':
     subprocess.call(['lib', '/OUT:%s' % out_lib] + in_libs)
   else:
     raise Exception('Error: Your platform is not supported')
 
 def Main():
-  if len(sys.argv) < 3:
-    _Usage()
-  out_lib = sys.argv[1]
-  in_libs = sys.argv[2:]
-  MergeLibs(in_libs, out_lib)
+  parser = argparse.ArgumentParser(
+      usage='merge_static_libs [--thin] [--jobs N] OUTPUT_LIB INPUT_LIB '
+            '[INPUT_LIB]*')
+  parser.add_argument('--thin', action='store_true',
+                      help='create a thin archive (not on Windows)')
+  parser.add_argument('--jobs', type=int,
+                      help='number of libraries to extract at once')
+  parser.add_argument('out_lib')
+  parser.add_argument('in_libs', nargs='+')
+  args = parser.parse_args()
+  MergeLibs(args.in_libs, args.out_lib, args.thin, args.jobs)
 
 if '__main__' == __name__:
   sys.exit(Main())
@@ -8,6 +8,9 @@
 
 
 import argparse
+import array
+import bisect
+import hashlib
 import json
 import os
 import re
@@ -35,17 +38,29 @@ def _fix_filename(filename):
   return filename.split('..')[-1].lstrip('./')
 
 
-def _file_in_repo(filename, all_files):
+def _suffix_index(all_files):
+  """Return an index of |all_files| for looking them up by suffix.
+
+  The index is the sorted list of the reversed paths, so that all files ending
+  in a given suffix are adjacent and can be found by bisecting on the reversed
+  suffix.
+  """
+  return sorted(f[::-1] for f in all_files)
+
+
+def _file_in_repo(filename, index):
   """Return the name of the checked-in file matching the given filename.
 
   Use suffix matching to determine which checked-in files the given filename
   matches. If there are no matches or multiple matches, return None.
   """
   new_file = _fix_filename(filename)
-  matched = []
-  for f in all_files:
-    if f.endswith(new_file):
-      matched.append(f)
+  rev = new_file[::-1]
+  start = bisect.bisect_left(index, rev)
+  end = start
+  while end < len(index) and index[end].startswith(rev):
+    end += 1
+  matched = sorted(f[::-1] for f in index[start:end])
   if len(matched) == 1:
     return matched[0]
   elif len(matched) > 1:
@@ -54,11 +69,8 @@ def _file_in_repo(filename, all_files):
   return None
 
 
-def _get_per_file_per_line_coverage(report):
-  """Return a dict whose keys are file names and values are coverage data.
-
-  Values are lists which take the form (lineno, coverage, code).
-  """
+def _get_all_files():
+  """Return the relative paths of all files under the current directory."""
   all_files = []
   for root, dirs, files in os.walk(os.getcwd()):
     if 'third_party/externals' in root:
@@ -67,37 +79,223 @@ def _get_per_file_per_line_coverage(report):
     dirs[:] = [d for d in dirs if not d[0] == '.']
     for name in files:
       all_files.append(os.path.join(root[(len(os.getcwd()) + 1):], name))
-  all_files.sort()
+  return all_files
+
+
+# Coverage value for lines which aren't executable.
+NOT_EXECUTABLE = -1
+
+FILE_HEADER_RE = re.compile('([a-zA-Z0-9\./_-]+):')
+SKIP_LINE_RE = re.compile('^\s{2}-+$|^\s{2}\|.+$')
+
+
+def _get_per_file_per_line_coverage(report, keep_code=False, only=None):
+  """Return a dict whose keys are file names and values are coverage data.
+
+  |report| is an iterable over the lines of the report. Values are
+  (coverage, code) pairs, where coverage is an array of execution counts
+  indexed by line number - 1, holding NOT_EXECUTABLE for lines we don't care
+  about, and code is the list of source lines (undecoded), or None unless
+  |keep_code| is set. If |only| is given, files not in it are skipped.
+  """
+  index = _suffix_index(_get_all_files())
 
-  lines = report.splitlines()
-  current_file = None
-  file_lines = []
   files = {}
-  not_checked_in = '%' # Use this as the file name for not-checked-in files.
-  for line in lines:
-    m = re.match('([a-zA-Z0-9\./_-]+):', line)
+  coverage = None
+  code = None
+  for line in report:
+    line = line.rstrip('\r\n')
+    m = FILE_HEADER_RE.match(line)
     if m:
-      if current_file and current_file != not_checked_in:
-        files[current_file] = file_lines
-      match_filename = _file_in_repo(m.groups()[0], all_files)
-      current_file = match_filename or not_checked_in
-      file_lines = []
-    else:
-      if current_file != not_checked_in:
-        skip = re.match('^\s{2}-+$|^\s{2}\|.+$', line)
-        if line and not skip:
-          cov, linenum, code = line.split('|', 2)
-          cov = cov.strip()
-          if cov:
-            cov = int(cov)
-          else:
-            cov = None # We don't care about coverage for this line.
-          linenum = int(linenum.strip())
-          assert linenum == len(file_lines) + 1
-          file_lines.append((linenum, cov, code.decode('utf-8', 'replace')))
+      match_filename = _file_in_repo(m.groups()[0], index)
+      if match_filename and (only is None or match_filename in only):
+        coverage = array.array('i')
+        code = [] if keep_code else None
+        files[match_filename] = (coverage, code)
+      else:
+        # Not checked in (or not wanted); skip its lines.
+        coverage = None
+    elif coverage is not None:
+      if line and not SKIP_LINE_RE.match(line):
+        cov, linenum, text = line.split('|', 2)
+        cov = cov.strip()
+        assert int(linenum) == len(coverage) + 1
+        coverage.append(int(cov) if cov else NOT_EXECUTABLE)
+        if code is not None:
+          code.append(text)
   return files
 
 
+def _write_line_by_line(line_by_line, f):
+  """Write the coverage data as JSON: {file: [[lineno, coverage, code]]}."""
+  f.write('{')
+  for i, (filepath, (coverage, code)) in enumerate(
+      sorted(line_by_line.iteritems())):
+    if i:
+      f.write(', ')
+    f.write(json.dumps(filepath))
+    f.write(': ')
+    f.write(json.dumps([
+        (n + 1, cov if cov != NOT_EXECUTABLE else None,
+         code[n].decode('utf-8', 'replace'))
+        for n, cov in enumerate(coverage)]))
+  f.write('}')
+
+
+def _load_line_by_line(f, only=None):
+  """Load coverage data written by _write_line_by_line.
+
+  Returns the same structure as _get_per_file_per_line_coverage, without the
+  source lines.
+  """
+  files = {}
+  for filepath, lines in json.load(f).iteritems():
+    if only is None or filepath in only:
+      files[filepath] = (array.array(
+          'i', (NOT_EXECUTABLE if cov is None else cov for _, cov, _ in lines)),
+          None)
+  return files
+
+
+def _git(*args):
+  return subprocess.check_output(['git'] + list(args)).strip()
+
+
+def _resolve_range(diff_range):
+  """Return the (base, head) commit hashes of a BASE..HEAD or BASE range.
+
+  A bare BASE means BASE..HEAD.
+  """
+  base, _, head = diff_range.partition('..')
+  return (_git('rev-parse', '--verify', base + '^{commit}'),
+          _git('rev-parse', '--verify', (head or 'HEAD') + '^{commit}'))
+
+
+HUNK_RE = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+
+def _get_changed_lines(base, head):
+  """Return a dict mapping each file changed in base..head to the sorted line
+  numbers, in head, of its added or modified lines."""
+  diff = subprocess.Popen(
+      ['git', 'diff', '--no-color', '--no-ext-diff', '--unified=0',
+       '--diff-filter=d', base, head], stdout=subprocess.PIPE)
+  changed = {}
+  lines = None
+  for line in diff.stdout:
+    if line.startswith('+++ '):
+      path = line[4:].rstrip('\n')
+      if path.startswith('b/'):
+        lines = changed.setdefault(path[2:], [])
+      else:
+        lines = None  # /dev/null
+      continue
+    m = HUNK_RE.match(line)
+    if m and lines is not None:
+      start = int(m.group(1))
+      count = int(m.group(2)) if m.group(2) is not None else 1
+      lines.extend(range(start, start + count))
+  if diff.wait() != 0:
+    raise Exception('git diff %s %s failed' % (base, head))
+  return dict((f, l) for f, l in changed.iteritems() if l)
+
+
+def _get_differential_coverage(line_by_line, changed):
+  """Summarize coverage of only the changed lines of each file.
+
+  |changed| is as returned by _get_changed_lines. Files without coverage data
+  (headers, scripts, files not built) are listed but not counted.
+  """
+  files = {}
+  not_instrumented = []
+  total_lines = 0
+  covered_lines = 0
+  for filepath, linenums in sorted(changed.iteritems()):
+    if filepath not in line_by_line:
+      not_instrumented.append(filepath)
+      continue
+    coverage = line_by_line[filepath][0]
+    not_covered = []
+    file_total = 0
+    for linenum in linenums:
+      cov = coverage[linenum - 1] if linenum <= len(coverage) else \
+          NOT_EXECUTABLE
+      if cov != NOT_EXECUTABLE:
+        file_total += 1
+        if cov == 0:
+          not_covered.append(linenum)
+    if file_total > 0:
+      files[filepath] = {
+        'percent': 100.0 * (file_total - len(not_covered)) / file_total,
+        'lines': file_total,
+        'lines_not_covered': not_covered,
+      }
+      total_lines += file_total
+      covered_lines += file_total - len(not_covered)
+  return {
+    'files': files,
+    'not_instrumented': not_instrumented,
+    'lines': total_lines,
+    'lines_covered': covered_lines,
+    'percent': (100.0 * covered_lines / total_lines) if total_lines else 100.0,
+  }
+
+
+def _cache_path(cache_dir, base, head, coverage_file):
+  """Return where differential results for base..head are cached.
+
+  Results are stored per head commit, and are also keyed by the coverage data
+  they were computed from.
+  """
+  h = hashlib.sha1()
+  with open(coverage_file, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      h.update(chunk)
+  return os.path.join(cache_dir, head, '%s-%s.json' % (base, h.hexdigest()))
+
+
+def _print_differential_coverage(result, f=sys.stdout):
+  f.write('Changed lines covered: %d/%d (%.1f%%)\n' % (
+      result['lines_covered'], result['lines'], result['percent']))
+  for filepath, r in sorted(result['files'].iteritems()):
+    f.write('  %5.1f%% %s' % (r['percent'], filepath))
+    if r['lines_not_covered']:
+      f.write(' (not covered: %s)' % ', '.join(
+          str(l) for l in r['lines_not_covered']))
+    f.write('\n')
+
+
+def _differential_coverage(args):
+  """Compute (or load from the cache) coverage of the lines in args.diff."""
+  coverage_file = args.report or args.coverage
+  base, head = _resolve_range(args.diff)
+  cache_file = None
+  if args.cache_dir:
+    cache_file = _cache_path(args.cache_dir, base, head, coverage_file)
+    if os.path.isfile(cache_file):
+      with open(cache_file) as f:
+        return json.load(f)
+
+  changed = _get_changed_lines(base, head)
+  only = set(changed)
+  with open(coverage_file) as f:
+    if args.report:
+      line_by_line = _get_per_file_per_line_coverage(f, only=only)
+    else:
+      line_by_line = _load_line_by_line(f, only=only)
+  result = _get_differential_coverage(line_by_line, changed)
+  result['base'] = base
+  result['head'] = head
+
+  if cache_file:
+    if not os.path.isdir(os.path.dirname(cache_file)):
+      os.makedirs(os.path.dirname(cache_file))
+    tmp = cache_file + '.%d.tmp' % os.getpid()
+    with open(tmp, 'w') as f:
+      json.dump(result, f)
+    os.rename(tmp, cache_file)
+  return result
+
 
 def _testname(filename):
   """Transform the file name into an ingestible test name."""
@@ -154,8 +352,8 @@ def _get_per_file_summaries(line_by_line):
   for filepath, lines in line_by_line.iteritems():
     total_lines = 0
     covered_lines = 0
-    for _, cov, _ in lines:
-      if cov is not None:
+    for cov in lines[0]:
+      if cov != NOT_EXECUTABLE:
         total_lines += 1
         if cov > 0:
           covered_lines += 1
@@ -170,8 +368,12 @@ def main():
   """Generate useful data from a coverage report."""
   # Parse args.
   parser = argparse.ArgumentParser()
-  parser.add_argument('--report', help='input file; an llvm coverage report.',
-                      required=True)
+  inputs = parser.add_mutually_exclusive_group(required=True)
+  inputs.add_argument('--report', help='input file; an llvm coverage report.')
+  inputs.add_argument('--coverage',
+                      help='input file; line-by-line JSON data written by an '
+                           'earlier run with --linebyline. Only usable with '
+                           '--diff.')
   parser.add_argument('--nanobench', help='output file for nanobench data.')
   parser.add_argument(
       '--key', metavar='key_or_value', nargs='+',
@@ -181,19 +383,42 @@ def main():
       help='key/value pairs representing properties of this build.')
   parser.add_argument('--linebyline',
                       help='output file for line-by-line JSON data.')
+  parser.add_argument('--diff', metavar='BASE[..HEAD]',
+                      help='only report coverage of the lines added or '
+                           'changed in this git range. HEAD defaults to HEAD.')
+  parser.add_argument('--diff-out',
+                      help='output file for the --diff JSON results.')
+  parser.add_argument('--cache-dir',
+                      help='cache --diff results here, per commit.')
+  parser.add_argument('--min-percent', type=float,
+                      help='with --diff, exit with an error if less than this '
+                           'percentage of the changed lines is covered.')
   args = parser.parse_args()
 
   if args.nanobench and not (args.key and args.properties):
     raise Exception('--key and --properties are required with --nanobench')
 
-  with open(args.report) as f:
-    report = f.read()
+  if args.diff:
+    if args.nanobench or args.linebyline:
+      raise Exception('--diff can\'t be used with --nanobench or --linebyline')
+    result = _differential_coverage(args)
+    _print_differential_coverage(result)
+    if args.diff_out:
+      with open(args.diff_out, 'w') as f:
+        json.dump(result, f)
+    if args.min_percent is not None and result['percent'] < args.min_percent:
+      sys.exit(1)
+    return
+  if args.coverage:
+    raise Exception('--coverage requires --diff')
 
-  line_by_line = _get_per_file_per_line_coverage(report)
+  with open(args.report) as f:
+    line_by_line = _get_per_file_per_line_coverage(
+        f, keep_code=bool(args.linebyline))
 
   if args.linebyline:
     with open(args.linebyline, 'w') as f:
-      json.dump(line_by_line, f)
+      _write_line_by_line(line_by_line, f)
 
   if args.nanobench:
     # Parse the key and properties for use in the nanobench JSON output.
@@ -3,25 +3,332 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""Downloads SVGs into a specified directory."""
+"""Downloads SVGs into a specified directory.
 
+SVGs are downloaded several at a time, each thread keeping one connection
+open per host, and failed downloads are retried with exponential backoff.
+A manifest, in the output directory unless given elsewhere, records the URL,
+validators (ETag and Last-Modified), size and SHA1 of each SVG, so that SVGs
+which haven't changed since the last run aren't downloaded again. Interrupted
+downloads resume where they left off, if the server supports it.
+"""
 
+
+import hashlib
+import httplib
+import json
+import multiprocessing.pool
 import optparse
 import os
+import random
+import socket
 import sys
-import urllib
+import threading
+import time
+import urlparse
 
 
 PARENT_DIR = os.path.dirname(os.path.realpath(__file__))
 
+MANIFEST_FILENAME = 'svgs_manifest.json'
+DEFAULT_JOBS = 8
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 1.0
+MAX_REDIRECTS = 5
+TIMEOUT_SECONDS = 60
+CHUNK_SIZE = 64 * 1024
+
+# Partial downloads are written to <dest>.part, with the validators of the
+# response they came from in <dest>.part.json.
+PART_SUFFIX = '.part'
+PART_INFO_SUFFIX = '.part.json'
+
+DOWNLOADED = 'downloaded'
+RESUMED = 'resumed'
+UNCHANGED = 'unchanged'
+
+
+class DownloadError(Exception):
+  pass
+
 
-def downloadSVGs(svgs_file, output_dir, prefix):
+class _RetryableError(Exception):
+  pass
+
+
+def readURLs(svgs_file, prefix=''):
+  """Returns (url, file name) for each URL in svgs_file."""
+  urls = []
   with open(svgs_file, 'r') as f:
-    for url in f.xreadlines():
-      svg_url = url.strip()
-      dest_file = os.path.join(output_dir, prefix + os.path.basename(svg_url))
-      print 'Downloading %s' % svg_url
-      urllib.urlretrieve(svg_url, dest_file)
+    for line in f:
+      url = line.strip()
+      if url:
+        urls.append((url, prefix + os.path.basename(url)))
+  return urls
+
+
+def _hashFile(path):
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def _removeIfExists(path):
+  if os.path.exists(path):
+    os.remove(path)
+
+
+def removePartialDownloads(output_dir):
+  """Removes what interrupted downloads left in output_dir."""
+  for filename in os.listdir(output_dir):
+    if filename.endswith(PART_SUFFIX) or filename.endswith(PART_INFO_SUFFIX):
+      os.remove(os.path.join(output_dir, filename))
+
+
+class Downloader(object):
+  """Downloads URLs into a directory, see the module docstring."""
+
+  def __init__(self, output_dir, manifest_path=None, jobs=DEFAULT_JOBS,
+               force=False, max_attempts=MAX_ATTEMPTS,
+               backoff_seconds=BACKOFF_SECONDS):
+    self._output_dir = output_dir
+    self._manifest_path = manifest_path or os.path.join(output_dir,
+                                                        MANIFEST_FILENAME)
+    self._jobs = jobs
+    self._force = force
+    self._max_attempts = max_attempts
+    self._backoff_seconds = backoff_seconds
+    self._manifest = {}
+    if os.path.isfile(self._manifest_path):
+      with open(self._manifest_path) as f:
+        self._manifest = json.load(f)
+    self._lock = threading.Lock()
+    # Each thread's connections, by (scheme, host), and all of them.
+    self._local = threading.local()
+    self._all_connections = []
+
+  def _log(self, msg):
+    # One write per line, so that threads don't interleave.
+    sys.stdout.write(msg + '\n')
+
+  def _connection(self, scheme, netloc):
+    if not hasattr(self._local, 'connections'):
+      self._local.connections = {}
+    conn = self._local.connections.get((scheme, netloc))
+    if conn is None:
+      if scheme == 'https':
+        conn = httplib.HTTPSConnection(netloc, timeout=TIMEOUT_SECONDS)
+      elif scheme == 'http':
+        conn = httplib.HTTPConnection(netloc, timeout=TIMEOUT_SECONDS)
+      else:
+        raise DownloadError('Unsupported URL scheme: %s' % scheme)
+      self._local.connections[(scheme, netloc)] = conn
+      with self._lock:
+        self._all_connections.append(conn)
+    return conn
+
+  def _dropConnection(self, scheme, netloc):
+    conn = self._local.connections.pop((scheme, netloc), None)
+    if conn:
+      conn.close()
+
+  def _request(self, method, url, headers):
+    """Returns the response to the request, following redirects."""
+    for _ in xrange(MAX_REDIRECTS + 1):
+      parsed = urlparse.urlsplit(url)
+      path = parsed.path or '/'
+      if parsed.query:
+        path += '?' + parsed.query
+      conn = self._connection(parsed.scheme, parsed.netloc)
+      reused = conn.sock is not None
+      try:
+        conn.request(method, path, headers=headers)
+        resp = conn.getresponse()
+      except (httplib.HTTPException, socket.error) as e:
+        self._dropConnection(parsed.scheme, parsed.netloc)
+        if not reused:
+          raise _RetryableError(str(e))
+        # The server closed the idle connection; try again on a new one.
+        conn = self._connection(parsed.scheme, parsed.netloc)
+        try:
+          conn.request(method, path, headers=headers)
+          resp = conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+          self._dropConnection(parsed.scheme, parsed.netloc)
+          raise _RetryableError(str(e))
+      if resp.status not in (301, 302, 303, 307, 308):
+        return resp
+      resp.read()
+      url = urlparse.urljoin(url, resp.getheader('location'))
+    raise DownloadError('Too many redirects: %s' % url)
+
+  def _isIntact(self, dest, entry):
+    """Whether dest is still what the manifest entry says was downloaded."""
+    return (os.path.isfile(dest) and
+            os.path.getsize(dest) == entry['size'] and
+            _hashFile(dest) == entry['sha1'])
+
+  def _tryFetch(self, url, dest, entry):
+    """Makes one attempt at downloading url into dest.
+
+    entry is dest's manifest entry, if dest is intact, in which case url is
+    only downloaded again if it changed.
+    """
+    part = dest + PART_SUFFIX
+    part_info = dest + PART_INFO_SUFFIX
+    headers = {'Accept-Encoding': 'identity'}
+
+    if entry and not (entry.get('etag') or entry.get('last_modified')):
+      # Without validators, the best we can do is compare sizes.
+      resp = self._request('HEAD', url, headers)
+      resp.read()
+      length = resp.getheader('content-length')
+      if resp.status == 200 and length and int(length) == entry['size']:
+        return UNCHANGED
+      entry = None
+    if entry and entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    elif entry:
+      headers['If-Modified-Since'] = entry['last_modified']
+
+    offset = 0
+    if os.path.isfile(part) and os.path.isfile(part_info):
+      with open(part_info) as f:
+        info = json.load(f)
+      validator = info.get('etag') or info.get('last_modified')
+      if info.get('url') == url and validator:
+        offset = os.path.getsize(part)
+        headers['Range'] = 'bytes=%d-' % offset
+        headers['If-Range'] = validator
+
+    resp = self._request('GET', url, headers)
+    if resp.status == 304:
+      resp.read()
+      return UNCHANGED
+    if resp.status == 206:
+      content_range = resp.getheader('content-range', '')
+      if not content_range.startswith('bytes %d-' % offset):
+        resp.read()
+        _removeIfExists(part)
+        raise _RetryableError('Unexpected Content-Range: %s' % content_range)
+    elif resp.status == 416:
+      # The partial download is no good; start over.
+      resp.read()
+      _removeIfExists(part)
+      raise _RetryableError('Range not satisfiable')
+    elif resp.status == 429 or resp.status >= 500:
+      resp.read()
+      raise _RetryableError('HTTP %d' % resp.status)
+    elif resp.status != 200:
+      resp.read()
+      raise DownloadError('HTTP %d' % resp.status)
+
+    validators = {
+      'url': url,
+      'etag': resp.getheader('etag'),
+      'last_modified': resp.getheader('last-modified'),
+    }
+    resuming = resp.status == 206
+    if not resuming:
+      offset = 0
+      with open(part_info, 'w') as f:
+        json.dump(validators, f)
+    length = resp.getheader('content-length')
+    received = 0
+    try:
+      with open(part, 'ab' if resuming else 'wb') as f:
+        for chunk in iter(lambda: resp.read(CHUNK_SIZE), ''):
+          f.write(chunk)
+          received += len(chunk)
+    except (httplib.HTTPException, socket.error) as e:
+      raise _RetryableError(str(e))
+    if length is not None and received != int(length):
+      raise _RetryableError('Expected %s bytes, got %d' % (length, received))
+
+    if os.path.exists(dest):
+      os.remove(dest)
+    os.rename(part, dest)
+    _removeIfExists(part_info)
+    validators['size'] = os.path.getsize(dest)
+    validators['sha1'] = _hashFile(dest)
+    self._updateManifest(os.path.basename(dest), validators)
+    return RESUMED if resuming else DOWNLOADED
+
+  def _updateManifest(self, filename, entry):
+    with self._lock:
+      self._manifest[filename] = entry
+      tmp = self._manifest_path + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump(self._manifest, f, indent=2, sort_keys=True)
+      if os.path.exists(self._manifest_path):
+        os.remove(self._manifest_path)
+      os.rename(tmp, self._manifest_path)
+
+  def _fetch(self, url, filename):
+    """Downloads url into filename, retrying; returns what was done."""
+    dest = os.path.join(self._output_dir, filename)
+    entry = self._manifest.get(filename)
+    if (self._force or not entry or entry.get('url') != url or
+        not self._isIntact(dest, entry)):
+      entry = None
+    for attempt in xrange(self._max_attempts):
+      try:
+        return self._tryFetch(url, dest, entry)
+      except _RetryableError as e:
+        if attempt + 1 == self._max_attempts:
+          raise DownloadError(str(e))
+        delay = self._backoff_seconds * 2 ** attempt * random.uniform(1, 1.5)
+        self._log('Retrying %s in %.1fs: %s' % (url, delay, e))
+        time.sleep(delay)
+
+  def download(self, urls):
+    """Downloads each (url, file name) in urls.
+
+    Returns a dict mapping each URL which couldn't be downloaded to the
+    error.
+    """
+    if not os.path.isdir(self._output_dir):
+      os.makedirs(self._output_dir)
+    errors = {}
+
+    def fetch((url, filename)):
+      try:
+        self._log('%s: %s' % (url, self._fetch(url, filename)))
+      except DownloadError as e:
+        self._log('%s: failed: %s' % (url, e))
+        errors[url] = e
+
+    pool = multiprocessing.pool.ThreadPool(self._jobs)
+    try:
+      pool.map(fetch, urls)
+    finally:
+      pool.close()
+      pool.join()
+      for conn in self._all_connections:
+        conn.close()
+    return errors
+
+
+def downloadURLs(urls, output_dir, jobs=DEFAULT_JOBS, force=False,
+                 manifest_path=None):
+  """Downloads each (url, file name) in urls into output_dir.
+
+  Returns 1 if any of them failed, after trying all of them.
+  """
+  errors = Downloader(output_dir, manifest_path=manifest_path, jobs=jobs,
+                      force=force).download(urls)
+  if errors:
+    print 'Failed to download %d of %d SVGs.' % (len(errors), len(urls))
+    return 1
+  return 0
+
+
+def downloadSVGs(svgs_file, output_dir, prefix, jobs=DEFAULT_JOBS,
+                 force=False, manifest_path=None):
+  return downloadURLs(readURLs(svgs_file, prefix), output_dir, jobs=jobs,
+                      force=force, manifest_path=manifest_path)
 
 
 if '__main__' == __name__:
@@ -38,8 +345,22 @@ if '__main__' == __name__:
       '-p', '--prefix',
       help='The prefix which downloaded SVG file will begin with.',
       default='')
+  option_parser.add_option(
+      '-j', '--jobs', type='int',
+      help='The number of SVGs to download at once.',
+      default=DEFAULT_JOBS)
+  option_parser.add_option(
+      '-f', '--force', action='store_true',
+      help='Download SVGs again even if they have not changed.',
+      default=False)
+  option_parser.add_option(
+      '-m', '--manifest_path',
+      help='Where to keep the manifest. Defaults to %s in the output dir.' %
+           MANIFEST_FILENAME)
   options, unused_args = option_parser.parse_args()
 
   if not options.output_dir:
     raise Exception('Must specify --output_dir')
-  sys.exit(downloadSVGs(options.svgs_file, options.output_dir, options.prefix))
+  sys.exit(downloadSVGs(options.svgs_file, options.output_dir, options.prefix,
+                        jobs=options.jobs, force=options.force,
+                        manifest_path=options.manifest_path))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc.
+#
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+
+"""Tests for svg_downloader, against a local HTTP server."""
+
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+import svg_downloader
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+    # Contents and ETag by path.
+    self.files = {}
+    # Number of requests to fail with a 503 before serving, by path.
+    self.failures = {}
+    # The headers of each request, by path.
+    self.requests = {}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    server = self.server
+    server.requests.setdefault(self.path, []).append(dict(self.headers))
+    if server.failures.get(self.path):
+      server.failures[self.path] -= 1
+      self.send_error(503)
+      return
+    if self.path not in server.files:
+      self.send_error(404)
+      return
+    contents, etag = server.files[self.path]
+    if self.headers.get('if-none-match') == etag:
+      self.send_response(304)
+      self.end_headers()
+      return
+    start = 0
+    range_header = self.headers.get('range')
+    if range_header and self.headers.get('if-range') == etag:
+      start = int(range_header[len('bytes='):-len('-')])
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+          start, len(contents) - 1, len(contents)))
+    else:
+      self.send_response(200)
+    self.send_header('ETag', etag)
+    self.send_header('Content-Length', str(len(contents) - start))
+    self.end_headers()
+    self.wfile.write(contents[start:])
+
+
+class SvgDownloaderTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.out = os.path.join(self.tmp, 'out')
+    self.manifest = os.path.join(self.tmp, 'manifest.json')
+    self.server = _Server()
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmp)
+
+  def url(self, path):
+    return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+
+  def download(self, paths):
+    downloader = svg_downloader.Downloader(
+        self.out, manifest_path=self.manifest, jobs=2, backoff_seconds=0)
+    downloader._log = lambda msg: None
+    return downloader.download(
+        [(self.url(p), os.path.basename(p)) for p in paths])
+
+  def read(self, filename):
+    with open(os.path.join(self.out, filename), 'rb') as f:
+      return f.read()
+
+  def test_retry(self):
+    self.server.files['/a.svg'] = ('<svg/>', '"a"')
+    self.server.failures['/a.svg'] = 2
+    self.assertEqual(self.download(['/a.svg']), {})
+    self.assertEqual(self.read('a.svg'), '<svg/>')
+    self.assertEqual(len(self.server.requests['/a.svg']), 3)
+
+  def test_give_up(self):
+    self.server.failures['/a.svg'] = svg_downloader.MAX_ATTEMPTS
+    self.assertEqual(sorted(self.download(['/a.svg', '/missing.svg'])),
+                     [self.url('/a.svg'), self.url('/missing.svg')])
+    self.assertEqual(len(self.server.requests['/a.svg']),
+                     svg_downloader.MAX_ATTEMPTS)
+    # Not found isn't retried.
+    self.assertEqual(len(self.server.requests['/missing.svg']), 1)
+
+  def test_conditional_download(self):
+    self.server.files['/a.svg'] = ('<svg/>', '"a1"')
+    self.server.files['/b.svg'] = ('<svg></svg>', '"b1"')
+    self.assertEqual(self.download(['/a.svg', '/b.svg']), {})
+    self.assertEqual(sorted(os.listdir(self.out)), ['a.svg', 'b.svg'])
+
+    # Unchanged SVGs are validated with their ETag, and not downloaded again.
+    self.server.files['/b.svg'] = ('<svg><g/></svg>', '"b2"')
+    self.assertEqual(self.download(['/a.svg', '/b.svg']), {})
+    self.assertEqual(self.server.requests['/a.svg'][1]['if-none-match'],
+                     '"a1"')
+    self.assertEqual(self.read('a.svg'), '<svg/>')
+    self.assertEqual(self.read('b.svg'), '<svg><g/></svg>')
+    with open(self.manifest) as f:
+      self.assertEqual(json.load(f)['b.svg']['etag'], '"b2"')
+
+    # An SVG which was modified locally is downloaded again.
+    with open(os.path.join(self.out, 'a.svg'), 'wb') as f:
+      f.write('<svg>modified</svg>')
+    self.assertEqual(self.download(['/a.svg']), {})
+    self.assertNotIn('if-none-match', self.server.requests['/a.svg'][2])
+    self.assertEqual(self.read('a.svg'), '<svg/>')
+
+  def test_resume(self):
+    contents = '<svg>%s</svg>' % ('x' * 1000)
+    self.server.files['/a.svg'] = (contents, '"a"')
+    os.makedirs(self.out)
+    dest = os.path.join(self.out, 'a.svg')
+    with open(dest + svg_downloader.PART_SUFFIX, 'wb') as f:
+      f.write(contents[:600])
+    with open(dest + svg_downloader.PART_INFO_SUFFIX, 'w') as f:
+      json.dump({'url': self.url('/a.svg'), 'etag': '"a"'}, f)
+
+    self.assertEqual(self.download(['/a.svg']), {})
+    self.assertEqual(self.server.requests['/a.svg'][0]['range'], 'bytes=600-')
+    self.assertEqual(self.read('a.svg'), contents)
+    self.assertEqual(os.listdir(self.out), ['a.svg'])
+
+  def test_resume_changed(self):
+    # A partial download of an older version is thrown away.
+    self.server.files['/a.svg'] = ('<svg>new</svg>', '"new"')
+    os.makedirs(self.out)
+    dest = os.path.join(self.out, 'a.svg')
+    with open(dest + svg_downloader.PART_SUFFIX, 'wb') as f:
+      f.write('<svg>ol')
+    with open(dest + svg_downloader.PART_INFO_SUFFIX, 'w') as f:
+      json.dump({'url': self.url('/a.svg'), 'etag': '"old"'}, f)
+
+    self.assertEqual(self.download(['/a.svg']), {})
+    self.assertEqual(self.read('a.svg'), '<svg>new</svg>')
+
+  def test_remove_partial_downloads(self):
+    os.makedirs(self.out)
+    for filename in ('a.svg', 'b.svg.part', 'b.svg.part.json'):
+      open(os.path.join(self.out, filename), 'w').close()
+    svg_downloader.removePartialDownloads(self.out)
+    self.assertEqual(os.listdir(self.out), ['a.svg'])
+
+
+if __name__ == '__main__':
+  unittest.main()